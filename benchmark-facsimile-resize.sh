@@ -0,0 +1,3 @@
+#!/bin/bash
+
+docker-compose exec backend python /app/sls_api/scripts/benchmark_facsimile_resize.py ${@:1}
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+docker-compose exec backend python /app/sls_api/scripts/generate_facsimile_tiles.py ${@:1}
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+docker-compose exec backend python /app/sls_api/scripts/prewarm_cache.py ${@:1}
@@ -0,0 +1,248 @@
+import hashlib
+import os
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import Optional, Tuple
+
+VALUE_HEADER = struct.Struct("!d")
+
+
+def pack_value(value, created):
+    return VALUE_HEADER.pack(created) + zlib.compress(value, 6)
+
+
+def unpack_value(packed_value):
+    created, = VALUE_HEADER.unpack_from(packed_value)
+    return zlib.decompress(packed_value[VALUE_HEADER.size:]), created
+
+
+class CacheBackend:
+    """
+    Base class for the backends used for sharing rendered content between API replicas,
+    see 'shared_render_cache' in digital_editions_example.yml.
+
+    Backends store values (bytes) by key (str) along with the time the value was created, and expire values
+    'ttl_seconds' after they were created. Values are stored zlib compressed, with the creation time as a header.
+    """
+    name = None
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key) -> Optional[Tuple[bytes, float]]:
+        """
+        Returns a tuple of the value stored for 'key' and the time it was created, or None if there's no such value
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, created):
+        """
+        Stores 'value' for 'key', created at the UNIX timestamp 'created'
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def is_expired(self, created):
+        return created + self.ttl_seconds < time.time()
+
+
+class FilesystemCacheBackend(CacheBackend):
+    """
+    Stores values as files in a directory, e.g. on a volume shared between replicas
+    """
+    name = "filesystem"
+
+    def __init__(self, ttl_seconds, path):
+        super().__init__(ttl_seconds)
+        self.path = path
+
+    def _get_file_path(self, key):
+        key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key_hash[:2], key_hash)
+
+    def get(self, key):
+        try:
+            with open(self._get_file_path(key), "rb") as value_file:
+                value, created = unpack_value(value_file.read())
+        except FileNotFoundError:
+            return None
+        if self.is_expired(created):
+            return None
+        return value, created
+
+    def set(self, key, value, created):
+        file_path = self._get_file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+        try:
+            with os.fdopen(temp_fd, "wb") as temp_file:
+                temp_file.write(pack_value(value, created))
+            os.replace(temp_path, file_path)
+        except Exception:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._get_file_path(key))
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Stores values in an SQLite database file, e.g. on a volume shared between replicas.
+    Expired values are deleted every 'cleanup_interval' writes.
+    """
+    name = "sqlite"
+
+    def __init__(self, ttl_seconds, path, timeout_seconds=5, cleanup_interval=1000):
+        super().__init__(ttl_seconds)
+        self.path = path
+        self.timeout_seconds = timeout_seconds
+        self.cleanup_interval = cleanup_interval
+        self._local = threading.local()
+        self._writes = 0
+
+    def _get_connection(self):
+        # sqlite3 connections can't be shared between threads, or between processes after forking
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout_seconds, isolation_level=None)
+            connection.execute("CREATE TABLE IF NOT EXISTS render_cache (key TEXT PRIMARY KEY, created REAL NOT NULL, value BLOB NOT NULL)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._get_connection().execute("SELECT value FROM render_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created = unpack_value(row[0])
+        if self.is_expired(created):
+            return None
+        return value, created
+
+    def set(self, key, value, created):
+        connection = self._get_connection()
+        connection.execute("INSERT OR REPLACE INTO render_cache (key, created, value) VALUES (?, ?, ?)",
+                           (key, created, pack_value(value, created)))
+        self._writes += 1
+        if self._writes % self.cleanup_interval == 0:
+            connection.execute("DELETE FROM render_cache WHERE created < ?", (time.time() - self.ttl_seconds,))
+
+    def delete(self, key):
+        self._get_connection().execute("DELETE FROM render_cache WHERE key = ?", (key,))
+
+
+class MemcachedCacheBackend(CacheBackend):
+    """
+    Stores values on one or more memcached servers ('host:port'), using the memcached text protocol.
+    Keys are distributed over the servers by their hash. memcached rejects values larger than its item size limit
+    (1 MB by default, see the -I option of memcached), such values aren't shared.
+    """
+    name = "memcached"
+
+    def __init__(self, ttl_seconds, servers, timeout_seconds=0.5):
+        super().__init__(ttl_seconds)
+        self.servers = []
+        for server in servers:
+            host, _, port = server.rpartition(":")
+            self.servers.append((host, int(port)))
+        self.timeout_seconds = timeout_seconds
+        self._local = threading.local()
+
+    def _get_server_key(self, key):
+        key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.servers[int(key_hash[:8], 16) % len(self.servers)], key_hash
+
+    def _get_connection(self, server):
+        connections = getattr(self._local, "connections", None)
+        if connections is None or self._local.pid != os.getpid():
+            connections = self._local.connections = {}
+            self._local.pid = os.getpid()
+        if server not in connections:
+            connection = socket.create_connection(server, timeout=self.timeout_seconds)
+            connections[server] = (connection, connection.makefile("rb"))
+        return connections[server]
+
+    def _close_connection(self, server):
+        connection, reader = self._local.connections.pop(server)
+        reader.close()
+        connection.close()
+
+    def _call(self, server, request, read_response):
+        connection, reader = self._get_connection(server)
+        try:
+            connection.sendall(request)
+            return read_response(reader)
+        except Exception:
+            # the connection is in an unknown state after an error, reconnect on the next call
+            self._close_connection(server)
+            raise
+
+    def get(self, key):
+        server, key_hash = self._get_server_key(key)
+
+        def read_response(reader):
+            line = reader.readline()
+            if line == b"END\r\n":
+                return None
+            if not line.startswith(b"VALUE "):
+                raise IOError("Unexpected response from memcached: {!r}".format(line[:100]))
+            length = int(line.split()[3])
+            packed_value = reader.read(length + 2)[:length]
+            if reader.readline() != b"END\r\n":
+                raise IOError("Unexpected end of response from memcached")
+            return packed_value
+
+        packed_value = self._call(server, "get {}\r\n".format(key_hash).encode("ascii"), read_response)
+        if packed_value is None:
+            return None
+        value, created = unpack_value(packed_value)
+        if self.is_expired(created):
+            return None
+        return value, created
+
+    def set(self, key, value, created):
+        server, key_hash = self._get_server_key(key)
+        packed_value = pack_value(value, created)
+        # memcached treats expiration times over 30 days as UNIX timestamps
+        expires = int(created + self.ttl_seconds)
+        request = "set {} 0 {} {}\r\n".format(key_hash, expires, len(packed_value)).encode("ascii") + packed_value + b"\r\n"
+        response = self._call(server, request, lambda reader: reader.readline())
+        if response.startswith(b"SERVER_ERROR object too large"):
+            # the value is larger than the item size limit of memcached, it's just not shared
+            return
+        if response != b"STORED\r\n":
+            raise IOError("memcached did not store value: {!r}".format(response[:100]))
+
+    def delete(self, key):
+        server, key_hash = self._get_server_key(key)
+        self._call(server, "delete {}\r\n".format(key_hash).encode("ascii"), lambda reader: reader.readline())
+
+
+def create_cache_backend(settings, ttl_seconds):
+    """
+    Creates a cache backend from the 'shared_render_cache' settings, or returns None if 'settings' is empty
+    """
+    if not settings:
+        return None
+    backend = settings.get("backend")
+    if backend == FilesystemCacheBackend.name:
+        return FilesystemCacheBackend(ttl_seconds, settings["path"])
+    if backend == SQLiteCacheBackend.name:
+        return SQLiteCacheBackend(ttl_seconds, settings["path"], timeout_seconds=settings.get("timeout_seconds", 5))
+    if backend == MemcachedCacheBackend.name:
+        return MemcachedCacheBackend(ttl_seconds, settings["servers"], timeout_seconds=settings.get("timeout_seconds", 0.5))
+    raise ValueError("Unknown shared_render_cache backend {!r}, must be one of 'filesystem', 'sqlite' or 'memcached'".format(backend))
@@ -13,6 +13,15 @@ logger = logging.getLogger("sls_api.correspondence")
 @correspondence.route("/<project>/correspondence/publication/metadata/<pub_id>")
 def get_correspondence_metadata_for_publication(project, pub_id):
     logger.info("Getting results for /correspondence/manifestations/")
+    data = get_publication_correspondence_metadata(project, pub_id)
+    return jsonify(data), 200
+
+
+def get_publication_correspondence_metadata(project, pub_id):
+    """
+    Returns the correspondence metadata of a publication, see get_correspondence_metadata_for_publication.
+    Also used by the publication bundle endpoint in text.py.
+    """
     connection = db_engine.connect()
     project_id = get_project_id_from_name(project)
     corresp_sql = """SELECT c.*, ec.type,s.full_name as full_name, s.id as subject_id from publication p
@@ -41,4 +50,4 @@ def get_correspondence_metadata_for_publication(project, pub_id):
             'subjects': subjects
         }
     connection.close()
-    return jsonify(data), 200
+    return data
@@ -1,19 +1,28 @@
-from flask import Blueprint, jsonify, request, Response
-import io
+from datetime import datetime
+from flask import Blueprint, jsonify, request, Response, url_for
 import logging
 import os
+import re
 import sqlalchemy
-import subprocess
+import tarfile
+import uuid
+import zipfile
 from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
-from sls_api.endpoints.generics import ALLOWED_EXTENSIONS_FOR_FACSIMILE_UPLOAD, allowed_facsimile, db_engine, \
-    FACSIMILE_IMAGE_SIZES, FACSIMILE_UPLOAD_FOLDER, get_project_config, get_project_id_from_name, \
-    project_permission_required
+from sls_api.endpoints.generics import ALLOWED_EXTENSIONS_FOR_FACSIMILE_UPLOAD, allowed_facsimile, create_file_response, \
+    db_engine, facsimile_collection_cache, FACSIMILE_IMAGE_SIZES, FACSIMILE_UPLOAD_FOLDER, get_image_derivative, \
+    get_project_config, get_project_id_from_name, project_permission_required
+from sls_api.facsimile_images import find_iiif_tile, get_iiif_info, get_tile_path, get_tiles_folder, read_tile_pyramid
+from sls_api.exceptions import BulkUploadLimitError
+from sls_api.facsimile_jobs import create_facsimile_job, get_bulk_upload_limits, get_conversion_workers, get_public_job, \
+    read_job, run_facsimile_job, run_facsimile_jobs, submit_facsimile_job
 
 facsimiles = Blueprint('facsimiles', __name__)
 logger = logging.getLogger("sls_api.facsimiles")
 
+PAGE_NUMBER_PATTERN = re.compile(r"\d+")
+
 # Facsimile metadata and file functions
 
 
@@ -27,69 +36,75 @@ def get_facsimiles(project, publication_id, section_id=None):
         return jsonify({"msg": "No such project."}), 400
     else:
         logger.info("Getting facsimiles /{}/facsimiles/{}".format(project, publication_id))
+        return_data = get_publication_facsimiles(project, config, publication_id, section_id)
+        return jsonify(return_data), 200
 
-        connection = db_engine.connect()
 
-        sql = 'select *, f.id as publication_facsimile_id from publication_facsimile as f \
-        left join publication_facsimile_collection as fc on fc.id=f.publication_facsimile_collection_id \
-        left join publication p on p.id=f.publication_id \
-        where f.deleted != 1 and fc.deleted != 1 and f.publication_id=:p_id \
-        '
+def get_publication_facsimiles(project, config, publication_id, section_id=None):
+    """
+    Returns the facsimiles of a publication as a list of dictionaries, see get_facsimiles.
+    Also used by the publication bundle endpoint in text.py.
+    """
+    connection = db_engine.connect()
 
-        if config["show_internally_published"]:
-            sql = " ".join([sql, "and p.published>0"])
-        elif config["show_unpublished"]:
-            sql = " ".join([sql, "and p.published>2"])
+    sql = 'select *, f.id as publication_facsimile_id from publication_facsimile as f \
+    left join publication_facsimile_collection as fc on fc.id=f.publication_facsimile_collection_id \
+    left join publication p on p.id=f.publication_id \
+    where f.deleted != 1 and fc.deleted != 1 and f.publication_id=:p_id \
+    '
 
-        if section_id is not None:
-            sql = " ".join([sql, "and f.section_id = :section"])
+    if config["show_internally_published"]:
+        sql = " ".join([sql, "and p.published>0"])
+    elif config["show_unpublished"]:
+        sql = " ".join([sql, "and p.published>2"])
 
-        sql = " ".join([sql, "ORDER BY f.priority"])
+    if section_id is not None:
+        sql = " ".join([sql, "and f.section_id = :section"])
 
-        if '_' in publication_id:
-            pub_id = publication_id.split('_')[1]
-        else:
-            pub_id = publication_id
+    sql = " ".join([sql, "ORDER BY f.priority"])
 
-        if section_id is not None:
-            section_id = str(section_id).replace('ch', '')
-            statement = sqlalchemy.sql.text(sql).bindparams(p_id=pub_id, section=section_id)
-        else:
-            statement = sqlalchemy.sql.text(sql).bindparams(p_id=pub_id)
+    if '_' in str(publication_id):
+        pub_id = str(publication_id).split('_')[1]
+    else:
+        pub_id = publication_id
 
-        result = []
-        for row in connection.execute(statement).fetchall():
-            if row is not None:
-                facsimile = row._asdict()
-            else:
-                facsimile = {}
-            if row.folder_path != '' and row.folder_path is not None:
-                facsimile["start_url"] = row.folder_path
-            else:
-                facsimile["start_url"] = safe_join(
-                    "digitaledition",
-                    project,
-                    "facsimile",
-                    str(row.publication_facsimile_collection_id)
-                )
-            pre_pages = row.start_page_number or 0
-
-            facsimile["first_page"] = pre_pages + row.page_nr
-
-            sql2 = "SELECT * FROM publication_facsimile WHERE deleted != 1 AND publication_facsimile_collection_id=:fc_id AND page_nr>:page_nr ORDER BY page_nr ASC LIMIT 1"
-            statement2 = sqlalchemy.sql.text(sql2).bindparams(fc_id=row.publication_facsimile_collection_id,
-                                                              page_nr=row.page_nr)
-            for row2 in connection.execute(statement2).fetchall():
-                facsimile["last_page"] = pre_pages + row2.page_nr - 1
-
-            if "last_page" not in facsimile.keys():
-                facsimile["last_page"] = row.number_of_pages
-
-            result.append(facsimile)
-        connection.close()
+    if section_id is not None:
+        section_id = str(section_id).replace('ch', '')
+        statement = sqlalchemy.sql.text(sql).bindparams(p_id=pub_id, section=section_id)
+    else:
+        statement = sqlalchemy.sql.text(sql).bindparams(p_id=pub_id)
 
-        return_data = result
-        return jsonify(return_data), 200
+    result = []
+    for row in connection.execute(statement).fetchall():
+        if row is not None:
+            facsimile = row._asdict()
+        else:
+            facsimile = {}
+        if row.folder_path != '' and row.folder_path is not None:
+            facsimile["start_url"] = row.folder_path
+        else:
+            facsimile["start_url"] = safe_join(
+                "digitaledition",
+                project,
+                "facsimile",
+                str(row.publication_facsimile_collection_id)
+            )
+        pre_pages = row.start_page_number or 0
+
+        facsimile["first_page"] = pre_pages + row.page_nr
+
+        sql2 = "SELECT * FROM publication_facsimile WHERE deleted != 1 AND publication_facsimile_collection_id=:fc_id AND page_nr>:page_nr ORDER BY page_nr ASC LIMIT 1"
+        statement2 = sqlalchemy.sql.text(sql2).bindparams(fc_id=row.publication_facsimile_collection_id,
+                                                          page_nr=row.page_nr)
+        for row2 in connection.execute(statement2).fetchall():
+            facsimile["last_page"] = pre_pages + row2.page_nr - 1
+
+        if "last_page" not in facsimile.keys():
+            facsimile["last_page"] = row.number_of_pages
+
+        result.append(facsimile)
+    connection.close()
+    return result
 
 
 @facsimiles.route("/<project>/publication-facsimile-relations/")
@@ -126,30 +141,21 @@ def get_facsimile_collections(project, facsimile_collection_ids):
     return jsonify(return_data), 200
 
 
-def convert_resize_uploaded_facsimile(uploaded_file_path, collection_folder_path, page_number):
+def get_upload_collection_folder(config, collection_id):
     """
-    Given an uploaded file, a destination folder for the facsimile collection, and a page number - create a .jpg file for each zoom level for the page
-    Files are stored as <collection_folder_path>/<zoom_level>/<page_number>.jpg
-    Where zoom_level is determined by FACSIMILE_IMAGE_SIZES in generics.py (1-4)
-
-    Returns True if all conversions succeeded, otherwise returns False.
+    Returns the folder facsimiles uploaded to the facsimile collection 'collection_id' are stored in, the folder path
+    of the collection in the database if set, otherwise in the project file root. Returns None if there's no such collection.
     """
-    successful_conversions = []
-    for zoom_level, resolution in FACSIMILE_IMAGE_SIZES.items():
-        os.makedirs(safe_join(collection_folder_path, str(zoom_level)), exist_ok=True)
-        convert_cmd = ["convert", "-resize", resolution, "-quality", "77", "-colorspace", "sRGB",
-                       uploaded_file_path, safe_join(collection_folder_path, str(zoom_level), f"{page_number}.jpg")]
-        try:
-            subprocess.run(convert_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError as ex:
-            logger.exception("Failed to convert uploaded facsimile!")
-            logger.error(ex.stdout)
-            logger.error(ex.stderr)
-        else:
-            successful_conversions.append(str(zoom_level))
-    # remove uploaded source file once conversions are complete
-    os.remove(uploaded_file_path)
-    return len(successful_conversions) == len(FACSIMILE_IMAGE_SIZES.keys())
+    connection = db_engine.connect()
+    collection_check_statement = sqlalchemy.sql.text("SELECT * FROM publication_facsimile_collection WHERE deleted != 1 AND id=:coll_id").bindparams(coll_id=collection_id)
+    row = connection.execute(collection_check_statement).fetchone()
+    connection.close()
+    if row is None:
+        return None
+    elif row.folder_path != '' and row.folder_path is not None:
+        return safe_join(row.folder_path, str(collection_id))
+    else:
+        return safe_join(config["file_root"], "facsimiles", str(collection_id))
 
 
 @project_permission_required
@@ -164,10 +170,16 @@ def upload_facsimile_file(project, collection_id, page_number):
 
     ---
     First and foremost, only accept images. Reject with 400 anything that allowed_facsimile() doesn't accept.
-    Then, attempt to convert image to 4 different "zoom levels" of .jpg with imagemagick
+    Then, queue a job to convert image to 4 different "zoom levels" of .jpg with Pillow, or imagemagick if
+    'facsimile_resize_engine' is set to 'imagemagick' for the project or Pillow can't read the image.
+    Responds with 202 and the id of the job, the progress of which is available from get_facsimile_job.
+    If 'facsimile_conversion_workers' is 0, the image is converted before responding instead.
 
     Lastly, store the images in root/facsimiles/<collection_id>/<zoom_level>/<page_number>.jpg
     Where zoom_level is determined by FACSIMILE_IMAGE_SIZES in generics.py (1-4)
+
+    If 'facsimile_tiles' is set for the project, tiles for deep zoom are also generated from the uploaded image
+    and stored in root/facsimiles/<collection_id>/tiles/<page_number>/ (see get_facsimile_iiif_info)
     """
     # TODO OpenStack Swift support for ISILON file storage - config param for root 'facsimiles' path
     # ensure temporary facsimile upload folder exists
@@ -179,19 +191,11 @@ def upload_facsimile_file(project, collection_id, page_number):
         return jsonify({"msg": "Request.files is none!"}), 400
     if "facsimile" not in request.files:
         return jsonify({"msg": "No file provided in request (facsimile)!"}), 400
-    # get a folder path for the facsimile collection from the database if set, otherwise use project file root
-    connection = db_engine.connect()
-    collection_check_statement = sqlalchemy.sql.text("SELECT * FROM publication_facsimile_collection WHERE deleted != 1 AND id=:coll_id").bindparams(coll_id=collection_id)
-    row = connection.execute(collection_check_statement).fetchone()
-    if row is None:
+    collection_folder_path = get_upload_collection_folder(config, collection_id)
+    if collection_folder_path is None:
         return jsonify({
             "msg": "Desired facsimile collection was not found in database!"
         }), 404
-    elif row.folder_path != '' and row.folder_path is not None:
-        collection_folder_path = safe_join(row.folder_path, collection_id)
-    else:
-        collection_folder_path = safe_join(config["file_root"], "facsimiles", collection_id)
-    connection.close()
 
     # handle received file
     uploaded_file = request.files["facsimile"]
@@ -200,93 +204,370 @@ def upload_facsimile_file(project, collection_id, page_number):
         return jsonify({"msg": "No file provided in uploaded_file.filename!"}), 400
 
     if uploaded_file and allowed_facsimile(uploaded_file.filename):
-        # handle potentially malicious filename and save file to temp folder
-        temp_path = os.path.join(FACSIMILE_UPLOAD_FOLDER, secure_filename(uploaded_file.filename))
+        # handle potentially malicious filename and save file to temp folder, under a unique name as several
+        # uploads of files with the same name may be waiting for conversion
+        temp_path = os.path.join(FACSIMILE_UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{secure_filename(uploaded_file.filename)}")
         uploaded_file.save(temp_path)
 
-        # resize file using imagemagick
-        resize = convert_resize_uploaded_facsimile(temp_path, collection_folder_path, page_number)
+        job = create_facsimile_job(project, collection_id, page_number, temp_path, collection_folder_path)
+        if get_conversion_workers() > 0:
+            submit_facsimile_job(job["id"])
+            return jsonify({
+                "msg": "Facsimile conversion queued.",
+                "job_id": job["id"],
+                "status_url": url_for("facsimiles.get_facsimile_job", project=project, job_id=job["id"])
+            }), 202
 
-        if resize:
+        job = run_facsimile_job(job["id"])
+        if job["status"] == "done":
             return jsonify({"msg": "OK"})
         else:
-            return jsonify({"msg": "Failed to resize uploaded facsimile!"}), 500
+            return jsonify({"msg": job["error"]}), 500
     else:
         return jsonify({"msg": f"Invalid facsimile provided. Allowed filetypes are {ALLOWED_EXTENSIONS_FOR_FACSIMILE_UPLOAD}. TIFF files are preferred."}), 400
 
 
-@facsimiles.route("/<project>/facsimiles/<collection_id>/<number>/<zoom_level>")
-def get_facsimile_file(project, collection_id, number, zoom_level):
+def get_page_number_from_filename(filename):
     """
-    Retrieve a single facsimile image file from project root
+    Returns the page number of a facsimile file in a bulk upload, the last number in its name
+    (e.g. 12 for 'vol1_0012.tif'), or None if there's no number in the name
+    """
+    numbers = PAGE_NUMBER_PATTERN.findall(os.path.splitext(os.path.basename(filename))[0])
+    return int(numbers[-1]) if numbers else None
 
-    Facsimile files are stored as follows: root/facsimiles/<collection_id>/<zoom_level>/<page_number>.jpg
-    The collection_id these are sorted by is the publication_facsimile_collection id, stored as publication_id in the old database structure?
 
-    However, the first page of a publication is not necessarily 1.jpg, as facsimiles often contain title pages and blank pages
-    Thus, calling for facsimiles/1/1/1 may require fetching a file from root/facsimiles/1/1/5.jpg
+def get_bulk_upload_entry(filename):
     """
-    # TODO OpenStack Swift support for ISILON file storage - config param for root 'facsimiles' path
+    Returns the report entry of a file in a bulk upload, with 'status' 'skipped' and the reason in 'error'
+    if the file isn't a facsimile, otherwise with the page number of the file and 'status' None
+    """
+    entry = {"filename": filename, "page_number": get_page_number_from_filename(filename), "status": None, "error": None}
+    basename = os.path.basename(filename)
+    if basename.startswith(".") or "__MACOSX/" in filename:
+        entry.update(status="skipped", error="Hidden file.")
+    elif not allowed_facsimile(basename):
+        entry.update(status="skipped", error=f"Not a facsimile file, allowed filetypes are {ALLOWED_EXTENSIONS_FOR_FACSIMILE_UPLOAD}.")
+    elif entry["page_number"] is None:
+        entry.update(status="skipped", error="No page number in filename.")
+    return entry
+
+
+def extract_bulk_upload_archive(archive_path, extract_folder, max_bytes, max_files):
+    """
+    Extracts the facsimile files in the zip or tar archive 'archive_path' into 'extract_folder'. Each file is
+    extracted under a unique name ending in _<page_number>.<extension>, never using the paths in the archive, so files
+    can't be written outside 'extract_folder' whatever their names in the archive are. Links and other special files
+    are skipped.
+
+    Returns a list of report entries (see get_bulk_upload_entry) with the extracted file in 'source_path',
+    or None if the file isn't a zip or tar archive. Raises BulkUploadLimitError if the archive has more than
+    'max_files' files, or the extracted files add up to more than 'max_bytes' bytes (whatever sizes the archive
+    claims they have). The files already extracted are removed if extracting fails.
+    """
+    entries = []
+    extracted_bytes = 0
+
+    def add_entry(entry):
+        if len(entries) >= max_files:
+            raise BulkUploadLimitError(f"The archive has more than {max_files} files.")
+        entries.append(entry)
+
+    def extract(filename, open_member):
+        nonlocal extracted_bytes
+        entry = get_bulk_upload_entry(filename)
+        add_entry(entry)
+        if entry["status"] is None:
+            extension = filename.rsplit(".", 1)[1].lower()
+            entry["source_path"] = os.path.join(extract_folder, f"{uuid.uuid4().hex}_{entry['page_number']}.{extension}")
+            with open_member() as member_file, open(entry["source_path"], "wb") as extracted_file:
+                while True:
+                    chunk = member_file.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    extracted_bytes += len(chunk)
+                    if extracted_bytes > max_bytes:
+                        raise BulkUploadLimitError(f"The files in the archive add up to more than {max_bytes} bytes.")
+                    extracted_file.write(chunk)
+
+    try:
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                for member in archive.infolist():
+                    if not member.is_dir():
+                        extract(member.filename, lambda: archive.open(member))
+        elif tarfile.is_tarfile(archive_path):
+            with tarfile.open(archive_path) as archive:
+                for member in archive:
+                    if member.isfile():
+                        extract(member.name, lambda: archive.extractfile(member))
+                    elif not member.isdir():
+                        entry = get_bulk_upload_entry(member.name)
+                        entry.update(status="skipped", error="Not a regular file.")
+                        add_entry(entry)
+        else:
+            return None
+    except BaseException:
+        remove_bulk_upload_files(entries)
+        raise
+    return entries
+
+
+def remove_bulk_upload_files(entries):
+    """
+    Removes the files extracted for the report entries 'entries' (see extract_bulk_upload_archive)
+    """
+    for entry in entries:
+        if "source_path" in entry:
+            try:
+                os.remove(entry["source_path"])
+            except OSError:
+                pass
+
+
+def update_collection_number_of_pages(collection_id, collection_folder_path, page_numbers=()):
+    """
+    Sets 'number_of_pages' of the facsimile collection 'collection_id' to the number of pages in its folder, those of
+    the smallest zoom level, so pages uploaded earlier are counted as well, together with 'page_numbers', the pages
+    still being converted. Returns the number of pages.
+    """
+    level_folder = safe_join(collection_folder_path, "1")
+    pages = set(int(page_number) for page_number in page_numbers)
+    if os.path.isdir(level_folder):
+        pages.update(int(filename[:-len(".jpg")]) for filename in os.listdir(level_folder)
+                     if filename.endswith(".jpg") and filename[:-len(".jpg")].isdigit())
+    connection = db_engine.connect()
+    with connection.begin():
+        update_statement = sqlalchemy.sql.text("UPDATE publication_facsimile_collection SET number_of_pages=:pages, date_modified=:modified "
+                                               "WHERE id=:coll_id").bindparams(pages=len(pages), modified=datetime.now(), coll_id=collection_id)
+        connection.execute(update_statement)
+    connection.close()
+    return len(pages)
+
+
+@facsimiles.route("/<project>/facsimiles/<collection_id>/bulk", methods=["PUT", "POST"])
+@project_permission_required
+def bulk_upload_facsimile_files(project, collection_id):
+    """
+    Upload all the pages of a facsimile collection at once.
+
+    The pages are given either as a zip or tar archive (optionally compressed) in a form parameter named 'archive'
+    (for example, curl -F 'archive=@path/to/pages.zip' https://api.sls.fi/digitaledition/<project>/facsimiles/<collection_id>/bulk),
+    or as the path of a directory inside the project file root in a form or JSON parameter named 'directory',
+    for pages already copied to the server. The files in a directory are left as they are. An archive may be at most
+    'facsimile_bulk_upload_max_bytes' bytes, as may the files extracted from it, and an archive or directory may have
+    at most 'facsimile_bulk_upload_max_files' files.
+
+    The page number of each file is the last number in its filename, e.g. 12 for 'vol1_0012.tif'. Files without
+    a number, of types other than those allowed for single facsimiles, or with the same page number as another file
+    are skipped. Each page is queued as a conversion job, as by upload_facsimile_file, and 'number_of_pages' of the
+    collection is set to the number of pages in the collection folder together with the queued pages.
+    Responds with 202 and a report of each file: its page number, 'status' ('queued' or 'skipped'), 'error', and the
+    'job_id' and 'status_url' of its conversion job (see get_facsimile_job).
+
+    If 'facsimile_conversion_workers' is 0, the pages are converted before responding instead, on a pool of
+    'facsimile_bulk_conversion_workers' processes (by default one per CPU), with 'status' 'done' or 'failed'.
+    """
+    os.makedirs(FACSIMILE_UPLOAD_FOLDER, exist_ok=True)
     config = get_project_config(project)
     if config is None:
         return jsonify({"msg": "No such project."}), 400
+    collection_folder_path = get_upload_collection_folder(config, collection_id)
+    if collection_folder_path is None:
+        return jsonify({
+            "msg": "Desired facsimile collection was not found in database!"
+        }), 404
+
+    max_bytes, max_files = get_bulk_upload_limits()
+    # checked before request.files, which reads the whole request
+    if request.content_length is not None and request.content_length > max_bytes:
+        return jsonify({"msg": f"The uploaded archive is larger than {max_bytes} bytes."}), 413
+    request_data = request.get_json(silent=True) or {}
+    directory = request.form.get("directory", request_data.get("directory"))
+    from_archive = "archive" in request.files and request.files["archive"].filename != ""
+    if from_archive:
+        archive_path = os.path.join(FACSIMILE_UPLOAD_FOLDER, f"{uuid.uuid4().hex}_bulk_archive")
+        try:
+            request.files["archive"].save(archive_path)
+            if os.path.getsize(archive_path) > max_bytes:
+                return jsonify({"msg": f"The uploaded archive is larger than {max_bytes} bytes."}), 413
+            entries = extract_bulk_upload_archive(archive_path, FACSIMILE_UPLOAD_FOLDER, max_bytes, max_files)
+        except BulkUploadLimitError as e:
+            return jsonify({"msg": e.message}), 413
+        except (OSError, tarfile.TarError, zipfile.BadZipFile, EOFError):
+            logger.exception("Failed to extract facsimile archive!")
+            return jsonify({"msg": "Failed to extract the uploaded archive!"}), 400
+        finally:
+            try:
+                os.remove(archive_path)
+            except OSError:
+                pass
+        if entries is None:
+            return jsonify({"msg": "The uploaded archive is not a zip or tar file."}), 400
+    elif directory:
+        directory_path = safe_join(config["file_root"], str(directory))
+        file_root = os.path.realpath(config["file_root"])
+        if directory_path is None or not os.path.realpath(directory_path).startswith(file_root + os.sep) \
+                or not os.path.isdir(directory_path):
+            return jsonify({"msg": "No such directory in the project files."}), 400
+        entries = []
+        for dir_entry in sorted(os.scandir(directory_path), key=lambda dir_entry: dir_entry.name):
+            if dir_entry.is_file(follow_symlinks=False):
+                if len(entries) >= max_files:
+                    return jsonify({"msg": f"The directory has more than {max_files} files."}), 400
+                entry = get_bulk_upload_entry(dir_entry.name)
+                entry["source_path"] = dir_entry.path
+                entries.append(entry)
     else:
-        connection = db_engine.connect()
+        return jsonify({"msg": "No archive or directory provided in request (archive, directory)!"}), 400
+
+    # one file per page, files with a page number that's already taken are skipped
+    pages = {}
+    for entry in entries:
+        if entry["status"] is None:
+            if entry["page_number"] in pages:
+                entry.update(status="skipped", error=f"Page number {entry['page_number']} is already used by {pages[entry['page_number']]['filename']}.")
+            else:
+                pages[entry["page_number"]] = entry
+    if from_archive:
+        # extracted files of pages are removed by their conversion jobs, the rest aren't needed
+        remove_bulk_upload_files([entry for entry in entries if entry["status"] is not None])
+    if not pages:
+        return jsonify({"msg": "No facsimile files with page numbers found.", "pages": strip_bulk_upload_entries(entries)}), 400
+
+    for entry in pages.values():
+        job = create_facsimile_job(project, collection_id, str(entry["page_number"]), entry["source_path"],
+                                   collection_folder_path, remove_source=from_archive)
+        entry["job_id"] = job["id"]
+        entry["status_url"] = url_for("facsimiles.get_facsimile_job", project=project, job_id=job["id"])
+
+    if get_conversion_workers() > 0:
+        logger.info(f"Queueing {len(pages)} facsimile pages for collection {collection_id} in {project}...")
+        for entry in pages.values():
+            submit_facsimile_job(entry["job_id"])
+            entry["status"] = "queued"
+        number_of_pages = update_collection_number_of_pages(collection_id, collection_folder_path, pages.keys())
+        return jsonify({
+            "msg": f"{len(pages)} pages queued for conversion, {len(entries) - len(pages)} skipped.",
+            "number_of_pages": number_of_pages,
+            "pages": strip_bulk_upload_entries(entries)
+        }), 202
+
+    logger.info(f"Converting {len(pages)} facsimile pages for collection {collection_id} in {project}...")
+    results = run_facsimile_jobs([entry["job_id"] for entry in pages.values()])
+    for entry in pages.values():
+        job = results[entry["job_id"]]
+        entry.update(status="done" if job["status"] == "done" else "failed", error=job["error"])
+    number_of_pages = update_collection_number_of_pages(collection_id, collection_folder_path)
+
+    statuses = [entry["status"] for entry in entries]
+    return jsonify({
+        "msg": f"{statuses.count('done')} pages converted, {statuses.count('failed')} failed, {statuses.count('skipped')} skipped.",
+        "number_of_pages": number_of_pages,
+        "pages": strip_bulk_upload_entries(entries)
+    }), 200
+
+
+def strip_bulk_upload_entries(entries):
+    return [{field: entry.get(field) for field in ["filename", "page_number", "status", "error", "job_id", "status_url"]}
+            for entry in entries]
+
+
+@facsimiles.route("/<project>/facsimiles/jobs/<job_id>")
+@project_permission_required
+def get_facsimile_job(project, job_id):
+    """
+    Returns the status of a facsimile conversion job queued by upload_facsimile_file:
+    'status' is 'queued', 'running', 'done' or 'failed', 'levels' the status of each zoom level ('pending', 'done'
+    or 'failed'), 'tiles' the status of the tiles (null if the project doesn't have tiles), and 'timings' the time
+    in seconds spent on each step.
+    """
+    job = read_job(job_id)
+    if job is None or job["project"] != project:
+        return jsonify({"msg": "No such facsimile conversion job."}), 404
+    response = jsonify(get_public_job(job))
+    response.headers["Cache-Control"] = "no-store"
+    return response, 200
+
+
+def get_facsimile_collection_location(config, collection_id):
+    """
+    Returns a tuple of the published status of the publication the facsimile collection 'collection_id' belongs to
+    (None if there's no such publication or the status is invalid) and the folder the files of the collection are in
+    (None if there's no such collection). Cached by get_facsimile_file, see FacsimileCollectionCache.
+    """
+    connection = db_engine.connect()
+    try:
         check_statement = sqlalchemy.sql.text("SELECT published FROM publication WHERE deleted != 1 AND id = "
                                               "(SELECT publication_id FROM publication_facsimile WHERE deleted != 1 AND publication_facsimile_collection_id=:coll_id LIMIT 1)").bindparams(
             coll_id=collection_id)
         row = connection.execute(check_statement).fetchone()
         if row is None:
-            return jsonify({
-                "msg": "Desired facsimile file not found in database."
-            }), 404
-        else:
-            try:
-                status = int(row[0])
-            except ValueError:
-                logger.exception(f"Couldn't convert {row[0]} to integer.")
-                return jsonify({
-                    "msg": "Desired facsimile file not found in database."
-                }), 404
-            except Exception:
-                logger.exception(f"Unknown exception handling {row} during facsimile file fetch.")
-                return jsonify({
-                    "msg": "Desired facsimile file not found in database."
-                }), 404
-            if status == 0:
-                return jsonify({
-                    "msg": "Desired facsimile file not found in database."
-                }), 404
-            elif status == 1:
-                if not config["show_internally_published"]:
-                    return jsonify({
-                        "msg": "Desired facsimile file not found in database."
-                    }), 404
+            return None, None
+        try:
+            status = int(row[0])
+        except ValueError:
+            logger.exception(f"Couldn't convert {row[0]} to integer.")
+            return None, None
+        except Exception:
+            logger.exception(f"Unknown exception handling {row} during facsimile file fetch.")
+            return None, None
 
         statement = sqlalchemy.sql.text("SELECT * FROM publication_facsimile_collection WHERE deleted != 1 AND id=:coll_id").bindparams(
             coll_id=collection_id)
         row = connection.execute(statement).fetchone()
         if row is None:
-            return jsonify({
-                "msg": "Desired facsimile collection was not found in database!"
-            }), 404
+            return status, None
         elif row.folder_path != '' and row.folder_path is not None:
-            file_path = safe_join(row.folder_path, collection_id, zoom_level, "{}.jpg".format(int(number)))
+            return status, row.folder_path
         else:
-            file_path = safe_join(config["file_root"],
-                                  "facsimiles",
-                                  collection_id,
-                                  zoom_level,
-                                  "{}.jpg".format(int(number)))
+            return status, safe_join(config["file_root"], "facsimiles")
+    finally:
         connection.close()
 
-        output = io.BytesIO()
+
+def get_visible_facsimile_folder(project, config, collection_id):
+    """
+    Returns a tuple of the folder the files of the facsimile collection 'collection_id' are in and None, or None and
+    an error response if the collection doesn't exist or its publication may not be shown
+    """
+    status, base_folder = facsimile_collection_cache.get(
+        (project, str(collection_id)),
+        lambda: get_facsimile_collection_location(config, collection_id)
+    )
+    if status is None or status == 0 or (status == 1 and not config["show_internally_published"]):
+        return None, (jsonify({
+            "msg": "Desired facsimile file not found in database."
+        }), 404)
+    elif base_folder is None:
+        return None, (jsonify({
+            "msg": "Desired facsimile collection was not found in database!"
+        }), 404)
+    return base_folder, None
+
+
+@facsimiles.route("/<project>/facsimiles/<collection_id>/<number>/<zoom_level>")
+def get_facsimile_file(project, collection_id, number, zoom_level):
+    """
+    Retrieve a single facsimile image file from project root
+
+    Facsimile files are stored as follows: root/facsimiles/<collection_id>/<zoom_level>/<page_number>.jpg
+    The collection_id these are sorted by is the publication_facsimile_collection id, stored as publication_id in the old database structure?
+
+    However, the first page of a publication is not necessarily 1.jpg, as facsimiles often contain title pages and blank pages
+    Thus, calling for facsimiles/1/1/1 may require fetching a file from root/facsimiles/1/1/5.jpg
+    """
+    # TODO OpenStack Swift support for ISILON file storage - config param for root 'facsimiles' path
+    config = get_project_config(project)
+    if config is None:
+        return jsonify({"msg": "No such project."}), 400
+    else:
+        base_folder, error_response = get_visible_facsimile_folder(project, config, collection_id)
+        if error_response is not None:
+            return error_response
+        file_path = safe_join(base_folder, collection_id, zoom_level, "{}.jpg".format(int(number)))
+
         try:
-            with open(file_path, mode="rb") as img_file:
-                output.write(img_file.read())
-            content = output.getvalue()
-            output.close()
-            return Response(content, status=200, content_type="image/jpeg")
+            return create_file_response(file_path, "image/jpeg")
         except Exception:
             logger.exception(f"Exception reading facsimile at {file_path}")
             return jsonify({
@@ -294,6 +575,101 @@ def get_facsimile_file(project, collection_id, number, zoom_level):
             }), 404
 
 
+@facsimiles.route("/<project>/facsimiles/<collection_id>/<number>/width/<width>")
+def get_facsimile_derivative(project, collection_id, number, width):
+    """
+    Retrieve a facsimile image 'width' pixels wide, for clients needing other sizes than those of the zoom levels
+    (e.g. thumbnails). 'width' is snapped to one of the widths allowed by 'derivative_widths' in the config.
+
+    The image is scaled down from the smallest zoom level at least as wide and cached, see get_image_derivative.
+    """
+    config = get_project_config(project)
+    if config is None:
+        return jsonify({"msg": "No such project."}), 400
+    try:
+        number = int(number)
+        width = int(width)
+    except ValueError:
+        return jsonify({"msg": "Page number and width must be integers."}), 400
+    if width < 1:
+        return jsonify({"msg": "Width must be a positive integer."}), 400
+    base_folder, error_response = get_visible_facsimile_folder(project, config, collection_id)
+    if error_response is not None:
+        return error_response
+    source_paths = [safe_join(base_folder, collection_id, str(zoom_level), f"{number}.jpg") for zoom_level in FACSIMILE_IMAGE_SIZES]
+    try:
+        file_path = get_image_derivative(project, "facsimiles", source_paths, width)
+        return create_file_response(file_path, "image/jpeg")
+    except Exception:
+        logger.exception(f"Exception creating facsimile derivative of {collection_id}/{number}")
+        return jsonify({
+            "msg": "Desired facsimile file not found."
+        }), 404
+
+
+@facsimiles.route("/<project>/facsimiles/iiif/<collection_id>/<page_number>/info.json")
+def get_facsimile_iiif_info(project, collection_id, page_number):
+    """
+    Get IIIF Image API 3.0 (level 0) information for the tiles of a facsimile page, for deep zoom viewers
+    such as OpenSeadragon, which then fetch only the tiles they show from get_facsimile_tile.
+
+    Tiles are generated when facsimiles are uploaded, if 'facsimile_tiles' is set for the project,
+    or with sls_api/scripts/generate_facsimile_tiles.py. Pages without tiles return 404.
+    """
+    config = get_project_config(project)
+    if config is None:
+        return jsonify({"msg": "No such project."}), 400
+    base_folder, error_response = get_visible_facsimile_folder(project, config, collection_id)
+    if error_response is not None:
+        return error_response
+    try:
+        tiles_folder = get_tiles_folder(safe_join(base_folder, collection_id), page_number)
+    except (TypeError, ValueError):
+        return jsonify({"msg": "Invalid facsimile page."}), 400
+    pyramid = read_tile_pyramid(tiles_folder)
+    if pyramid is None:
+        return jsonify({"msg": "Desired facsimile page has no tiles."}), 404
+    image_id = request.base_url[:-len("/info.json")]
+    response = jsonify(get_iiif_info(pyramid, image_id))
+    response.headers["Content-Type"] = 'application/ld+json;profile="http://iiif.io/api/image/3/context.json"'
+    return response
+
+
+@facsimiles.route("/<project>/facsimiles/iiif/<collection_id>/<page_number>/<region>/<size>/<rotation>/<quality>.<image_format>")
+def get_facsimile_tile(project, collection_id, page_number, region, size, rotation, quality, image_format):
+    """
+    Get a tile of a facsimile page, following IIIF Image API region and size semantics (level 0),
+    see get_facsimile_iiif_info. Only the regions and sizes of the tiles listed there are available,
+    with rotation 0, quality 'default' (or 'color') and format 'jpg'.
+    """
+    config = get_project_config(project)
+    if config is None:
+        return jsonify({"msg": "No such project."}), 400
+    if rotation != "0" or quality not in ("default", "color") or image_format != "jpg":
+        return jsonify({"msg": "Only rotation 0, quality 'default' and format 'jpg' are supported."}), 400
+    base_folder, error_response = get_visible_facsimile_folder(project, config, collection_id)
+    if error_response is not None:
+        return error_response
+    try:
+        tiles_folder = get_tiles_folder(safe_join(base_folder, collection_id), page_number)
+    except (TypeError, ValueError):
+        return jsonify({"msg": "Invalid facsimile page."}), 400
+    pyramid = read_tile_pyramid(tiles_folder)
+    if pyramid is None:
+        return jsonify({"msg": "Desired facsimile page has no tiles."}), 404
+    tile = find_iiif_tile(pyramid, region, size)
+    if tile is None:
+        return jsonify({"msg": "No tile with the requested region and size."}), 400
+    tile_path = get_tile_path(tiles_folder, *tile)
+    try:
+        return create_file_response(tile_path, "image/jpeg")
+    except Exception:
+        logger.exception(f"Exception reading facsimile tile at {tile_path}")
+        return jsonify({
+            "msg": "Desired facsimile tile not found."
+        }), 404
+
+
 @facsimiles.route("/<project>/facsimile/page/<col_pub>/")
 @facsimiles.route("/<project>/facsimiles/page/<col_pub>/<section_id>")
 def get_facsimile_pages(project, col_pub, section_id=None):
@@ -347,13 +723,8 @@ def get_facsimile_page_image(project, facsimile_type, facs_id, facs_nr):
             # TODO placeholder page image file?
             file_path = ""
 
-        output = io.BytesIO()
         try:
-            with open(file_path, mode="rb") as img_file:
-                output.write(img_file.read())
-            content = output.getvalue()
-            output.close()
-            return Response(content, status=200, content_type="image/jpeg")
+            return create_file_response(file_path, "image/jpeg")
         except Exception:
             logger.exception(f"Failed to read facsimile page from {file_path}")
             return Response("File not found: " + file_path, status=404, content_type="text/json")
@@ -1,22 +1,39 @@
 import calendar
 from collections import OrderedDict
-from datetime import datetime
-from flask import jsonify, Response
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timezone
+import fcntl
+from flask import current_app, g as request_globals, has_request_context, jsonify, request, Response, send_file
 from flask_jwt_extended import get_jwt, get_jwt_identity, verify_jwt_in_request
-from functools import wraps
+from functools import lru_cache, wraps
+from html.parser import HTMLParser
 import glob
+import gzip
 import hashlib
 import io
+import json
 import logging
 from lxml import etree
 import os
 import re
 from ruamel.yaml import YAML
+from PIL import Image
+from saxonche import PySaxonProcessor
+from sls_api.cache_backends import create_cache_backend
+from sls_api.facsimile_images import create_image_derivative, FACSIMILE_JPEG_QUALITY
 from sls_api.models import User
+from sls_api.scripts.saxon_xml_document import SaxonXMLDocument
 from sqlalchemy import create_engine, Connection, MetaData, Table
 from sqlalchemy.sql import select, text
+import stat
+import sys
+import tempfile
+import threading
 import time
 from typing import Any, Dict, List, Optional, Tuple
+import unicodedata
+from urllib.parse import quote, unquote, urljoin, urlparse
+from werkzeug.http import is_resource_modified
 from werkzeug.security import safe_join
 
 ALLOWED_EXTENSIONS_FOR_FACSIMILE_UPLOAD = ["tif", "tiff", "png", "jpg", "jpeg"]
@@ -25,7 +42,7 @@ ALLOWED_EXTENSIONS_FOR_FACSIMILE_UPLOAD = ["tif", "tiff", "png", "jpg", "jpeg"]
 FACSIMILE_UPLOAD_FOLDER = "/tmp/uploads"
 
 # these are the max resolutions for each zoom level of facsimile, used for resizing uploaded TIF files.
-# imagemagick retains aspect ratio by default, so resizing a 730x1200 image to "600x600" would result in a 365x600 file
+# aspect ratio is retained as by imagemagick (see get_fit_size), so resizing a 730x1200 image to "600x600" would result in a 365x600 file
 FACSIMILE_IMAGE_SIZES = {
     1: "600x600",
     2: "1200x1200",
@@ -37,6 +54,13 @@ metadata = MetaData()
 
 logger = logging.getLogger("sls_api.generics")
 
+try:
+    # brotli is optional, if it isn't installed cached text responses are only compressed with gzip
+    import brotli
+except ImportError:
+    brotli = None
+    logger.info("brotli not installed, text responses will only be compressed with gzip")
+
 config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs")
 with io.open(os.path.join(config_dir, "digital_editions.yml"), encoding="UTF-8") as config:
     yaml = YAML(typ="safe")
@@ -237,23 +261,333 @@ def split_after(value, a):
     return value[adjusted_pos_a:]
 
 
-def cache_is_recent(source_file, xsl_file, cache_file):
+def cache_is_recent(created_timestamp):
     """
-    Returns False if the source or xsl file have been modified since the creation of the cache file
-    Returns False if the cache is more than 'cache_lifetime_seconds' seconds old, as defined in config file
+    Returns False if 'created_timestamp' is more than 'cache_lifetime_seconds' seconds ago, as defined in config file
     Otherwise, returns True
+
+    Changes to source XML files, XSL stylesheets or transform parameters don't need to be checked here,
+    as they result in a different cache key for the content (see get_content_cache_key)
     """
-    try:
-        source_file_mtime = os.path.getmtime(source_file)
-        xsl_file_mtime = os.path.getmtime(xsl_file)
-        cache_file_mtime = os.path.getmtime(cache_file)
-    except OSError:
-        return False
-    if source_file_mtime > cache_file_mtime or xsl_file_mtime > cache_file_mtime:
-        return False
-    elif calendar.timegm(time.gmtime()) > (cache_file_mtime + config["cache_lifetime_seconds"]):
-        return False
-    return True
+    return calendar.timegm(time.gmtime()) <= (created_timestamp + config["cache_lifetime_seconds"])
+
+
+def get_content_cache_key(xml_file_path, xsl_file_path, parameters, engine="lxml"):
+    """
+    Returns a cache key for the result of transforming 'xml_file_path' with 'xsl_file_path' using 'parameters'
+    and the XSLT engine 'engine' (see get_xslt_engine).
+
+    The key is a hash of the path, modification time and size of the XML file, the path and modification time
+    of the stylesheet and every file it imports or includes, and every transform parameter. Parameters that are
+    file:// URLs (such as 'estDocument') also contribute the modification time and size of the file they point to.
+    Any change to the inputs of a transformation thus results in a new key, while unrelated entries keep theirs.
+    """
+    return get_content_version(xml_file_path, xsl_file_path, parameters, engine)[0]
+
+
+def get_content_version(xml_file_path, xsl_file_path, parameters, engine="lxml"):
+    """
+    Returns a tuple of the content cache key (see get_content_cache_key) and the latest modification time of the
+    inputs (see get_content_last_modified) of transforming 'xml_file_path' with 'xsl_file_path' using 'parameters',
+    looking up each input file only once
+    """
+    cache_key = hashlib.sha256()
+    xml_file_stat = os.stat(xml_file_path)
+    last_modified = xml_file_stat.st_mtime
+    cache_key.update("xml={}|{}|{}\n".format(os.path.abspath(xml_file_path),
+                                             xml_file_stat.st_mtime_ns,
+                                             xml_file_stat.st_size).encode("utf-8"))
+    if engine != "lxml":
+        cache_key.update("engine={}\n".format(engine).encode("utf-8"))
+    for path, mtime in sorted(XSLT_ENGINES[engine].get_dependencies(xsl_file_path).items()):
+        cache_key.update("xsl={}|{}\n".format(path, mtime).encode("utf-8"))
+        last_modified = max(last_modified, mtime)
+    if parameters is not None:
+        for name, value in sorted(parameters.items()):
+            cache_key.update("param={}={}\n".format(name, value).encode("utf-8"))
+            value = str(value).strip("\"'")
+            if value.startswith("file://"):
+                try:
+                    param_file_stat = os.stat(url_to_local_path(value))
+                except OSError:
+                    continue
+                cache_key.update("file={}|{}\n".format(param_file_stat.st_mtime_ns,
+                                                       param_file_stat.st_size).encode("utf-8"))
+                last_modified = max(last_modified, param_file_stat.st_mtime)
+    return cache_key.hexdigest(), last_modified
+
+
+def get_memory_cache_key(xml_file_path, xsl_file_path, parameters):
+    """
+    Returns the key get_content keeps the content of a transformation under in the memory cache
+    """
+    return "{}|{}|{}".format(xml_file_path, xsl_file_path, sorted(parameters.items()) if parameters else "")
+
+
+def get_request_content_version(project, xml_file_path, xsl_file_path, parameters, revalidate=False):
+    """
+    Returns get_content_version for a transformation of 'project', looking up the input files at most once per
+    request however many times the version is needed (e.g. for the validators, the cached response body and the
+    content of a text response).
+
+    Like the memory cache entries of content, versions are kept in memory (see content_version_cache) and only
+    looked up again once 'memory_cache_revalidate_seconds' have passed, or if 'revalidate' is True.
+    """
+    memory_cache_key = get_memory_cache_key(xml_file_path, xsl_file_path, parameters)
+    # versions used in this request, and whether the input files were looked up for them during the request
+    versions = request_globals.setdefault("content_versions", {}) if has_request_context() else {}
+    version, looked_up = versions.get(memory_cache_key, (None, False))
+    if version is None and not revalidate:
+        # entries are never valid once they're due to be checked, the files are looked up again instead
+        version = content_version_cache.get(project, memory_cache_key, lambda entry: False)
+    if version is None or (revalidate and not looked_up):
+        version = get_content_version(xml_file_path, xsl_file_path, parameters, get_xslt_engine(project))
+        content_version_cache.set(project, memory_cache_key, version, time.time(), version[0])
+        looked_up = True
+    versions[memory_cache_key] = (version, looked_up)
+    return version
+
+
+def get_content_last_modified(xml_file_path, xsl_file_path, parameters, engine="lxml"):
+    """
+    Returns the latest modification time of the inputs of transforming 'xml_file_path' with 'xsl_file_path' using
+    'parameters', see get_content_cache_key. 'xsl_file_path' may be None for untransformed XML.
+    """
+    last_modified = os.path.getmtime(xml_file_path)
+    if xsl_file_path is not None:
+        last_modified = max([last_modified] + list(XSLT_ENGINES[engine].get_dependencies(xsl_file_path).values()))
+    if parameters is not None:
+        for value in parameters.values():
+            value = str(value).strip("\"'")
+            if value.startswith("file://"):
+                try:
+                    last_modified = max(last_modified, os.path.getmtime(url_to_local_path(value)))
+                except OSError:
+                    continue
+    return last_modified
+
+
+# included in the ETags of text responses, increase this when the format of the responses changes,
+# so clients don't keep using responses in the old format
+TEXT_RESPONSE_VERSION = 1
+
+
+def get_text_validators(project, sources, extra=None):
+    """
+    Returns a tuple of an ETag and a Last-Modified datetime for a text response built from the transformations in
+    'sources', a list of (folder, XML filename, XSL filename or None, parameters) tuples, and 'extra', any JSON
+    serializable data in the response that doesn't come from the transformations, such as fields from the database.
+
+    The validators only depend on the modification times of the files involved, so they are cheap to compute,
+    and the versions of the transformations are shared with the rest of the request (see get_request_content_version).
+    Returns (None, None) if any of the files are missing.
+    """
+    project_config = get_project_config(project)
+    if project_config is None:
+        return None, None
+    etag = hashlib.sha256("version={}\n".format(TEXT_RESPONSE_VERSION).encode("utf-8"))
+    last_modified = 0.0
+    for folder, xml_filename, xsl_filename, parameters in sources:
+        xml_file_path = safe_join(project_config["file_root"], "xml", folder, xml_filename)
+        xsl_file_path = safe_join(project_config["file_root"], "xslt", xsl_filename) if xsl_filename is not None else None
+        if xml_file_path is None or (xsl_filename is not None and xsl_file_path is None):
+            return None, None
+        # missing files raise an OSError when looked up
+        try:
+            if xsl_file_path is not None:
+                content_key, source_last_modified = get_request_content_version(project, xml_file_path, xsl_file_path, parameters)
+                etag.update("content={}\n".format(content_key).encode("utf-8"))
+            else:
+                xml_file_stat = os.stat(xml_file_path)
+                etag.update("xml={}|{}|{}|{}\n".format(os.path.abspath(xml_file_path), xml_file_stat.st_mtime_ns,
+                                                       xml_file_stat.st_size, sorted((parameters or {}).items())).encode("utf-8"))
+                source_last_modified = get_content_last_modified(xml_file_path, None, parameters)
+            last_modified = max(last_modified, source_last_modified)
+        except Exception:
+            return None, None
+    etag.update("extra={}\n".format(json.dumps(extra, sort_keys=True, default=str)).encode("utf-8"))
+    return etag.hexdigest()[:40], datetime.fromtimestamp(int(last_modified), tz=timezone.utc)
+
+
+def get_conditional_text_response(project, sources, extra, create_response, compressed=False):
+    """
+    Returns a text response with ETag and Last-Modified headers built from 'sources' and 'extra' (see
+    get_text_validators), or a 304 Not Modified response if the request has If-None-Match or If-Modified-Since
+    headers matching them. The 304 response is returned before calling 'create_response', which should return the
+    full response (or a view function return value such as a (response, status) tuple).
+
+    'compressed' should be True if the response is compressed according to the Accept-Encoding header
+    (see get_text_response), so each content coding gets its own ETag.
+    Incomplete responses, such as ones with texts left to render later, should be marked with
+    'Cache-Control: no-store', they are returned without validators.
+    """
+    etag, last_modified = get_text_validators(project, sources, extra)
+    if etag is None:
+        return create_response()
+    if compressed:
+        encoding = request.accept_encodings.best_match(get_payload_encodings(), default="identity")
+        if encoding != "identity":
+            etag = "{}-{}".format(etag, encoding)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = current_app.make_response(create_response())
+        if response.status_code != 200 or response.cache_control.no_store:
+            return response
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # clients may keep the response, but should check with the API that it's still current before using it
+    response.headers["Cache-Control"] = "no-cache"
+    if compressed:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def create_conditional_json_response(data):
+    """
+    Returns jsonify(data) with an ETag based on the response body, or a 304 Not Modified response if the request
+    has a matching If-None-Match header. For responses built only from the database, without transformations.
+    """
+    response = jsonify(data)
+    response.add_etag()
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+class MemoryContentCache:
+    """
+    Per-worker in-memory LRU cache of rendered content, used by get_content in front of the file cache.
+
+    The cache is capped by the total memory used by the cached strings. Entries are stored under a key
+    describing the requested transformation and remember the content cache key (see get_content_cache_key)
+    they were rendered with. To keep hits free of filesystem calls, entries are only checked against their
+    source files and 'cache_lifetime_seconds' again once 'revalidate_seconds' have passed since their last check.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, revalidate_seconds=10):
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._project_stats = {}
+
+    def get(self, project, key, validator):
+        """
+        Returns cached content for 'key', or None if there is no valid entry.
+        When an entry is due to be checked, 'validator' is called with the entry and should return False if it is stale.
+        Stale entries are kept until they are replaced or evicted, see get_stale.
+        """
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            project_stats = self._get_project_stats(project)
+            entry = self._entries.get(key)
+            if entry is None or entry["stale"]:
+                project_stats["misses"] += 1
+                return None
+            needs_validation = time.monotonic() - entry["validated_at"] >= self.revalidate_seconds
+
+        # validate outside of the lock, as validation may need to stat files or compile a stylesheet
+        if needs_validation:
+            is_valid = validator(entry)
+            with self._lock:
+                if self._entries.get(key) is not entry:
+                    project_stats["misses"] += 1
+                    return None
+                if not is_valid:
+                    entry["stale"] = True
+                    project_stats["misses"] += 1
+                    project_stats["invalidations"] += 1
+                    return None
+                entry["validated_at"] = time.monotonic()
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            project_stats["hits"] += 1
+            return entry["content"]
+
+    def get_stale(self, key):
+        """
+        Returns the content of a stale entry for 'key', or None if there is no such entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["stale"]:
+                return entry["content"]
+            return None
+
+    def set(self, project, key, content, created, content_key):
+        """
+        Stores 'content' for 'key'. 'created' is the timestamp the content was rendered at,
+        and 'content_key' the content cache key it was rendered with.
+        """
+        size = sys.getsizeof(content)
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "project": project,
+                "content": content,
+                "size": size,
+                "created": created,
+                "content_key": content_key,
+                "stale": False,
+                "validated_at": time.monotonic()
+            }
+            self.current_bytes += size
+            self._get_project_stats(project)["bytes"] += size
+            while self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._get_project_stats(self._entries[oldest_key]["project"])["evictions"] += 1
+                self._remove(oldest_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            for project_stats in self._project_stats.values():
+                project_stats["bytes"] = 0
+
+    def stats(self, project=None):
+        """
+        Returns the cache counters as a dictionary, optionally only for the given project
+        """
+        with self._lock:
+            projects = {}
+            for name, project_stats in self._project_stats.items():
+                if project is not None and name != project:
+                    continue
+                lookups = project_stats["hits"] + project_stats["misses"]
+                projects[name] = dict(project_stats)
+                projects[name]["hit_ratio"] = round(project_stats["hits"] / lookups, 3) if lookups else None
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "revalidate_seconds": self.revalidate_seconds,
+                "projects": projects
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry["size"]
+        self._get_project_stats(entry["project"])["bytes"] -= entry["size"]
+
+    def _get_project_stats(self, project):
+        if project not in self._project_stats:
+            self._project_stats[project] = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0, "bytes": 0}
+        return self._project_stats[project]
+
+
+memory_content_cache = MemoryContentCache(max_bytes=config.get("memory_cache_max_bytes", 64 * 1024 * 1024),
+                                          revalidate_seconds=config.get("memory_cache_revalidate_seconds", 10))
+
+# versions of transformations (see get_request_content_version), checked as often as the memory cache entries of content
+content_version_cache = MemoryContentCache(max_bytes=1024 * 1024, revalidate_seconds=memory_content_cache.revalidate_seconds)
 
 
 def get_published_status(project, collection_id, publication_id):
@@ -347,111 +681,1530 @@ def get_collection_published_status(project, collection_id):
     return can_show, message
 
 
+class FacsimileCollectionCache:
+    """
+    Thread-safe cache of the visibility and file folder of facsimile collections, one per worker process,
+    so requests for facsimile images don't query the database for every image (see get_facsimile_file).
+
+    Entries expire 'ttl_seconds' after they were loaded. The facsimile collection tools call invalidate() when they
+    change collections or their links to publications, which clears the cache of the calling worker and updates the
+    marker file 'generation_file_path', so the other workers clear their caches on their next lookup.
+    """
+    def __init__(self, ttl_seconds=60, max_entries=1024, generation_file_path=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.generation_file_path = generation_file_path
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _get_generation(self):
+        if self.generation_file_path is None:
+            return None
+        try:
+            generation_stat = os.stat(self.generation_file_path)
+        except OSError:
+            return None
+        return generation_stat.st_ino, generation_stat.st_mtime_ns
+
+    def get(self, key, load):
+        """
+        Returns the value cached for 'key', calling 'load' to load it if it isn't cached or has expired
+        """
+        if self.ttl_seconds <= 0:
+            return load()
+        generation = self._get_generation()
+        with self._lock:
+            if generation != self._generation:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._generation = generation
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = load()
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        """
+        Clears the cache in all worker processes
+        """
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+        if self.generation_file_path is not None:
+            try:
+                write_file_atomically(self.generation_file_path, str(time.time()))
+            except OSError:
+                logger.exception("Could not update {}, other workers keep their cached facsimile collections "
+                                 "until they expire".format(self.generation_file_path))
+
+    def stats(self):
+        """
+        Returns the cache counters as a dictionary
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations
+            }
+
+
+facsimile_collection_cache = FacsimileCollectionCache(ttl_seconds=config.get("facsimile_cache_ttl_seconds", 60),
+                                                      generation_file_path=os.path.join("/tmp", "api_facsimile_collections.generation"))
+
+
+class XMLDocumentCache:
+    """
+    Bounded, thread-safe cache of documents loaded from XML files, one per worker process.
+
+    Documents are kept by key in least-recently-used order. Each entry remembers the modification time
+    and size of its file, and the document is loaded again on the next lookup if the file has changed.
+    Cached documents are shared between threads, so they must not be modified.
+    """
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.load_seconds = 0.0
+
+    def get(self, file_path, load, key=None):
+        """
+        Returns the document for 'file_path', calling 'load' with the path to load it if it isn't cached
+        or the file has changed. 'key' defaults to the path, and should also describe how 'load' loads the file.
+        """
+        file_stat = os.stat(file_path)
+        file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+        if key is None:
+            key = file_path
+        if self.max_entries <= 0:
+            return load(file_path)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == file_version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.invalidations += 1
+            self.misses += 1
+
+        # load outside of the lock so other documents can be served in the meantime
+        start_time = time.perf_counter()
+        document = load(file_path)
+        load_time = time.perf_counter() - start_time
+
+        with self._lock:
+            self.load_seconds += load_time
+            self._entries[key] = (file_version, document)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return document
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters as a dictionary
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "load_seconds": round(self.load_seconds, 3)
+            }
+
+
+# parsed XML files transformed by transform_xml
+xml_document_cache = XMLDocumentCache(max_entries=config.get("xml_document_cache_size", 16))
+# contents of XML files loaded with document() in XSL stylesheets, such as the reading text given as 'estDocument'
+xml_source_cache = XMLDocumentCache(max_entries=config.get("xml_document_cache_size", 16))
+
+
+def read_file_bytes(file_path):
+    with io.open(file_path, mode="rb") as file:
+        return file.read()
+
+
 class FileResolver(etree.Resolver):
+    """
+    Resolves files referenced from XSL stylesheets (xsl:import, xsl:include and document() calls).
+
+    If a set is given as 'dependencies', the local path of every resolved file is added to it.
+    This is used while compiling stylesheets to find out which files a compiled stylesheet depends on.
+
+    Once recording has stopped, local files (i.e. document() calls while applying the stylesheet) are served
+    from xml_source_cache. libxslt only reuses documents loaded with document() within a single transformation,
+    and lxml resolvers can't return parsed documents, so this saves reading the file again for every
+    transformation, but not parsing it.
+    """
+    def __init__(self, dependencies=None):
+        super().__init__()
+        self.dependencies = dependencies
+
     def resolve(self, system_url, public_id, context):
         logger.debug("Resolving {}".format(system_url))
+        local_path = url_to_local_path(system_url)
+        if self.dependencies is not None:
+            if local_path is not None:
+                self.dependencies.add(local_path)
+        elif local_path is not None and os.path.isfile(local_path):
+            try:
+                return self.resolve_string(xml_source_cache.get(local_path, read_file_bytes), context,
+                                           base_url=system_url)
+            except OSError:
+                pass
         return self.resolve_filename(system_url, context)
 
 
-def transform_xml(xsl_file_path, xml_file_path, replace_namespace=False, params=None):
-    logger.debug("Transforming {} using {}".format(xml_file_path, xsl_file_path))
+def url_to_local_path(url):
+    """
+    Returns the local filesystem path for a file:// URL or plain path, or None for other URL schemes
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == "file":
+        return os.path.abspath(unquote(parsed_url.path))
+    elif parsed_url.scheme == "" or len(parsed_url.scheme) == 1:
+        # no scheme, or a Windows drive letter
+        return os.path.abspath(url)
+    return None
+
+
+def compile_xslt(xsl_file_path):
+    """
+    Parses and compiles the given XSL stylesheet.
+
+    Returns a tuple of the compiled etree.XSLT object and a dictionary mapping the path of
+    the stylesheet and every file it imports or includes to their modification times.
+    """
+    dependencies = set()
+    dependencies.add(os.path.abspath(xsl_file_path))
+    resolver = FileResolver(dependencies=dependencies)
+    xsl_parser = etree.XMLParser()
+    xsl_parser.resolvers.add(resolver)
+    with io.open(xsl_file_path, encoding="UTF-8") as xsl_file:
+        xslt_root = etree.parse(xsl_file, parser=xsl_parser)
+        xsl_transform = etree.XSLT(xslt_root)
+    # stop recording, the resolver is also used for document() calls when the stylesheet is applied
+    resolver.dependencies = None
+
+    dependency_mtimes = {}
+    for path in dependencies:
+        try:
+            dependency_mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            dependency_mtimes[path] = None
+    return xsl_transform, dependency_mtimes
+
+
+class XSLTCache:
+    """
+    Bounded, thread-safe cache of compiled XSL stylesheets, one per worker process.
+
+    Compiled stylesheets are kept by path in least-recently-used order. Each entry remembers the
+    modification times of the stylesheet and all files it imports or includes, and is recompiled
+    on the next lookup if any of them have changed.
+
+    'compile_function' compiles a stylesheet and returns a tuple of the compiled stylesheet and its
+    dependency modification times, see compile_xslt (lxml) and compile_saxon_xslt (Saxon).
+    """
+    def __init__(self, max_entries=32, compile_function=None):
+        self.max_entries = max_entries
+        self.compile_function = compile_function or compile_xslt
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.compile_seconds = 0.0
+
+    def get(self, xsl_file_path):
+        """
+        Returns the compiled stylesheet for the given path, compiling it if needed
+        """
+        return self.get_with_dependencies(xsl_file_path)[0]
+
+    def get_dependencies(self, xsl_file_path):
+        """
+        Returns a dictionary mapping the stylesheet and every file it imports or includes to their modification times
+        """
+        return dict(self.get_with_dependencies(xsl_file_path)[1])
+
+    def get_with_dependencies(self, xsl_file_path):
+        """
+        Returns a tuple of the compiled stylesheet for the given path and its dependency modification times
+        """
+        xsl_file_path = os.path.abspath(xsl_file_path)
+        with self._lock:
+            entry = self._entries.get(xsl_file_path)
+
+        # check the dependencies outside of the lock, so lookups of other stylesheets don't wait for the stat calls
+        if entry is not None and self._dependencies_unchanged(entry[1]):
+            with self._lock:
+                if xsl_file_path in self._entries:
+                    self._entries.move_to_end(xsl_file_path)
+                self.hits += 1
+            return entry
+
+        with self._lock:
+            # only remove the entry if another thread hasn't already replaced it
+            if entry is not None and self._entries.get(xsl_file_path) is entry:
+                logger.info("Stylesheet {} or one of its imports has changed, recompiling...".format(xsl_file_path))
+                del self._entries[xsl_file_path]
+                self.invalidations += 1
+            self.misses += 1
+
+        # compile outside of the lock so other stylesheets can be served in the meantime
+        start_time = time.perf_counter()
+        xsl_transform, dependency_mtimes = self.compile_function(xsl_file_path)
+        compile_time = time.perf_counter() - start_time
+        logger.debug("Compiled {} in {:.3f} seconds".format(xsl_file_path, compile_time))
+
+        with self._lock:
+            self.compile_seconds += compile_time
+            self._entries[xsl_file_path] = (xsl_transform, dependency_mtimes)
+            self._entries.move_to_end(xsl_file_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return xsl_transform, dependency_mtimes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self, path_prefix=None):
+        """
+        Returns the cache counters as a dictionary.
+        If 'path_prefix' is given, only stylesheets under that path are listed.
+        """
+        with self._lock:
+            stylesheets = [path for path in self._entries
+                           if path_prefix is None or path.startswith(path_prefix)]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "compile_seconds": round(self.compile_seconds, 3),
+                "stylesheets": stylesheets
+            }
+
+    @staticmethod
+    def _dependencies_unchanged(dependency_mtimes):
+        for path, mtime in dependency_mtimes.items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return False
+            except OSError:
+                if mtime is not None:
+                    return False
+        return True
+
+
+xslt_cache = XSLTCache(max_entries=config.get("xslt_cache_size", 32))
+
+
+XSL_NAMESPACE = "http://www.w3.org/1999/XSL/Transform"
+
+
+def get_stylesheet_dependencies(xsl_file_path):
+    """
+    Returns a dictionary mapping the path of the given stylesheet and every file it imports or includes,
+    directly or indirectly, to their modification times (None for missing files).
+
+    Unlike compile_xslt, this only parses the stylesheets as XML, so it works for XSLT 2.0 and 3.0 stylesheets
+    that lxml can't compile.
+    """
+    dependency_mtimes = {}
+    pending = [os.path.abspath(xsl_file_path)]
+    while pending:
+        path = pending.pop()
+        if path in dependency_mtimes:
+            continue
+        try:
+            dependency_mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            dependency_mtimes[path] = None
+            continue
+        stylesheet = etree.parse(path)
+        for element in stylesheet.iter("{{{0}}}import".format(XSL_NAMESPACE), "{{{0}}}include".format(XSL_NAMESPACE)):
+            href = element.get("href")
+            if href:
+                local_path = url_to_local_path(urljoin(stylesheet.docinfo.URL or path, href))
+                if local_path is not None:
+                    pending.append(local_path)
+    return dependency_mtimes
+
+
+class SaxonXSLT:
+    """
+    A compiled Saxon XSLT executable, applied with SaxonXMLDocument.transform_to_string.
+
+    Parameters are set on the executable itself before each transformation, so transformations
+    using the same executable are serialized with a lock.
+    """
+    def __init__(self, xslt_exec):
+        self.xslt_exec = xslt_exec
+        self.lock = threading.Lock()
+
+    def __call__(self, xml_document, parameters=None):
+        with self.lock:
+            return xml_document.transform_to_string(self.xslt_exec, parameters)
+
+
+saxon_processor = None
+saxon_processor_pid = None
+saxon_processor_lock = threading.Lock()
+
+
+def get_saxon_processor():
+    """
+    Returns the Saxon processor of this worker process, creating it on first use.
+    The processor is created lazily, as it can't be shared with worker processes forked after creating it.
+    """
+    global saxon_processor, saxon_processor_pid
+    with saxon_processor_lock:
+        if saxon_processor is None or saxon_processor_pid != os.getpid():
+            if saxon_processor is not None:
+                # stylesheets and documents from the processor of the parent process can't be used with the new one
+                saxon_xslt_cache.clear()
+                xml_document_cache.clear()
+            saxon_processor = PySaxonProcessor(license=False)
+            saxon_processor_pid = os.getpid()
+        return saxon_processor
+
+
+def compile_saxon_xslt(xsl_file_path):
+    """
+    Compiles the given XSL stylesheet using Saxon.
+
+    Returns a tuple of a SaxonXSLT object and a dictionary mapping the path of the stylesheet
+    and every file it imports or includes to their modification times.
+    """
+    dependency_mtimes = get_stylesheet_dependencies(xsl_file_path)
+    xslt_processor = get_saxon_processor().new_xslt30_processor()
+    xslt_exec = xslt_processor.compile_stylesheet(stylesheet_file=os.path.abspath(xsl_file_path), encoding="utf-8")
+    if xslt_exec is None:
+        raise Exception("Could not compile {}: {}".format(xsl_file_path, xslt_processor.error_message))
+    return SaxonXSLT(xslt_exec), dependency_mtimes
+
+
+saxon_xslt_cache = XSLTCache(max_entries=config.get("xslt_cache_size", 32), compile_function=compile_saxon_xslt)
+
+XSLT_ENGINES = {
+    "lxml": xslt_cache,
+    "saxon": saxon_xslt_cache
+}
+
+
+def get_xslt_engine(project):
+    """
+    Returns the name of the XSLT engine used for rendering texts in 'project', 'lxml' (the default) or 'saxon'
+    """
+    project_config = get_project_config(project) or {}
+    engine = project_config.get("xslt_engine", "lxml")
+    if engine not in XSLT_ENGINES:
+        logger.warning("Unknown xslt_engine {!r} for {}, using lxml".format(engine, project))
+        return "lxml"
+    return engine
+
+
+def get_saxon_parameter_value(value):
+    """
+    Converts an lxml XSLT parameter, an XPath expression such as '"1"' for the string 1, into the Python value
+    passed to Saxon. String literals become strings, true() and false() XDM booleans, and numbers ints or floats.
+    Other values are passed as strings.
+    """
+    if not isinstance(value, str):
+        return value
+    stripped_value = value.strip()
+    if len(stripped_value) >= 2 and stripped_value[0] == stripped_value[-1] and stripped_value[0] in "\"'":
+        return stripped_value[1:-1]
+    if stripped_value in ("true()", "false()"):
+        # SaxonXMLDocument passes Python booleans as integers, like the publisher has always done
+        return get_saxon_processor().make_boolean_value(stripped_value == "true()")
+    for number_type in (int, float):
+        try:
+            return number_type(stripped_value)
+        except ValueError:
+            pass
+    return value
+
+
+def transform_xml(xsl_file_path, xml_file_path, replace_namespace=False, params=None, engine="lxml"):
+    logger.debug("Transforming {} using {} ({})".format(xml_file_path, xsl_file_path, engine))
     if params is not None:
         logger.debug("Parameters are {}".format(params))
     if not os.path.exists(xsl_file_path):
         return "XSL file {!r} not found!".format(xsl_file_path)
     if not os.path.exists(xml_file_path):
         return "XML file {!r} not found!".format(xml_file_path)
+    if params is not None and not isinstance(params, dict):
+        raise Exception(
+            "Invalid parameters for XSLT transformation, must be of type dict or OrderedDict, not {}".format(
+                type(params)))
 
-    with io.open(xml_file_path, mode="rb") as xml_file:
-        xml_contents = xml_file.read()
-        if replace_namespace:
-            xml_contents = xml_contents.replace(b'xmlns="http://www.sls.fi/tei"',
-                                                b'xmlns="http://www.tei-c.org/ns/1.0"')
+    if engine == "saxon":
+        return transform_xml_with_saxon(xsl_file_path, xml_file_path, replace_namespace=replace_namespace, params=params)
 
-        xml_root = etree.fromstring(xml_contents)
-
-    xsl_parser = etree.XMLParser()
-    xsl_parser.resolvers.add(FileResolver())
-    with io.open(xsl_file_path, encoding="UTF-8") as xsl_file:
-        xslt_root = etree.parse(xsl_file, parser=xsl_parser)
-        xsl_transform = etree.XSLT(xslt_root)
+    xml_root = xml_document_cache.get(xml_file_path, lambda path: parse_xml_file(path, replace_namespace),
+                                      key=("lxml", xml_file_path, replace_namespace))
+    xsl_transform = xslt_cache.get(xsl_file_path)
 
     if params is None:
         result = xsl_transform(xml_root)
-    elif isinstance(params, dict) or isinstance(params, OrderedDict):
-        result = xsl_transform(xml_root, **params)
     else:
-        raise Exception(
-            "Invalid parameters for XSLT transformation, must be of type dict or OrderedDict, not {}".format(
-                type(params)))
+        result = xsl_transform(xml_root, **params)
     if len(xsl_transform.error_log) > 0:
         logging.debug(xsl_transform.error_log)
     return str(result)
 
 
+def parse_xml_file(xml_file_path, replace_namespace=False):
+    """
+    Parses 'xml_file_path' for transform_xml and returns the root element
+    """
+    with io.open(xml_file_path, mode="rb") as xml_file:
+        xml_contents = xml_file.read()
+    if replace_namespace:
+        xml_contents = xml_contents.replace(b'xmlns="http://www.sls.fi/tei"',
+                                            b'xmlns="http://www.tei-c.org/ns/1.0"')
+    return etree.fromstring(xml_contents)
+
+
+def parse_xml_file_with_saxon(xml_file_path, replace_namespace=False):
+    """
+    Parses 'xml_file_path' for transform_xml_with_saxon and returns it as a SaxonXMLDocument
+    """
+    xml_document = SaxonXMLDocument(get_saxon_processor())
+    with io.open(xml_file_path, encoding="utf-8-sig") as xml_file:
+        xml_contents = xml_file.read()
+    if replace_namespace:
+        xml_contents = xml_contents.replace('xmlns="http://www.sls.fi/tei"', 'xmlns="http://www.tei-c.org/ns/1.0"')
+    xml_document.load_xml_string(xml_contents)
+    return xml_document
+
+
+def transform_xml_with_saxon(xsl_file_path, xml_file_path, replace_namespace=False, params=None):
+    """
+    Transforms 'xml_file_path' with 'xsl_file_path' using Saxon, see transform_xml.
+    'params' are given in the same form as for lxml and passed to Saxon as XDM values.
+    """
+    # the processor is checked first, so documents parsed by the processor of a parent process aren't used
+    get_saxon_processor()
+    xml_document = xml_document_cache.get(xml_file_path, lambda path: parse_xml_file_with_saxon(path, replace_namespace),
+                                          key=("saxon", xml_file_path, replace_namespace))
+
+    parameters = None
+    if params is not None:
+        parameters = {name: get_saxon_parameter_value(value) for name, value in params.items()}
+    return saxon_xslt_cache.get(xsl_file_path)(xml_document, parameters)
+
+
+def acquire_file_lock(lock_file_path, timeout=None):
+    """
+    Acquires an exclusive lock on 'lock_file_path', shared between all processes on this host.
+    If 'timeout' is None, returns immediately, otherwise waits for up to 'timeout' seconds for the lock.
+    Returns an open file descriptor holding the lock, or None if the lock could not be acquired.
+    """
+    lock_fd = os.open(lock_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+    deadline = time.monotonic() + (timeout or 0)
+    while True:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_fd
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                os.close(lock_fd)
+                return None
+            time.sleep(0.05)
+
+
+def release_file_lock(lock_fd):
+    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    os.close(lock_fd)
+
+
+# the umask of the process, which can only be read by setting it, so it's read once while importing, before any
+# threads that could create files in the meantime are started
+PROCESS_UMASK = os.umask(0o022)
+os.umask(PROCESS_UMASK)
+
+
+def write_file_atomically(file_path, content, mode="w", file_mode=None):
+    """
+    Writes 'content' to a temporary file next to 'file_path' and then renames it to 'file_path',
+    so readers see either the previous file or the complete new file, never a partially written one.
+
+    The file gets the permissions 'file_mode', by default the same permissions as files created with open(), rather
+    than the owner-only permissions of the temporary file, so it can be read by other users such as nginx
+    (see create_file_response).
+    """
+    folder, filename = os.path.split(file_path)
+    temp_fd, temp_path = tempfile.mkstemp(dir=folder, prefix=".{}.".format(filename), suffix=".tmp")
+    try:
+        if "b" in mode:
+            with io.open(temp_fd, mode=mode) as temp_file:
+                temp_file.write(content)
+        else:
+            with io.open(temp_fd, mode=mode, encoding="UTF-8") as temp_file:
+                temp_file.write(content)
+        os.chmod(temp_path, file_mode if file_mode is not None else 0o666 & ~PROCESS_UMASK)
+        os.replace(temp_path, file_path)
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class RenderCounters:
+    """
+    Per-worker counters for content rendered on cache misses, kept per project
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._project_counters = {}
+
+    def increment(self, project, counter, amount=1):
+        with self._lock:
+            if project not in self._project_counters:
+                self._project_counters[project] = {
+                    "renders": 0,
+                    "shared_cache_hits": 0,
+                    "duplicate_renders_avoided": 0,
+                    "stale_served": 0,
+                    "lock_wait_seconds": 0.0
+                }
+            self._project_counters[project][counter] += amount
+
+    def stats(self, project=None):
+        with self._lock:
+            return {
+                name: dict(counters, lock_wait_seconds=round(counters["lock_wait_seconds"], 3))
+                for name, counters in self._project_counters.items()
+                if project is None or name == project
+            }
+
+
+render_counters = RenderCounters()
+
+# rendered content is also shared with other API replicas through this backend, if configured
+shared_render_cache = create_cache_backend(config.get("shared_render_cache"), config["cache_lifetime_seconds"])
+# after an error, the shared render cache isn't used for this many seconds, so an unreachable cache doesn't slow down every request
+SHARED_RENDER_CACHE_RETRY_SECONDS = 30
+shared_render_cache_retry_at = 0.0
+
+
+def shared_render_cache_is_available():
+    return shared_render_cache is not None and time.monotonic() >= shared_render_cache_retry_at
+
+
+def shared_render_cache_failed(message):
+    global shared_render_cache_retry_at
+    logger.exception(message)
+    shared_render_cache_retry_at = time.monotonic() + SHARED_RENDER_CACHE_RETRY_SECONDS
+
+
+def get_shared_content(cache_key):
+    """
+    Returns a tuple of content and the timestamp it was rendered at from the shared render cache,
+    or None if it isn't there or the shared render cache is not configured or not reachable
+    """
+    if not shared_render_cache_is_available():
+        return None
+    try:
+        shared_content = shared_render_cache.get(cache_key)
+    except Exception:
+        shared_render_cache_failed("Could not get {} from shared render cache".format(cache_key))
+        return None
+    if shared_content is None:
+        return None
+    content, rendered_at = shared_content
+    logger.info("Content fetched from shared render cache.")
+    return content.decode("utf-8"), rendered_at
+
+
+def set_shared_content(cache_key, content, rendered_at):
+    if not shared_render_cache_is_available():
+        return
+    try:
+        shared_render_cache.set(cache_key, content.encode("utf-8"), rendered_at)
+    except Exception:
+        shared_render_cache_failed("Could not store {} in shared render cache".format(cache_key))
+
+
+def render_to_cache_file(project, cache_file_path, render, stale_content=None, fetch=None, publish=None):
+    """
+    Calls 'render' to produce content for 'cache_file_path' and atomically writes the result to the cache file.
+
+    Only one worker process renders a given cache file at a time. Other workers requesting the same content wait
+    for the rendering worker to finish and then read its cache file, or, if 'cache_stale_while_revalidate' is set
+    in the config and 'stale_content' is given, return 'stale_content' immediately instead.
+
+    If given, 'fetch' is called before rendering and may return a tuple of already rendered content and the
+    timestamp it was rendered at (e.g. from a shared cache), which is then used instead of rendering. 'publish'
+    is called with newly rendered content and its timestamp.
+
+    Returns a tuple of the content and the timestamp the content was rendered at. The timestamp is None if
+    stale content was returned.
+    """
+    lock_fd = acquire_file_lock(cache_file_path + ".lock")
+    waited_for_lock = False
+    if lock_fd is None:
+        if stale_content is not None and config.get("cache_stale_while_revalidate", False):
+            logger.info("Content is being rendered by another worker, serving stale content.")
+            render_counters.increment(project, "stale_served")
+            return stale_content, None
+        logger.info("Content is being rendered by another worker, waiting for it...")
+        wait_start = time.monotonic()
+        lock_fd = acquire_file_lock(cache_file_path + ".lock", timeout=config.get("cache_render_wait_seconds", 60))
+        render_counters.increment(project, "lock_wait_seconds", time.monotonic() - wait_start)
+        waited_for_lock = True
+        if lock_fd is None:
+            logger.warning("Timed out waiting for rendering lock on {}, rendering anyway.".format(cache_file_path))
+
+    try:
+        if waited_for_lock and lock_fd is not None:
+            # the worker holding the lock has most likely just written the cache file
+            try:
+                cache_file_mtime = os.path.getmtime(cache_file_path)
+                if cache_is_recent(cache_file_mtime):
+                    with io.open(cache_file_path, encoding="UTF-8") as cache_file:
+                        content = cache_file.read()
+                    render_counters.increment(project, "duplicate_renders_avoided")
+                    return content, cache_file_mtime
+            except OSError:
+                pass
+
+        fetched = fetch() if fetch is not None else None
+        if fetched is not None:
+            content, rendered_at = fetched
+            render_counters.increment(project, "shared_cache_hits")
+            write_file_atomically(cache_file_path, content)
+            # keep the cache lifetime of the content as it was rendered
+            os.utime(cache_file_path, (time.time(), rendered_at))
+            return content, rendered_at
+
+        rendered_at = time.time()
+        content = render()
+        render_counters.increment(project, "renders")
+        write_file_atomically(cache_file_path, content)
+        if publish is not None:
+            publish(content, rendered_at)
+        return content, rendered_at
+    finally:
+        if lock_fd is not None:
+            release_file_lock(lock_fd)
+
+
+class DiskCache:
+    """
+    A cache directory with files laid out as <root>/<project>/<type>/<file>, kept within a byte budget.
+
+    A background thread in each worker process periodically sweeps the directory, one worker at a time: it rebuilds
+    the index of cached entries by scanning the directory, removes entries that have expired and not been used for
+    'max_age_seconds', evicts the least recently used entries while the directory is over 'max_bytes', and cleans up
+    leftover lock and temporary files. Files sharing the same content cache key (e.g. a rendering and its section
+    index) form one entry and are evicted together. Use is tracked by the access time of the files, see touch().
+    """
+    ENTRY_NAME_PATTERN = re.compile(r"^(.*\.[0-9a-f]{64})(\..*)?$")
+    LEFTOVER_FILE_MAX_AGE_SECONDS = 3600
+
+    def __init__(self, root, max_bytes=0, sweep_interval_seconds=300, max_age_seconds=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.max_age_seconds = max_age_seconds
+        self._stats_file_path = os.path.join(root, ".stats.json")
+        self._sweep_lock_file_path = os.path.join(root, ".sweep.lock")
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+
+    def touch(self, file_path):
+        """
+        Marks 'file_path' as used now, by setting its access time and keeping its modification time,
+        which is used for the cache lifetime
+        """
+        try:
+            os.utime(file_path, (time.time(), os.stat(file_path).st_mtime))
+        except OSError:
+            pass
+
+    def start_sweeper(self):
+        """
+        Starts the sweeper thread in this process, if it isn't running already
+        """
+        if not self.sweep_interval_seconds or self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            # threads don't survive forking, so this is checked per process id
+            self._sweeper_pid = os.getpid()
+            threading.Thread(target=self._run_sweeper, name="disk-cache-sweeper", daemon=True).start()
+
+    def _run_sweeper(self):
+        while True:
+            time.sleep(self.sweep_interval_seconds)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Error when sweeping cache directory {}".format(self.root))
+
+    def scan(self):
+        """
+        Scans the cache directory. Returns a tuple of a dictionary of cache entries keyed by entry name,
+        and a list of (path, modification time) tuples of lock and temporary files.
+        """
+        entries = {}
+        leftover_files = []
+        for project_entry in os.scandir(self.root):
+            if not project_entry.is_dir(follow_symlinks=False):
+                continue
+            for type_folder, _, filenames in os.walk(project_entry.path):
+                text_type = os.path.relpath(type_folder, project_entry.path).split(os.sep)[0]
+                for filename in filenames:
+                    file_path = os.path.join(type_folder, filename)
+                    try:
+                        file_stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    if filename.endswith((".lock", ".tmp")):
+                        leftover_files.append((file_path, file_stat.st_mtime))
+                        continue
+                    match = self.ENTRY_NAME_PATTERN.match(filename)
+                    entry_name = os.path.join(type_folder, match.group(1) if match else filename)
+                    entry = entries.setdefault(entry_name, {
+                        "project": project_entry.name,
+                        "type": text_type,
+                        "bytes": 0,
+                        "used": 0.0,
+                        "modified": 0.0,
+                        "paths": []
+                    })
+                    entry["bytes"] += file_stat.st_size
+                    entry["used"] = max(entry["used"], file_stat.st_atime, file_stat.st_mtime)
+                    entry["modified"] = max(entry["modified"], file_stat.st_mtime)
+                    entry["paths"].append(file_path)
+        return entries, leftover_files
+
+    def _remove_leftover_files(self, leftover_files, now):
+        for file_path, modified in leftover_files:
+            if modified + self.LEFTOVER_FILE_MAX_AGE_SECONDS > now:
+                continue
+            if file_path.endswith(".lock"):
+                # don't remove locks that are held by a worker
+                lock_fd = acquire_file_lock(file_path)
+                if lock_fd is None:
+                    continue
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+                release_file_lock(lock_fd)
+            else:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+    def _read_stats_file(self):
+        try:
+            with io.open(self._stats_file_path, encoding="UTF-8") as stats_file:
+                return json.load(stats_file)
+        except (OSError, ValueError):
+            return None
+
+    def sweep(self, force=False):
+        """
+        Sweeps the cache directory, unless another worker is sweeping it or it has been swept within
+        'sweep_interval_seconds' (and 'force' is False). Returns the updated statistics, or None if no sweep was done.
+        """
+        if not os.path.isdir(self.root):
+            return None
+        lock_fd = acquire_file_lock(self._sweep_lock_file_path)
+        if lock_fd is None:
+            return None
+        try:
+            previous_stats = self._read_stats_file()
+            if not force and previous_stats is not None and \
+                    previous_stats["swept_at"] + self.sweep_interval_seconds > time.time():
+                return None
+            start = time.perf_counter()
+            now = time.time()
+            entries, leftover_files = self.scan()
+            self._remove_leftover_files(leftover_files, now)
+
+            evictions = {}
+            if previous_stats is not None:
+                for project, project_stats in previous_stats["projects"].items():
+                    for text_type, type_stats in project_stats["types"].items():
+                        evictions[(project, text_type)] = type_stats["evictions"]
+
+            def evict(entry_name, entry):
+                for file_path in entry["paths"]:
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        pass
+                del entries[entry_name]
+                evictions[(entry["project"], entry["type"])] = evictions.get((entry["project"], entry["type"]), 0) + 1
+
+            if self.max_age_seconds:
+                for entry_name, entry in list(entries.items()):
+                    if entry["modified"] + self.max_age_seconds < now and entry["used"] + self.max_age_seconds < now:
+                        evict(entry_name, entry)
+
+            total_bytes = sum(entry["bytes"] for entry in entries.values())
+            if self.max_bytes and total_bytes > self.max_bytes:
+                # evict down to 90% of the budget, so the next sweep doesn't have to evict again right away
+                target_bytes = self.max_bytes * 0.9
+                for entry_name, entry in sorted(entries.items(), key=lambda item: item[1]["used"]):
+                    if total_bytes <= target_bytes:
+                        break
+                    total_bytes -= entry["bytes"]
+                    evict(entry_name, entry)
+
+            stats = {
+                "swept_at": now,
+                "sweep_seconds": round(time.perf_counter() - start, 3),
+                "entries": len(entries),
+                "bytes": total_bytes,
+                "max_bytes": self.max_bytes,
+                "projects": {}
+            }
+            for (project, text_type), count in evictions.items():
+                project_stats = stats["projects"].setdefault(project, {"entries": 0, "bytes": 0, "evictions": 0, "types": {}})
+                project_stats["types"][text_type] = {"entries": 0, "bytes": 0, "evictions": count}
+                project_stats["evictions"] += count
+            for entry in entries.values():
+                project_stats = stats["projects"].setdefault(entry["project"], {"entries": 0, "bytes": 0, "evictions": 0, "types": {}})
+                type_stats = project_stats["types"].setdefault(entry["type"], {"entries": 0, "bytes": 0, "evictions": 0})
+                for counters in (project_stats, type_stats):
+                    counters["entries"] += 1
+                    counters["bytes"] += entry["bytes"]
+            write_file_atomically(self._stats_file_path, json.dumps(stats))
+            logger.info("Swept cache directory {} in {} seconds, {} entries, {} bytes".format(
+                self.root, stats["sweep_seconds"], stats["entries"], stats["bytes"]))
+            return stats
+        finally:
+            release_file_lock(lock_fd)
+
+    def stats(self, project=None):
+        """
+        Returns the statistics of the last sweep, shared by all workers. If the directory hasn't been swept yet,
+        e.g. after a restart, it is swept (and its index rebuilt) first.
+        """
+        stats = self._read_stats_file()
+        if stats is None:
+            stats = self.sweep(force=True)
+        if stats is None:
+            return None
+        if project is not None:
+            stats["projects"] = {name: project_stats for name, project_stats in stats["projects"].items() if name == project}
+        return stats
+
+
+content_disk_cache = DiskCache(os.path.join("/tmp", "api_cache"),
+                               max_bytes=config.get("disk_cache_max_bytes", 0),
+                               sweep_interval_seconds=config.get("disk_cache_sweep_interval_seconds", 300),
+                               max_age_seconds=config.get("cache_lifetime_seconds"))
+
+
+# image derivatives (see get_image_derivative) are cached separately from the content cache, as they're much larger
+derivative_disk_cache = DiskCache(os.path.join("/tmp", "api_derivatives"),
+                                  max_bytes=config.get("derivative_cache_max_bytes", 1073741824),
+                                  sweep_interval_seconds=config.get("disk_cache_sweep_interval_seconds", 300))
+
+# widths derivatives can be requested in, unless 'derivative_widths' is set in the config
+DEFAULT_DERIVATIVE_WIDTHS = [150, 300, 600, 900, 1200, 2000]
+
+
+def snap_derivative_width(width):
+    """
+    Returns the smallest of the allowed derivative widths ('derivative_widths') at least 'width' pixels wide,
+    or the largest one if 'width' is wider than all of them, so only a few sizes of each image are ever cached
+    """
+    widths = sorted(config.get("derivative_widths") or DEFAULT_DERIVATIVE_WIDTHS)
+    for allowed_width in widths:
+        if width <= allowed_width:
+            return allowed_width
+    return widths[-1]
+
+
+@lru_cache(maxsize=4096)
+def get_image_width(image_path, mtime_ns, size):
+    """
+    Returns the width of the image at 'image_path' in pixels.
+    The result is kept per worker for the given modification time and size of the image.
+    """
+    with Image.open(image_path) as image:
+        return image.size[0]
+
+
+def get_image_derivative(project, image_type, source_paths, width):
+    """
+    Returns the path of a JPEG image 'width' pixels wide (snapped to an allowed width, see snap_derivative_width)
+    made from the images in 'source_paths', which are the same image in different sizes (e.g. the zoom levels of
+    a facsimile page), or a single image. Images that don't exist are ignored.
+
+    The derivative is scaled down from the smallest source image at least as wide, and stored in the derivative
+    cache (<root>/<project>/<image_type>/) for later requests, keyed by the modification times and sizes of the source
+    images, so the images are only opened when a derivative is created. Images aren't enlarged: if the source image is
+    exactly as wide, or no source image is wide enough, the path of the widest source image is returned instead.
+    Raises FileNotFoundError if none of the source images exist.
+    """
+    width = snap_derivative_width(width)
+    source_stats = []
+    for source_path in source_paths:
+        if not source_path:
+            continue
+        try:
+            source_stat = os.stat(source_path)
+        except OSError:
+            continue
+        if stat.S_ISREG(source_stat.st_mode):
+            source_stats.append((source_path, source_stat))
+    if not source_stats:
+        raise FileNotFoundError("No source image for derivative")
+
+    # derivatives are keyed by all of the source images, so existing ones are found without opening the images
+    derivative_key = "|".join("{}|{}|{}".format(source_path, source_stat.st_mtime_ns, source_stat.st_size)
+                              for source_path, source_stat in source_stats)
+    derivative_key = "{}|{}|{}".format(derivative_key, width, FACSIMILE_JPEG_QUALITY)
+    derivative_key = hashlib.sha256(derivative_key.encode("utf-8")).hexdigest()
+    derivative_folder = os.path.join(derivative_disk_cache.root, project, image_type)
+    # keep the file names readable, e.g. 12.300.<derivative_key>.jpg
+    derivative_path = os.path.join(derivative_folder, "{}.{}.{}.jpg".format(
+        os.path.splitext(os.path.basename(source_stats[0][0]))[0], width, derivative_key))
+    derivative_disk_cache.start_sweeper()
+    if os.path.isfile(derivative_path):
+        derivative_disk_cache.touch(derivative_path)
+        return derivative_path
+
+    sources = sorted((get_image_width(source_path, source_stat.st_mtime_ns, source_stat.st_size), source_path)
+                     for source_path, source_stat in source_stats)
+    source_width, source_path = next((source for source in sources if source[0] >= width), sources[-1])
+    if source_width <= width:
+        return source_path
+
+    os.makedirs(derivative_folder, exist_ok=True)
+    # only one worker creates a derivative at a time, others wait for it and then use the same file
+    lock_fd = acquire_file_lock(derivative_path + ".lock", timeout=config.get("cache_render_wait_seconds", 60))
+    try:
+        if not os.path.isfile(derivative_path):
+            start = time.perf_counter()
+            create_image_derivative(source_path, derivative_path, width)
+            logger.info("Created {} pixels wide derivative of {} in {:.3f} seconds".format(
+                width, source_path, time.perf_counter() - start))
+    finally:
+        if lock_fd is not None:
+            release_file_lock(lock_fd)
+    return derivative_path
+
+
+def get_cache_file_path(project, folder, xml_filename, xsl_filename, content_key):
+    """
+    Returns the path of the cache file for content rendered with the content cache key 'content_key'
+    """
+    # keep the file names readable, e.g. 1_2_ms_3.ms_changes.<content_key>.html
+    cache_filename = "{}.{}.{}.html".format(xml_filename.replace(".xml", ""), xsl_filename.replace(".xsl", ""), content_key)
+    return os.path.join(content_disk_cache.root, project, folder, cache_filename)
+
+
+# get_content returns a message starting with one of these instead of the content when a text can't be rendered
+RENDER_ERROR_PREFIXES = (
+    "No such project.",
+    "File not found",
+    "Error parsing document",
+    "Error reading content from cache.",
+    "Successfully fetched content but could not generate cache for it.",
+    "XSL file",
+    "XML file",
+    "Error rendering content"
+)
+
+
 def get_content(project, folder, xml_filename, xsl_filename, parameters):
     project_config = get_project_config(project)
     if project_config is None:
         return "No such project."
     xml_file_path = safe_join(project_config["file_root"], "xml", folder, xml_filename)
     xsl_file_path = safe_join(project_config["file_root"], "xslt", xsl_filename)
-    cache_folder = os.path.join("/tmp", "api_cache", project, folder)
-    os.makedirs(cache_folder, exist_ok=True)
-    if "ms" in xsl_filename:
-        # xsl_filename is 'ms_changes.xsl' or 'ms_normalized.xsl'
-        # ensure that '_changes' or '_normalized' is appended to the cache filename accordingly
-        cache_extension = "{}.html".format(xsl_filename.split("ms")[1].replace(".xsl", ""))
-    else:
-        cache_extension = ".html"
-    cache_file_path = os.path.join(cache_folder, xml_filename.replace(".xml", cache_extension))
+    engine = get_xslt_engine(project)
 
-    content = None
-    param_ext = ''
-    if parameters is not None:
-        if 'noteId' in parameters:
-            param_ext += "_" + parameters["noteId"]
-        if 'sectionId' in parameters:
-            param_ext += "_" + parameters["sectionId"]
-        # not needed for bookId
-        param_file_name = xml_filename.split(".xml")[0] + param_ext
-        cache_file_path = cache_file_path.replace(xml_filename.split(".xml")[0], param_file_name)
-        cache_file_path = cache_file_path.replace('"', '')
+    # the memory cache is keyed by the requested transformation, entries are checked against the content cache key periodically
+    memory_cache_key = get_memory_cache_key(xml_file_path, xsl_file_path, parameters)
+
+    def memory_cache_entry_is_valid(entry):
+        try:
+            if cache_is_recent(entry["created"]) and \
+                    entry["content_key"] == get_request_content_version(project, xml_file_path, xsl_file_path, parameters, revalidate=True)[0]:
+                # keep the cache file from being evicted from disk while the content is used from memory
+                content_disk_cache.touch(get_cache_file_path(project, folder, xml_filename, xsl_filename, entry["content_key"]))
+                return True
+            return False
+        except Exception:
+            return False
+
+    content_disk_cache.start_sweeper()
+
+    content = memory_content_cache.get(project, memory_cache_key, memory_cache_entry_is_valid)
+    if content is not None:
+        logger.info("Content fetched from memory cache.")
+        return content
+
+    if not os.path.exists(xml_file_path):
+        return "File not found"
+    if not os.path.exists(xsl_file_path):
+        return "XSL file {!r} not found!".format(xsl_file_path)
+
+    try:
+        content_key = get_request_content_version(project, xml_file_path, xsl_file_path, parameters)[0]
+    except Exception as e:
+        logger.exception("Error when compiling XSL file")
+        return "Error parsing document" + str(e)
 
+    cache_file_path = get_cache_file_path(project, folder, xml_filename, xsl_filename, content_key)
     logger.debug("Cache file path for {} is {}".format(xml_filename, cache_file_path))
 
+    # content the memory cache or file cache held before it went stale, may be served while new content is rendered
+    stale_content = memory_content_cache.get_stale(memory_cache_key)
     if os.path.exists(cache_file_path):
-        if cache_is_recent(xml_file_path, xsl_file_path, cache_file_path):
-            try:
-                with io.open(cache_file_path, encoding="UTF-8") as cache_file:
-                    content = cache_file.read()
-            except Exception:
-                logger.exception("Error reading content from cache for {}".format(cache_file_path))
-                content = "Error reading content from cache."
-            else:
-                logger.info("Content fetched from cache.")
-        else:
-            logger.info("Cache file is old or invalid, deleting cache file...")
-            os.remove(cache_file_path)
-    if os.path.exists(xml_file_path) and content is None:
-        logger.info("Getting contents from file and transforming...")
         try:
-            content = transform_xml(xsl_file_path, xml_file_path, params=parameters).replace('\n', '').replace('\r', '')
-            try:
-                with io.open(cache_file_path, mode="w", encoding="UTF-8") as cache_file:
-                    cache_file.write(content)
-            except Exception:
-                logger.exception("Could not create cachefile")
-                content = "Successfully fetched content but could not generate cache for it."
-        except Exception as e:
-            logger.exception("Error when parsing XML file")
-            content = "Error parsing document"
-            content += str(e)
-    elif content is None:
-        content = "File not found"
+            cache_file_mtime = os.path.getmtime(cache_file_path)
+            with io.open(cache_file_path, encoding="UTF-8") as cache_file:
+                cached_content = cache_file.read()
+        except Exception:
+            logger.exception("Error reading content from cache for {}".format(cache_file_path))
+            return "Error reading content from cache."
+        if cache_is_recent(cache_file_mtime):
+            logger.info("Content fetched from cache.")
+            content_disk_cache.touch(cache_file_path)
+            memory_content_cache.set(project, memory_cache_key, cached_content, cache_file_mtime, content_key)
+            return cached_content
+        logger.info("Cache file is old, rendering new content...")
+        stale_content = cached_content
+
+    logger.info("Getting contents from file and transforming...")
+
+    def render():
+        return transform_xml(xsl_file_path, xml_file_path, params=parameters, engine=engine).replace('\n', '').replace('\r', '')
+
+    # the cache file path below the cache directory is the same on all replicas
+    shared_cache_key = os.path.relpath(cache_file_path, content_disk_cache.root)
+
+    try:
+        os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+        content, rendered_at = render_to_cache_file(
+            project, cache_file_path, render, stale_content=stale_content,
+            fetch=lambda: get_shared_content(shared_cache_key),
+            publish=lambda new_content, new_rendered_at: set_shared_content(shared_cache_key, new_content, new_rendered_at)
+        )
+    except OSError:
+        logger.exception("Could not create cachefile")
+        return "Successfully fetched content but could not generate cache for it."
+    except Exception as e:
+        logger.exception("Error when parsing XML file")
+        content = "Error parsing document"
+        content += str(e)
+    else:
+        if rendered_at is not None:
+            memory_content_cache.set(project, memory_cache_key, content, rendered_at, content_key)
 
     return content
 
 
+# file extensions of the cached text response bodies for each content coding
+PAYLOAD_FILE_EXTENSIONS = {
+    "br": ".br",
+    "gzip": ".gz",
+    "identity": ""
+}
+
+
+def get_payload_encodings():
+    """
+    Returns the content codings cached text responses are available in, in order of preference
+    """
+    if brotli is not None:
+        return ["br", "gzip", "identity"]
+    return ["gzip", "identity"]
+
+
+def create_payload_response(body, encoding):
+    response = Response(body, status=200, mimetype="application/json")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def get_cached_payload(project, payload_file_path, cache_file_path):
+    """
+    Returns the cached response body 'payload_file_path' belonging to the content cache file 'cache_file_path',
+    or None if it isn't cached or is older than the cache file
+    """
+    def payload_is_valid(entry):
+        try:
+            return entry["created"] == os.path.getmtime(cache_file_path) and cache_is_recent(entry["created"])
+        except OSError:
+            return False
+
+    body = memory_content_cache.get(project, payload_file_path, payload_is_valid)
+    if body is not None:
+        return body
+    try:
+        cache_file_mtime = os.path.getmtime(cache_file_path)
+        if not cache_is_recent(cache_file_mtime) or os.path.getmtime(payload_file_path) < cache_file_mtime:
+            return None
+        with io.open(payload_file_path, mode="rb") as payload_file:
+            body = payload_file.read()
+    except OSError:
+        return None
+    content_disk_cache.touch(cache_file_path)
+    memory_content_cache.set(project, payload_file_path, body, cache_file_mtime, None)
+    return body
+
+
+def get_text_response(project, folder, xml_filename, xsl_filename, parameters, envelope, replace_ids=False):
+    """
+    Returns the same JSON response as jsonify(dict(envelope, content=content)), where 'content' is the text
+    rendered by get_content, with ' id=' replaced with ' data-id=' if 'replace_ids' is True.
+
+    The response body is cached next to the cache file of the content, compressed with gzip and brotli (if installed),
+    so cached responses are served as they are, using the content coding preferred in the Accept-Encoding header.
+    """
+    encoding = request.accept_encodings.best_match(get_payload_encodings(), default="identity")
+    project_config = get_project_config(project)
+    cache_file_path = None
+    payload_file_path = None
+    if project_config is not None:
+        xml_file_path = safe_join(project_config["file_root"], "xml", folder, xml_filename)
+        xsl_file_path = safe_join(project_config["file_root"], "xslt", xsl_filename)
+        try:
+            if os.path.exists(xml_file_path) and os.path.exists(xsl_file_path):
+                content_key = get_request_content_version(project, xml_file_path, xsl_file_path, parameters)[0]
+                cache_file_path = get_cache_file_path(project, folder, xml_filename, xsl_filename, content_key)
+        except Exception:
+            # get_content reports the error in the content
+            cache_file_path = None
+    if cache_file_path is not None:
+        payload_key = hashlib.sha256(json.dumps([envelope, replace_ids], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        payload_file_path = cache_file_path.replace(".html", ".{}.json".format(payload_key[:16]))
+        body = get_cached_payload(project, payload_file_path + PAYLOAD_FILE_EXTENSIONS[encoding], cache_file_path)
+        if body is not None:
+            return create_payload_response(body, encoding)
+
+    content = get_content(project, folder, xml_filename, xsl_filename, parameters)
+    if replace_ids:
+        content = content.replace(" id=", " data-id=")
+    body = current_app.json.response(dict(envelope, content=content)).get_data()
+
+    # only responses with freshly cached content are cached, not error messages or stale content
+    try:
+        cache_file_mtime = os.path.getmtime(cache_file_path) if cache_file_path is not None else None
+    except OSError:
+        cache_file_mtime = None
+    if cache_file_mtime is None or not cache_is_recent(cache_file_mtime):
+        return create_payload_response(body, "identity")
+
+    payloads = {"identity": body, "gzip": gzip.compress(body, compresslevel=9)}
+    if brotli is not None:
+        payloads["br"] = brotli.compress(body, quality=9)
+    try:
+        for payload_encoding, payload in payloads.items():
+            write_file_atomically(payload_file_path + PAYLOAD_FILE_EXTENSIONS[payload_encoding], payload, mode="wb")
+    except OSError:
+        logger.exception("Could not cache response body {}".format(payload_file_path))
+    else:
+        memory_content_cache.set(project, payload_file_path + PAYLOAD_FILE_EXTENSIONS[encoding], payloads[encoding],
+                                 cache_file_mtime, None)
+    return create_payload_response(payloads[encoding], encoding)
+
+
+HTML_VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+
+# stored in section indexes, increase this when the way sections are found changes, so older indexes are rebuilt
+SECTION_INDEX_VERSION = 2
+
+
+class SectionIndexParser(HTMLParser):
+    """
+    Finds the start and end offsets of the elements with an id attribute matching 'id_regex' in the HTML string
+    'content', see index_sections. Elements left unclosed end where their parent element ends.
+    """
+    def __init__(self, content, id_regex):
+        super().__init__(convert_charrefs=False)
+        self.content = content
+        self.id_regex = id_regex
+        self.line_offsets = [0] + [newline.end() for newline in re.finditer("\n", content)]
+        self.sections = {}
+        self.open_elements = []
+
+    def get_offset(self):
+        # the position of the tag being handled, which the parser reports as a line and a column
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+
+    def get_section_id(self, attrs):
+        for name, value in attrs:
+            if name == "id" and value is not None and self.id_regex.match(value):
+                return value
+        return None
+
+    def add_section(self, section_id, start, end):
+        if section_id is not None and section_id not in self.sections:
+            self.sections[section_id] = (start, end)
+
+    def handle_starttag(self, tag, attrs):
+        start = self.get_offset()
+        if tag in HTML_VOID_ELEMENTS:
+            self.add_section(self.get_section_id(attrs), start, start + len(self.get_starttag_text()))
+        else:
+            self.open_elements.append((tag, start, self.get_section_id(attrs)))
+
+    def handle_startendtag(self, tag, attrs):
+        start = self.get_offset()
+        self.add_section(self.get_section_id(attrs), start, start + len(self.get_starttag_text()))
+
+    def handle_endtag(self, tag):
+        end = self.content.index(">", self.get_offset()) + 1
+        # close the matching start tag, and any unclosed elements in between
+        for index in range(len(self.open_elements) - 1, -1, -1):
+            if self.open_elements[index][0] == tag:
+                for _, start, section_id in self.open_elements[index:]:
+                    self.add_section(section_id, start, end)
+                del self.open_elements[index:]
+                break
+
+
+def index_sections(content, section_id_pattern):
+    """
+    Finds all elements in the HTML string 'content' with an id attribute matching the regex 'section_id_pattern',
+    parsing it with html.parser, which (unlike lxml) reports the position of each tag in the string.
+    Returns a dictionary mapping each matching id to the start and end offsets of its element in 'content'.
+    """
+    parser = SectionIndexParser(content, re.compile(section_id_pattern))
+    parser.feed(content)
+    parser.close()
+    return parser.sections
+
+
+def get_section_index(project, folder, xml_filename, xsl_filename, parameters, content, id_pattern=None, index_name="sections"):
+    """
+    Returns the section index for the full rendering 'content' of a document, see index_sections.
+    'id_pattern' defaults to the 'section_id_pattern' of the project, other indexes of the same rendering
+    (such as the note index, see get_note_contents) are told apart by 'index_name'.
+
+    The index is stored next to the cache file of the rendering and kept in the memory cache, so it is
+    built once per rendering. Returns None if the rendering isn't cached.
+    """
+    project_config = get_project_config(project)
+    xml_file_path = safe_join(project_config["file_root"], "xml", folder, xml_filename)
+    xsl_file_path = safe_join(project_config["file_root"], "xslt", xsl_filename)
+    try:
+        content_key = get_request_content_version(project, xml_file_path, xsl_file_path, parameters)[0]
+    except Exception:
+        return None
+    cache_file_path = get_cache_file_path(project, folder, xml_filename, xsl_filename, content_key)
+    index_file_path = cache_file_path.replace(".html", ".{}.json".format(index_name))
+
+    def section_index_is_valid(entry):
+        return cache_is_recent(entry["created"]) and os.path.exists(cache_file_path)
+
+    index = None
+    cached_index = memory_content_cache.get(project, index_file_path, section_index_is_valid)
+    if cached_index is None and os.path.exists(index_file_path) and os.path.exists(cache_file_path):
+        try:
+            with io.open(index_file_path, encoding="UTF-8") as index_file:
+                cached_index = index_file.read()
+        except OSError:
+            logger.exception("Error reading section index from {}".format(index_file_path))
+    if cached_index is not None:
+        index = json.loads(cached_index)
+        # the index belongs to the rendering with the same content key, unless the files changed during this request
+        if index["length"] != len(content) or index.get("version") != SECTION_INDEX_VERSION:
+            index = None
+    if index is None:
+        if not os.path.exists(cache_file_path):
+            return None
+        index = {
+            "version": SECTION_INDEX_VERSION,
+            "length": len(content),
+            "sections": index_sections(content, id_pattern or project_config.get("section_id_pattern", r"^ch\d+"))
+        }
+        cached_index = json.dumps(index)
+        try:
+            write_file_atomically(index_file_path, cached_index)
+        except OSError:
+            logger.exception("Could not write section index {}".format(index_file_path))
+    try:
+        cache_file_mtime = os.path.getmtime(cache_file_path)
+    except OSError:
+        # the rendering was removed from the cache (see DiskCache) while indexing it
+        return None
+    memory_content_cache.set(project, index_file_path, cached_index, cache_file_mtime, content_key)
+    return index["sections"]
+
+
+def get_section_content(project, folder, xml_filename, xsl_filename, parameters, section_id):
+    """
+    Returns the content of section 'section_id' (as passed to the XSLT 'sectionId' parameter) of a document.
+
+    If 'section_slicing' is enabled for the project, the section is sliced out of the cached full rendering
+    of the document, using an index of the elements with ids matching 'section_id_pattern'. Otherwise, or if the
+    section isn't found in the index, the section is rendered by the XSLT using the 'sectionId' parameter.
+    """
+    project_config = get_project_config(project)
+    if project_config is None:
+        return "No such project."
+    section_parameters = dict(parameters or {}, sectionId=section_id)
+    if not project_config.get("section_slicing", False):
+        return get_content(project, folder, xml_filename, xsl_filename, section_parameters)
+
+    content = get_content(project, folder, xml_filename, xsl_filename, parameters)
+    sections = get_section_index(project, folder, xml_filename, xsl_filename, parameters, content)
+    section = sections.get(section_id.strip('"')) if sections is not None else None
+    if section is None:
+        logger.info("Section {} not found in full rendering of {}, transforming section...".format(section_id, xml_filename))
+        return get_content(project, folder, xml_filename, xsl_filename, section_parameters)
+    logger.info("Section {} sliced from full rendering of {}.".format(section_id, xml_filename))
+    return content[section[0]:section[1]]
+
+
+def get_note_contents(project, folder, xml_filename, xsl_filename, note_xsl_filename, parameters, note_ids):
+    """
+    Returns a dictionary mapping each note id in 'note_ids' to the content of the note in a comments document.
+
+    If 'note_slicing' is enabled for the project, the document is rendered once in full using 'xsl_filename', and
+    notes are sliced out of the rendering using an index of the elements with ids matching 'note_id_pattern', stored
+    next to the cache file of the rendering. Otherwise, or if a note isn't found in the index, the note is rendered
+    by 'note_xsl_filename' using the 'noteId' parameter.
+    """
+    project_config = get_project_config(project)
+    if project_config is None:
+        return {note_id: "No such project." for note_id in note_ids}
+
+    notes = None
+    if project_config.get("note_slicing", False):
+        content = get_content(project, folder, xml_filename, xsl_filename, parameters)
+        notes = get_section_index(project, folder, xml_filename, xsl_filename, parameters, content,
+                                  id_pattern=project_config.get("note_id_pattern", r"^en\d+"), index_name="notes")
+
+    note_contents = {}
+    for note_id in note_ids:
+        note = notes.get(note_id) if notes is not None else None
+        if note is not None:
+            note_contents[note_id] = content[note[0]:note[1]]
+        else:
+            note_parameters = dict(parameters or {}, noteId='"{}"'.format(note_id))
+            note_contents[note_id] = get_content(project, folder, xml_filename, note_xsl_filename, note_parameters)
+    if notes is not None:
+        logger.info("{} of {} notes sliced from full rendering of {}.".format(
+            sum(note_id in notes for note_id in note_ids), len(note_ids), xml_filename))
+    return note_contents
+
+
+rendering_executor = None
+rendering_executor_pid = None
+rendering_executor_lock = threading.Lock()
+
+
+def get_rendering_executor():
+    """
+    Returns the thread pool of this worker process used for rendering several texts of a request in parallel,
+    with 'render_workers' threads. lxml releases the GIL while transforming, so the texts are rendered concurrently.
+    """
+    global rendering_executor, rendering_executor_pid
+    with rendering_executor_lock:
+        # threads don't survive forking, a forked worker process needs a pool of its own
+        if rendering_executor is None or rendering_executor_pid != os.getpid():
+            rendering_executor = ThreadPoolExecutor(max_workers=config.get("render_workers", 4),
+                                                    thread_name_prefix="render")
+            rendering_executor_pid = os.getpid()
+        return rendering_executor
+
+
+def get_render_result(key, future):
+    """
+    Returns the result of the finished rendering 'future', or an error message starting with one of
+    RENDER_ERROR_PREFIXES if the rendering raised an exception, so one failed text doesn't fail the whole response
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        logger.exception("Error rendering {}".format(key))
+        return "Error rendering content: {}".format(e)
+
+
+def render_with_budget(renders, budget_seconds=None):
+    """
+    Runs the functions in the dictionary 'renders' on the rendering thread pool, and waits for them for at most
+    'budget_seconds' (default 'render_budget_seconds', 0 or None to wait for all of them).
+
+    Returns a tuple of a dictionary of the results of the functions that finished in time, by the same keys as in
+    'renders', and a list of the keys of the functions that didn't. These keep running in the background, so their
+    results end up in the cache for later requests. A function that raised an exception has an error message as its
+    result (see get_render_result).
+    """
+    if budget_seconds is None:
+        budget_seconds = config.get("render_budget_seconds", 10)
+    executor = get_rendering_executor()
+    futures = {key: executor.submit(render) for key, render in renders.items()}
+    done, _ = wait(futures.values(), timeout=budget_seconds or None)
+    results = {key: get_render_result(key, future) for key, future in futures.items() if future in done}
+    pending = [key for key, future in futures.items() if future not in done]
+    if pending:
+        logger.info("Rendering budget of {} seconds exceeded, {} of {} texts still rendering.".format(
+            budget_seconds, len(pending), len(renders)))
+    return results, pending
+
+
+def render_as_completed(renders):
+    """
+    Runs the functions in the dictionary 'renders' on the rendering thread pool, and yields a tuple of the key
+    and the result of each function as soon as it has finished, as in render_with_budget. If the generator is closed
+    early, the remaining functions keep running in the background, so their results end up in the cache for later requests.
+    """
+    executor = get_rendering_executor()
+    futures = {executor.submit(render): key for key, render in renders.items()}
+    for future in as_completed(futures):
+        yield futures[future], get_render_result(futures[future], future)
+
+
 def update_publication_related_table(
         connection: Connection,
         text_type: str,
@@ -624,36 +2377,175 @@ def get_translation_text_id(translation_id, table_name, field_name, language):
         return None
 
 
-def get_xml_content(project, folder, xml_filename, xsl_filename, parameters):
+def get_x_accel_redirect_location(file_path):
+    """
+    Returns the internal nginx location to send 'file_path' from with X-Accel-Redirect, according to the
+    'x_accel_redirect' setting in the config, or None if the file isn't in any of the directories listed there
+    """
+    absolute_path = os.path.abspath(file_path)
+    for mapping in config.get("x_accel_redirect") or []:
+        root = os.path.join(os.path.abspath(mapping["path"]), "")
+        if absolute_path.startswith(root):
+            return "{}/{}".format(mapping["location"].rstrip("/"), quote(os.path.relpath(absolute_path, root)))
+    return None
+
+
+def create_file_response(file_path, mimetype, download_name=None, as_attachment=False):
+    """
+    Returns a response sending the file 'file_path', for endpoints serving binary files such as facsimile images,
+    after they have checked the file may be shown.
+
+    If the file is in a directory listed in the 'x_accel_redirect' setting in the config, the response only has an
+    X-Accel-Redirect header, and nginx sends the file itself (including conditional and range requests), so the API
+    worker is free as soon as the response is returned. Otherwise, the file is sent with send_file.
+
+    Raises FileNotFoundError (or another OSError) if the file can't be read, like opening it would.
+    """
+    if not file_path:
+        raise FileNotFoundError("No file path given")
+    location = get_x_accel_redirect_location(file_path)
+    if location is None:
+        return send_file(file_path, mimetype=mimetype, download_name=download_name, as_attachment=as_attachment,
+                         conditional=True)
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError("File {} not found".format(file_path))
+    response = Response(status=200, mimetype=mimetype)
+    response.headers["X-Accel-Redirect"] = location
+    if download_name is not None or as_attachment:
+        disposition_name = download_name or os.path.basename(file_path)
+        try:
+            disposition_name.encode("ascii")
+            disposition_options = {"filename": disposition_name}
+        except UnicodeEncodeError:
+            disposition_options = {
+                "filename": unicodedata.normalize("NFKD", disposition_name).encode("ascii", "ignore").decode("ascii"),
+                "filename*": "UTF-8''{}".format(quote(disposition_name, safe=""))
+            }
+        response.headers.set("Content-Disposition", "attachment" if as_attachment else "inline", **disposition_options)
+    return response
+
+
+# times get_downloadable_file is called for a file removed from the cache before it could be opened
+DOWNLOADABLE_FILE_ATTEMPTS = 2
+
+
+def get_downloadable_file(project, folder, xml_filename, xsl_filename, parameters):
+    """
+    Returns a tuple of the path of a file with 'xml_filename' transformed with 'xsl_filename' using 'parameters',
+    and None, or None and an error message if the file can't be rendered. If 'xsl_filename' is None, the path is
+    that of the XML file itself.
+
+    Transformed files are cached in the same cache directory (and shared cache, if any) as the texts rendered by
+    get_content, under the same content cache keys, so each downloadable format is cached separately and is only
+    rendered by one worker at a time. Unlike get_content, line breaks are kept, as they matter in downloaded files.
+    """
     project_config = get_project_config(project)
     if project_config is None:
-        return "No such project."
+        return None, "No such project."
     xml_file_path = safe_join(project_config["file_root"], "xml", folder, xml_filename)
-    if xsl_filename is not None:
-        xsl_file_path = safe_join(project_config["file_root"], "xslt", xsl_filename)
-    else:
-        xsl_file_path = None
+    if xml_file_path is None or not os.path.exists(xml_file_path):
+        return None, "File not found"
+    if xsl_filename is None:
+        return xml_file_path, None
+    xsl_file_path = safe_join(project_config["file_root"], "xslt", xsl_filename)
+    if xsl_file_path is None or not os.path.exists(xsl_file_path):
+        return None, "XSL file {!r} not found!".format(xsl_filename)
+    engine = get_xslt_engine(project)
 
-    if os.path.exists(xml_file_path):
-        logger.info("Getting contents from file ...")
-        if xsl_file_path is not None:
-            try:
-                content = transform_xml(xsl_file_path, xml_file_path, params=parameters)
-            except Exception as e:
-                logger.exception("Error when parsing XML file")
-                content = "Error parsing document"
-                content += str(e)
-        else:
-            try:
-                with io.open(xml_file_path, encoding="UTF-8") as xml_file:
-                    content = xml_file.read()
-            except Exception as e:
+    content_disk_cache.start_sweeper()
+    try:
+        content_key = get_content_cache_key(xml_file_path, xsl_file_path, parameters, engine)
+    except Exception as e:
+        logger.exception("Error when compiling XSL file")
+        return None, "Error parsing document" + str(e)
+
+    cache_file_path = get_cache_file_path(project, folder, xml_filename, xsl_filename, content_key)
+    try:
+        if cache_is_recent(os.path.getmtime(cache_file_path)):
+            logger.info("Downloadable file fetched from cache.")
+            content_disk_cache.touch(cache_file_path)
+            return cache_file_path, None
+        # the expired file may be served while another worker renders it again, see render_to_cache_file
+        stale_file_path = cache_file_path
+    except OSError:
+        stale_file_path = None
+
+    logger.info("Getting contents from file and transforming...")
+    shared_cache_key = os.path.relpath(cache_file_path, content_disk_cache.root)
+    try:
+        os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+        # only the cache file is used, not the content returned, so the stale "content" is the path of the stale file
+        render_to_cache_file(
+            project, cache_file_path,
+            lambda: transform_xml(xsl_file_path, xml_file_path, params=parameters, engine=engine),
+            stale_content=stale_file_path,
+            fetch=lambda: get_shared_content(shared_cache_key),
+            publish=lambda new_content, new_rendered_at: set_shared_content(shared_cache_key, new_content, new_rendered_at)
+        )
+    except OSError:
+        logger.exception("Could not create cachefile")
+        return None, "Successfully fetched content but could not generate cache for it."
+    except Exception as e:
+        logger.exception("Error when parsing XML file")
+        return None, "Error parsing document" + str(e)
+    return cache_file_path, None
+
+
+def get_xml_content(project, folder, xml_filename, xsl_filename, parameters):
+    """
+    Returns the content of the file get_downloadable_file returns, or an error message
+    """
+    # the file may be evicted from the cache before it's opened, in which case it's rendered again once
+    for attempt in range(DOWNLOADABLE_FILE_ATTEMPTS):
+        file_path, error = get_downloadable_file(project, folder, xml_filename, xsl_filename, parameters)
+        if error is not None:
+            return error
+        try:
+            with io.open(file_path, encoding="UTF-8") as downloadable_file:
+                return downloadable_file.read()
+        except FileNotFoundError as e:
+            if attempt == DOWNLOADABLE_FILE_ATTEMPTS - 1:
                 logger.exception("Error opening/reading XML file")
-                content = "Error opening/reading XML file"
-                content += str(e)
-    else:
-        content = "File not found"
-    return content
+                return "Error opening/reading XML file" + str(e)
+            logger.warning("Downloadable file {} was removed from the cache, rendering it again.".format(file_path))
+        except Exception as e:
+            logger.exception("Error opening/reading XML file")
+            return "Error opening/reading XML file" + str(e)
+
+
+def get_downloadable_file_response(project, folder, xml_filename, xsl_filename, parameters, extra, download_name, mimetype):
+    """
+    Returns the file get_downloadable_file returns as a file download named 'download_name', streamed from disk with
+    Content-Length, range request support, and the ETag and Last-Modified validators get_text_validators returns
+    for the transformation and 'extra'. Returns a JSON response with 'extra' and the error if the file can't be rendered.
+    """
+    etag, last_modified = get_text_validators(project, [(folder, xml_filename, xsl_filename, parameters)],
+                                              dict(extra, download_name=download_name))
+    if etag is not None and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    # the file may be evicted from the cache before send_file opens it, in which case it's rendered again once
+    for attempt in range(DOWNLOADABLE_FILE_ATTEMPTS):
+        file_path, error = get_downloadable_file(project, folder, xml_filename, xsl_filename, parameters)
+        if error is not None:
+            status = 404 if error in ("No such project.", "File not found") else 500
+            return jsonify(dict(extra, error=error)), status
+        try:
+            response = send_file(file_path, mimetype=mimetype, as_attachment=True,
+                                 download_name=download_name, conditional=True,
+                                 etag=etag if etag is not None else True, last_modified=last_modified)
+        except FileNotFoundError:
+            logger.warning("Downloadable file {} was removed from the cache, rendering it again.".format(file_path))
+            continue
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    response = jsonify(dict(extra, error="The file was removed from the cache while being sent, try again."))
+    response.headers["Retry-After"] = "1"
+    return response, 503
 
 
 # Recursive function for flattening the given json, i.e. turning it into a one dimensional array, which is stored in "flattened"
@@ -1,14 +1,19 @@
-from flask import Blueprint, jsonify, Response, send_file, make_response, request
+from flask import Blueprint, jsonify, Response, make_response, request
 import io
 import logging
+import os
 import sqlalchemy
 from werkzeug.security import safe_join
 
-from sls_api.endpoints.generics import db_engine, get_project_config, get_project_id_from_name, get_allowed_cors_origins
+from sls_api.endpoints.generics import create_file_response, db_engine, get_image_derivative, get_project_config, \
+    get_project_id_from_name, get_allowed_cors_origins
 
 media = Blueprint('media', __name__)
 logger = logging.getLogger("sls_api.media")
 
+# width of the thumbnails made for gallery images without a pre-made _thumb.jpg
+GALLERY_THUMBNAIL_WIDTH = 300
+
 # Media and Gallery functions
 
 
@@ -292,7 +297,12 @@ def get_galleries(project, lang=None):
 
 
 @media.route("/<project>/gallery/get/<collection_id>/<file_name>")
-def get_gallery_image(project, collection_id, file_name):
+@media.route("/<project>/gallery/get/<collection_id>/<file_name>/width/<int:width>")
+def get_gallery_image(project, collection_id, file_name, width=None):
+    """
+    Returns a gallery image, or a derivative of it 'width' pixels wide (snapped to one of the widths allowed by
+    'derivative_widths' in the config, see get_image_derivative) if a width is given
+    """
     logger.info("Getting galleries")
     try:
         project_id = get_project_id_from_name(project)
@@ -311,12 +321,9 @@ def get_gallery_image(project, collection_id, file_name):
             return Response("Couldn't get gallery file.", status=404, content_type="text/json")
         file_path = safe_join(config["file_root"], "media", str(result['image_path']), "{}".format(str(file_name)))
         try:
-            output = io.BytesIO()
-            with open(file_path, mode="rb") as img_file:
-                output.write(img_file.read())
-            content = output.getvalue()
-            output.close()
-            return Response(content, status=200, content_type="image/jpeg")
+            if width:
+                file_path = get_image_derivative(project, "gallery", [file_path], width)
+            return create_file_response(file_path, "image/jpeg")
         except Exception:
             logger.exception(f"Failed to read from image file at {file_path}")
             return Response("File not found: " + file_path, status=404, content_type="text/json")
@@ -326,7 +333,13 @@ def get_gallery_image(project, collection_id, file_name):
 
 
 @media.route("/<project>/gallery/thumb/<connection_type>/<connection_id>")
-def get_type_gallery_image(project, connection_type, connection_id):
+@media.route("/<project>/gallery/thumb/<connection_type>/<connection_id>/width/<int:width>")
+def get_type_gallery_image(project, connection_type, connection_id, width=None):
+    """
+    Returns the thumbnail of the first gallery image of a tag, location or subject: the pre-made _thumb.jpg next to
+    the image if there is one, otherwise a derivative of the image GALLERY_THUMBNAIL_WIDTH pixels wide.
+    If 'width' is given, returns a derivative of the image that wide instead (see get_gallery_image).
+    """
     logger.info("Getting gallery file")
     if connection_type not in ['tag', 'location', 'subject']:
         return Response("Couldn't get media connection data.", status=404, content_type="text/json")
@@ -351,15 +364,15 @@ def get_type_gallery_image(project, connection_type, connection_id):
             connection.close()
             logger.error(f"Failed to get gallery file for {connection_type} {connection_id} (database returned None)")
             return Response("Couldn't get type file.", status=404, content_type="text/json")
+        image_file_path = safe_join(config["file_root"], "media", str(result['image_path']), str(result['image_filename_front']))
         file_path = safe_join(config["file_root"], "media", str(result['image_path']),
                               str(result['image_filename_front']).replace(".jpg", "_thumb.jpg"))
         try:
-            output = io.BytesIO()
-            with open(file_path, mode="rb") as img_file:
-                output.write(img_file.read())
-            content = output.getvalue()
-            output.close()
-            return Response(content, status=200, content_type="image/jpeg")
+            if width:
+                file_path = get_image_derivative(project, "gallery", [image_file_path], width)
+            elif file_path is None or not os.path.isfile(file_path):
+                file_path = get_image_derivative(project, "gallery", [image_file_path], GALLERY_THUMBNAIL_WIDTH)
+            return create_file_response(file_path, "image/jpeg")
         except Exception:
             logger.exception(f"Failed to read from image file at {file_path}")
             return Response("File not found: " + file_path, status=404, content_type="text/json")
@@ -459,7 +472,7 @@ def get_pdf_file(project, collection_id, file_type, download_name, use_download_
 
     try:
         response = make_response(
-            send_file(file_path, mimetype=mimetype, download_name=download_name, conditional=True)
+            create_file_response(file_path, mimetype, download_name=download_name)
         )
         # Dynamically set the Access-Control-Allow-Origin header
         # to the request origin if the origin is defined in the list
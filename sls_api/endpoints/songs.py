@@ -1,9 +1,9 @@
-from flask import Blueprint, jsonify, Response, request, send_file
+from flask import Blueprint, jsonify, Response, request
 import logging
 import sqlalchemy
 from werkzeug.security import safe_join
 
-from sls_api.endpoints.generics import db_engine, get_project_config
+from sls_api.endpoints.generics import create_file_response, db_engine, get_project_config
 
 songs = Blueprint('songs', __name__)
 logger = logging.getLogger("sls_api.songs")
@@ -179,8 +179,7 @@ def get_song_file(project, file_type, file_name):
                               "{}.mid".format(str(file_name)))
 
     try:
-        return send_file(file_path, as_attachment=True, mimetype='application/octet-stream',
-                         download_name=file_name)
+        return create_file_response(file_path, 'application/octet-stream', download_name=file_name, as_attachment=True)
     except Exception:
         logger.exception(f"Failed sending file from {file_path}")
         return Response("File not found.", status=404, content_type="text/json")
@@ -1,14 +1,151 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, current_app, jsonify, request, Response, stream_with_context, url_for
 import logging
 import sqlalchemy
 from werkzeug.security import safe_join
 
 from sls_api.endpoints.generics import db_engine, get_collection_published_status, get_content, get_xml_content, \
-    get_project_config, get_published_status, get_collection_legacy_id
+    get_project_config, get_published_status, get_collection_legacy_id, get_section_content, get_text_response, \
+    get_conditional_text_response, create_conditional_json_response, get_note_contents, render_with_budget, \
+    render_as_completed, get_downloadable_file_response, RENDER_ERROR_PREFIXES
+from sls_api.endpoints.correspondence import get_publication_correspondence_metadata
+from sls_api.endpoints.facsimiles import get_publication_facsimiles
 
 text = Blueprint('text', __name__)
 logger = logging.getLogger("sls_api.text")
 
+
+# Helpers for the XML filenames and XSLT parameters of publication texts.
+# These are also used by the cache pre-warming script, so cache keys for pre-rendered texts match those of requests.
+
+def get_book_id_parameter(collection_id):
+    """
+    Returns the 'bookId' XSLT parameter for a collection, the collection legacy_id if set, otherwise the collection id
+    """
+    book_id = get_collection_legacy_id(collection_id)
+    if book_id is None:
+        book_id = collection_id
+    return '"{}"'.format(book_id)
+
+
+def get_reading_text_filename(collection_id, publication_id, legacy_id=None, language=None):
+    """
+    Returns the filename of the reading text (est) XML file for a publication.
+    'legacy_id' should be the publication legacy_id if the publication has no original_filename set.
+    """
+    if legacy_id is None or language is not None:
+        filename = "{}_{}_est.xml".format(collection_id, publication_id)
+        if language is not None:
+            filename = "{}_{}_{}_est.xml".format(collection_id, publication_id, language)
+    else:
+        filename = "{}_est.xml".format(legacy_id)
+    return filename
+
+
+def get_comment_filename(collection_id, publication_id, comment_legacy_id=None):
+    """
+    Returns the filename of the comments (com) XML file for a publication.
+    'comment_legacy_id' should be the publication_comment legacy_id if the comment has no original_filename set.
+    """
+    if comment_legacy_id is not None:
+        return "{}_com.xml".format(comment_legacy_id)
+    return "{}_{}_com.xml".format(collection_id, publication_id)
+
+
+def get_comment_legacy_id(publication_id):
+    """
+    Returns the publication_comment legacy_id of a publication, if its comment has no original_filename set
+    """
+    connection = db_engine.connect()
+    select = "SELECT legacy_id FROM publication_comment WHERE id IN (SELECT publication_comment_id FROM publication WHERE id = :p_id) \
+                AND legacy_id IS NOT NULL AND original_filename IS NULL"
+    statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
+    result = connection.execute(statement).fetchone()
+    connection.close()
+    return result.legacy_id if result is not None else None
+
+
+def get_comment_parameters(config, filename, book_id):
+    """
+    Returns the XSLT parameters for rendering the comments file 'filename'
+    """
+    return {
+        "estDocument": '"file://{}"'.format(safe_join(config["file_root"], "xml", "est", filename.replace("com", "est"))),
+        "bookId": book_id
+    }
+
+
+def get_manuscript_filename(collection_id, publication_id, manuscript):
+    """
+    Returns the filename of the manuscript (ms) XML file for a publication_manuscript row (as a dictionary)
+    """
+    if manuscript["original_filename"] is None and manuscript["legacy_id"] is not None:
+        return "{}.xml".format(manuscript["legacy_id"])
+    return "{}_{}_ms_{}.xml".format(collection_id, publication_id, manuscript["id"])
+
+
+def get_variant_filename(collection_id, publication_id, variant):
+    """
+    Returns the filename of the variant (var) XML file for a publication_version row (as a dictionary)
+    """
+    if variant["original_filename"] is None and variant["legacy_id"] is not None:
+        return "{}.xml".format(variant["legacy_id"])
+    return "{}_{}_var_{}.xml".format(collection_id, publication_id, variant["id"])
+
+
+def get_variant_xsl_filename(variant):
+    """
+    Returns the XSL stylesheet used for a publication_version row (as a dictionary), based on the variant type
+    """
+    if variant["type"] == 1:
+        return "poem_variants_est.xsl"
+    return "poem_variants_other.xsl"
+
+
+# maximum number of notes in one com/notes request
+MAX_NOTES_PER_REQUEST = 500
+
+# the renderings of manuscripts, selected with the 'views' query parameter of the ms endpoint
+MANUSCRIPT_VIEWS = {
+    "changes": ("manuscript_changes", "ms_changes.xsl"),
+    "normalized": ("manuscript_normalized", "ms_normalized.xsl")
+}
+
+
+# response modes of the var endpoint, selected with the 'mode' query parameter
+VARIANT_MODES = ("full", "summary", "stream")
+
+
+# the parts of a publication the bundle endpoint can return, selected with the 'include' query parameter
+BUNDLE_PARTS = ("est", "com", "ms", "var", "facs", "correspondence")
+DEFAULT_BUNDLE_PARTS = ("est", "com", "ms", "var", "facs")
+
+
+def get_list_query_parameter(name):
+    """
+    Returns the comma-separated values of the query parameter 'name' as a list, or None if the parameter isn't given
+    """
+    if name not in request.args:
+        return None
+    return [value.strip() for value in request.args[name].split(",") if value.strip()]
+
+
+# media types of the downloadable text formats, other formats are served as the XML file
+DOWNLOADABLE_MIMETYPES = {
+    "xml": "application/xml",
+    "txt": "text/plain"
+}
+
+
+def wants_downloadable_file(mimetype):
+    """
+    Returns True if the request asks for a downloadable text as a file, with the 'download' query parameter or by
+    preferring 'mimetype' over JSON in the Accept header, instead of the content embedded in a JSON response
+    """
+    if request.args.get("download", "").lower() in ("1", "true"):
+        return True
+    return request.accept_mimetypes.best_match(["application/json", mimetype]) == mimetype
+
+
 # Text functions
 
 
@@ -34,7 +171,7 @@ def get_text_by_type(project, text_type, text_id):
         if row is not None:
             results.append(row._asdict())
     connection.close()
-    return jsonify(results)
+    return create_conditional_json_response(results)
 
 
 @text.route("/<project>/text/<collection_id>/<publication_id>/inl")
@@ -54,12 +191,14 @@ def get_introduction(project, collection_id, publication_id, lang="swe"):
             # TODO get original_filename from publication_collection_introduction table? how handle language/version
             filename = "{}_inl_{}_{}.xml".format(collection_id, lang, version)
             xsl_file = "introduction.xsl"
-            content = get_content(project, "inl", filename, xsl_file, None)
             data = {
-                "id": "{}_{}_inl".format(collection_id, publication_id),
-                "content": content.replace(" id=", " data-id=")
+                "id": "{}_{}_inl".format(collection_id, publication_id)
             }
-            return jsonify(data), 200
+            return get_conditional_text_response(
+                project, [("inl", filename, xsl_file, None)], data,
+                lambda: get_text_response(project, "inl", filename, xsl_file, None, data, replace_ids=True),
+                compressed=True
+            )
         else:
             return jsonify({
                 "id": "{}_{}".format(collection_id, publication_id),
@@ -84,12 +223,14 @@ def get_title(project, collection_id, publication_id, lang="swe"):
             # TODO get original_filename from publication_collection_title table? how handle language/version
             filename = "{}_tit_{}_{}.xml".format(collection_id, lang, version)
             xsl_file = "title.xsl"
-            content = get_content(project, "tit", filename, xsl_file, None)
             data = {
-                "id": "{}_{}_tit".format(collection_id, publication_id),
-                "content": content.replace(" id=", " data-id=")
+                "id": "{}_{}_tit".format(collection_id, publication_id)
             }
-            return jsonify(data), 200
+            return get_conditional_text_response(
+                project, [("tit", filename, xsl_file, None)], data,
+                lambda: get_text_response(project, "tit", filename, xsl_file, None, data, replace_ids=True),
+                compressed=True
+            )
         else:
             return jsonify({
                 "id": "{}_{}".format(collection_id, publication_id),
@@ -114,12 +255,14 @@ def get_foreword(project, collection_id, lang="sv"):
             # TODO get original_filename from database table? how handle language/version
             filename = "{}_fore_{}_{}.xml".format(collection_id, lang, version)
             xsl_file = "foreword.xsl"
-            content = get_content(project, "fore", filename, xsl_file, None)
             data = {
-                "id": "{}_fore".format(collection_id),
-                "content": content.replace(" id=", " data-id=")
+                "id": "{}_fore".format(collection_id)
             }
-            return jsonify(data), 200
+            return get_conditional_text_response(
+                project, [("fore", filename, xsl_file, None)], data,
+                lambda: get_text_response(project, "fore", filename, xsl_file, None, data, replace_ids=True),
+                compressed=True
+            )
         else:
             return jsonify({
                 "id": "{}".format(collection_id),
@@ -141,31 +284,18 @@ def get_reading_text(project, collection_id, publication_id, section_id=None, la
         select = "SELECT legacy_id FROM publication WHERE id = :p_id AND original_filename IS NULL"
         statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
         result = connection.execute(statement).fetchone()
-        if result is None or language is not None:
-            filename = "{}_{}_est.xml".format(collection_id, publication_id)
-            if language is not None:
-                filename = "{}_{}_{}_est.xml".format(collection_id, publication_id, language)
-                logger.debug("Filename (est) for {} is {}".format(publication_id, filename))
-        else:
-            filename = "{}_est.xml".format(result.legacy_id)
+        filename = get_reading_text_filename(collection_id, publication_id,
+                                             legacy_id=result.legacy_id if result is not None else None,
+                                             language=language)
         logger.debug("Filename (est) for {} is {}".format(publication_id, filename))
         xsl_file = "est.xsl"
 
-        bookId = get_collection_legacy_id(collection_id)
-        if bookId is None:
-            bookId = collection_id
-        bookId = '"{}"'.format(bookId)
-
-        if section_id is not None:
-            section_id = '"{}"'.format(section_id)
-            content = get_content(project, "est", filename, xsl_file,
-                                  {"bookId": bookId, "sectionId": section_id})
-        else:
-            content = get_content(project, "est", filename, xsl_file, {"bookId": bookId})
+        bookId = get_book_id_parameter(collection_id)
 
         select = "SELECT language FROM publication WHERE id = :p_id"
         statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
         result = connection.execute(statement).fetchone()
+        connection.close()
 
         text_language = ""
         if result is not None and result.language is not None:
@@ -173,12 +303,25 @@ def get_reading_text(project, collection_id, publication_id, section_id=None, la
 
         data = {
             "id": "{}_{}_est".format(collection_id, publication_id),
-            "content": content.replace(" id=", " data-id="),
             "language": text_language
         }
-        connection.close()
 
-        return jsonify(data), 200
+        params = {"bookId": bookId}
+        sources = [("est", filename, xsl_file, params)]
+        if section_id is None:
+            return get_conditional_text_response(
+                project, sources, data,
+                lambda: get_text_response(project, "est", filename, xsl_file, params, data, replace_ids=True),
+                compressed=True
+            )
+
+        section_id = '"{}"'.format(section_id)
+
+        def create_section_response():
+            content = get_section_content(project, "est", filename, xsl_file, params, section_id)
+            return jsonify(dict(data, content=content.replace(" id=", " data-id="))), 200
+
+        return get_conditional_text_response(project, sources, dict(data, section_id=section_id), create_section_response)
     else:
         return jsonify({
             "id": "{}_{}".format(collection_id, publication_id),
@@ -200,52 +343,40 @@ def get_comments(project, collection_id, publication_id, note_id=None, section_i
         can_show, message = get_published_status(project, collection_id, publication_id)
         if can_show:
             logger.info("Getting XML for {} and transforming...".format(request.full_path))
-            connection = db_engine.connect()
-            select = "SELECT legacy_id FROM publication_comment WHERE id IN (SELECT publication_comment_id FROM publication WHERE id = :p_id) \
-                        AND legacy_id IS NOT NULL AND original_filename IS NULL"
-            statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
-            result = connection.execute(statement).fetchone()
-
-            bookId = get_collection_legacy_id(collection_id)
-            if bookId is None:
-                bookId = collection_id
+            bookId = get_book_id_parameter(collection_id)
 
-            bookId = '"{}"'.format(bookId)
-
-            if result is not None:
-                filename = "{}_com.xml".format(result.legacy_id)
-                connection.close()
-            else:
-                filename = "{}_{}_com.xml".format(collection_id, publication_id)
-                connection.close()
+            filename = get_comment_filename(collection_id, publication_id,
+                                            comment_legacy_id=get_comment_legacy_id(publication_id))
             logger.debug("Filename (com) for {} is {}".format(publication_id, filename))
-            params = {
-                "estDocument": '"file://{}"'.format(safe_join(config["file_root"], "xml", "est", filename.replace("com", "est"))),
-                "bookId": bookId
-            }
+            params = get_comment_parameters(config, filename, bookId)
+            xsl_file = "com.xsl"
 
+            data = {
+                "id": "{}_{}_com".format(collection_id, publication_id)
+            }
+            sources = [("com", filename, xsl_file, params)]
             if note_id is not None and section_id is None:
-                params["noteId"] = '"{}"'.format(note_id)
-                xsl_file = "notes.xsl"
-            else:
-                xsl_file = "com.xsl"
+                # notes may be sliced from the full comments, or rendered by notes.xsl
+                sources.append(("com", filename, "notes.xsl", dict(params, noteId='"{}"'.format(note_id))))
+
+                def create_note_response():
+                    content = get_note_contents(project, "com", filename, xsl_file, "notes.xsl", params, [note_id])[note_id]
+                    return jsonify(dict(data, content=content)), 200
+
+                return get_conditional_text_response(project, sources, dict(data, note_id=note_id), create_note_response)
+            if section_id is None and note_id is None:
+                return get_conditional_text_response(
+                    project, sources, data,
+                    lambda: get_text_response(project, "com", filename, xsl_file, params, data),
+                    compressed=True
+                )
+            section_id = '"{}"'.format(section_id)
 
-            if section_id is not None:
-                section_id = '"{}"'.format(section_id)
-                content = get_content(project, "com", filename, xsl_file, {
-                    "sectionId": str(section_id),
-                    "estDocument": '"file://{}"'.format(safe_join(config["file_root"], "xml", "est", filename.replace("com", "est"))),
-                    "bookId": bookId
-                })
-            else:
-                content = get_content(project, "com", filename, xsl_file, params)
+            def create_comments_response():
+                content = get_section_content(project, "com", filename, xsl_file, params, section_id)
+                return jsonify(dict(data, content=content)), 200
 
-            data = {
-                "id": "{}_{}_com".format(collection_id, publication_id),
-                "content": content
-            }
-            connection.close()
-            return jsonify(data), 200
+            return get_conditional_text_response(project, sources, dict(data, section_id=section_id), create_comments_response)
         else:
             return jsonify({
                 "id": "{}_{}".format(collection_id, publication_id),
@@ -253,6 +384,48 @@ def get_comments(project, collection_id, publication_id, note_id=None, section_i
             }), 403
 
 
+@text.route("/<project>/text/<collection_id>/<publication_id>/com/notes")
+def get_comment_notes(project, collection_id, publication_id):
+    """
+    Get several notes from the comments file of a given publication, with the note ids given as a comma-separated
+    list in the 'ids' query parameter, e.g. com/notes?ids=en1,en2.
+    Returns the content of each note keyed by note id under 'notes'.
+    """
+    config = get_project_config(project)
+    if config is None:
+        return jsonify({"msg": "No such project."}), 400
+    note_ids = []
+    for note_id in request.args.get("ids", "").split(","):
+        note_id = note_id.strip()
+        if note_id and note_id not in note_ids:
+            note_ids.append(note_id)
+    if not note_ids:
+        return jsonify({"msg": "No note ids given, use the 'ids' query parameter."}), 400
+    if len(note_ids) > MAX_NOTES_PER_REQUEST:
+        return jsonify({"msg": "At most {} notes can be requested at a time.".format(MAX_NOTES_PER_REQUEST)}), 400
+
+    can_show, message = get_published_status(project, collection_id, publication_id)
+    if not can_show:
+        return jsonify({
+            "id": "{}_{}".format(collection_id, publication_id),
+            "error": message
+        }), 403
+
+    filename = get_comment_filename(collection_id, publication_id,
+                                    comment_legacy_id=get_comment_legacy_id(publication_id))
+    params = get_comment_parameters(config, filename, get_book_id_parameter(collection_id))
+    data = {
+        "id": "{}_{}_com".format(collection_id, publication_id)
+    }
+    sources = [("com", filename, "com.xsl", params), ("com", filename, "notes.xsl", params)]
+
+    def create_notes_response():
+        notes = get_note_contents(project, "com", filename, "com.xsl", "notes.xsl", params, note_ids)
+        return jsonify(dict(data, notes=notes)), 200
+
+    return get_conditional_text_response(project, sources, dict(data, note_ids=note_ids), create_notes_response)
+
+
 @text.route("/<project>/text/<collection_id>/<publication_id>/list/ms")
 @text.route("/<project>/text/<collection_id>/<publication_id>/list/ms/<section_id>")
 def get_manuscript_list(project, collection_id, publication_id, section_id=None):
@@ -284,7 +457,7 @@ def get_manuscript_list(project, collection_id, publication_id, section_id=None)
             "id": "{}_{}".format(collection_id, publication_id),
             "manuscripts": manuscript_info
         }
-        return jsonify(data), 200
+        return create_conditional_json_response(data)
     else:
         return jsonify({
             "id": "{}_{}_ms".format(collection_id, publication_id),
@@ -298,7 +471,24 @@ def get_manuscript_list(project, collection_id, publication_id, section_id=None)
 def get_manuscript(project, collection_id, publication_id, manuscript_id=None, section_id=None):
     """
     Get one or all manuscripts for a given publication
+
+    Optional query parameters:
+    - views: comma-separated renderings to include, 'changes' and/or 'normalized' (default both),
+      or 'none' for only the manuscript metadata
+    - ids: comma-separated manuscript ids to include (default all manuscripts of the publication)
+
+    Renderings not finished within the rendering budget ('render_budget_seconds') are left out, and the manuscript
+    gets the URL to fetch them from later instead, e.g. 'manuscript_changes_url' instead of 'manuscript_changes'.
     """
+    views = get_list_query_parameter("views")
+    if views is None:
+        views = list(MANUSCRIPT_VIEWS)
+    elif views == ["none"]:
+        views = []
+    elif not views or any(view not in MANUSCRIPT_VIEWS for view in views):
+        return jsonify({"msg": "Invalid views, must be 'none' or one or more of {}.".format(", ".join(MANUSCRIPT_VIEWS))}), 400
+    manuscript_ids = get_list_query_parameter("ids")
+
     can_show, message = get_published_status(project, collection_id, publication_id)
     if can_show:
         logger.info("Getting XML for {} and transforming...".format(request.full_path))
@@ -320,42 +510,64 @@ def get_manuscript(project, collection_id, publication_id, manuscript_id=None, s
                     manuscript_info.append(row._asdict())
             connection.close()
 
-        bookId = get_collection_legacy_id(collection_id)
-        if bookId is None:
-            bookId = collection_id
+        if manuscript_ids is not None:
+            manuscript_info = [manuscript for manuscript in manuscript_info if str(manuscript["id"]) in manuscript_ids]
+
+        bookId = get_book_id_parameter(collection_id)
+        params = {
+            "bookId": bookId
+        }
+        url_section_id = section_id
+        if section_id is not None:
+            section_id = '"{}"'.format(section_id)
+        elif manuscript_id is not None and 'ch' in str(manuscript_id):
+            url_section_id = manuscript_id
+            section_id = '"{}"'.format(manuscript_id)
 
-        bookId = '"{}"'.format(bookId)
+        manuscript_views = [MANUSCRIPT_VIEWS[view] for view in views]
+        sources = [
+            ("ms", get_manuscript_filename(collection_id, publication_id, manuscript), xsl_file, params)
+            for manuscript in manuscript_info for _, xsl_file in manuscript_views
+        ]
 
-        for index in range(len(manuscript_info)):
-            manuscript = manuscript_info[index]
+        def render_manuscript(filename, xsl_file):
             if section_id is not None:
-                section_id = '"{}"'.format(section_id)
-                params = {
-                    "bookId": bookId,
-                    "sectionId": str(section_id)
-                }
-            elif manuscript_id is not None and 'ch' in str(manuscript_id):
-                section_id = '"{}"'.format(manuscript_id)
-                params = {
-                    "bookId": bookId,
-                    "sectionId": str(section_id)
-                }
+                content = get_section_content(project, "ms", filename, xsl_file, params, str(section_id))
             else:
-                params = {
-                    "bookId": bookId
-                }
-            if manuscript["original_filename"] is None and manuscript["legacy_id"] is not None:
-                filename = "{}.xml".format(manuscript["legacy_id"])
-            else:
-                filename = "{}_{}_ms_{}.xml".format(collection_id, publication_id, manuscript["id"])
-            manuscript_info[index]["manuscript_changes"] = get_content(project, "ms", filename, "ms_changes.xsl", params).replace(" id=", " data-id=")
-            manuscript_info[index]["manuscript_normalized"] = get_content(project, "ms", filename, "ms_normalized.xsl", params).replace(" id=", " data-id=")
+                content = get_content(project, "ms", filename, xsl_file, params)
+            return content.replace(" id=", " data-id=")
+
+        def create_manuscripts_response():
+            renders = {}
+            for index, manuscript in enumerate(manuscript_info):
+                filename = get_manuscript_filename(collection_id, publication_id, manuscript)
+                for view in views:
+                    xsl_file = MANUSCRIPT_VIEWS[view][1]
+                    renders[(index, view)] = lambda filename=filename, xsl_file=xsl_file: render_manuscript(filename, xsl_file)
+            contents, pending = render_with_budget(renders)
+
+            for (index, view), content in contents.items():
+                manuscript_info[index][MANUSCRIPT_VIEWS[view][0]] = content
+            for index, view in pending:
+                manuscript_info[index][MANUSCRIPT_VIEWS[view][0] + "_url"] = url_for(
+                    "text.get_manuscript", project=project, collection_id=collection_id, publication_id=publication_id,
+                    manuscript_id=manuscript_info[index]["id"], section_id=url_section_id, views=view
+                )
 
-        data = {
-            "id": "{}_{}".format(collection_id, publication_id),
-            "manuscripts": manuscript_info
-        }
-        return jsonify(data), 200
+            data = {
+                "id": "{}_{}".format(collection_id, publication_id),
+                "manuscripts": manuscript_info
+            }
+            response = jsonify(data)
+            if pending:
+                # the rest of the renderings are fetched separately, so this response shouldn't be reused
+                response.headers["Cache-Control"] = "no-store"
+            return response, 200
+
+        return get_conditional_text_response(
+            project, sources, {"manuscripts": manuscript_info, "section_id": section_id, "views": views},
+            create_manuscripts_response
+        )
     else:
         return jsonify({
             "id": "{}_{}_ms".format(collection_id, publication_id),
@@ -368,7 +580,22 @@ def get_manuscript(project, collection_id, publication_id, manuscript_id=None, s
 def get_variant(project, collection_id, publication_id, section_id=None):
     """
     Get all variants for a given publication, optionally specifying a section (chapter)
+
+    Optional query parameters:
+    - mode: 'full' (default) for the variants with their content, 'summary' for the variant metadata with the URL
+      of the content of each variant as 'content_url', or 'stream' for newline-delimited JSON, with the id of the
+      publication and the number of variants on the first line, followed by each variant (with its position in the
+      list as 'index') on a line of its own as soon as it has been rendered
+    - ids: comma-separated variant ids to include (default all variants of the publication)
+
+    In 'full' mode, variants not rendered within the rendering budget ('render_budget_seconds') get a 'content_url'
+    instead of 'content'.
     """
+    mode = request.args.get("mode", "full")
+    if mode not in VARIANT_MODES:
+        return jsonify({"msg": "Invalid mode, must be one of {}.".format(", ".join(VARIANT_MODES))}), 400
+    variant_ids = get_list_query_parameter("ids")
+
     can_show, message = get_published_status(project, collection_id, publication_id)
     if can_show:
         logger.info("Getting XML for {} and transforming...".format(request.full_path))
@@ -380,43 +607,78 @@ def get_variant(project, collection_id, publication_id, section_id=None):
             if row is not None:
                 variation_info.append(row._asdict())
         connection.close()
+        if variant_ids is not None:
+            variation_info = [variation for variation in variation_info if str(variation["id"]) in variant_ids]
 
-        bookId = get_collection_legacy_id(collection_id)
-        if bookId is None:
-            bookId = collection_id
-
-        bookId = '"{}"'.format(bookId)
+        bookId = get_book_id_parameter(collection_id)
+        params = {
+            "bookId": bookId
+        }
+        url_section_id = section_id
         if section_id is not None:
             section_id = '"{}"'.format(section_id)
-            params = {
-                "bookId": bookId,
-                "sectionId": str(section_id)
-            }
-        else:
-            params = {
-                "bookId": bookId
-            }
 
-        for index in range(len(variation_info)):
-            variation = variation_info[index]
-
-            if variation["type"] == 1:
-                xsl_file = "poem_variants_est.xsl"
-            else:
-                xsl_file = "poem_variants_other.xsl"
+        def get_content_url(variation):
+            return url_for("text.get_variant", project=project, collection_id=collection_id, publication_id=publication_id,
+                           section_id=url_section_id, ids=variation["id"])
+
+        if mode == "summary":
+            for variation in variation_info:
+                variation["content_url"] = get_content_url(variation)
+            return create_conditional_json_response({
+                "id": "{}_{}_var".format(collection_id, publication_id),
+                "variations": variation_info
+            })
+
+        sources = [
+            ("var", get_variant_filename(collection_id, publication_id, variation), get_variant_xsl_filename(variation), params)
+            for variation in variation_info
+        ]
+
+        def render_variant(variation):
+            xsl_file = get_variant_xsl_filename(variation)
+            filename = get_variant_filename(collection_id, publication_id, variation)
+            if section_id is not None:
+                return get_section_content(project, "var", filename, xsl_file, params, str(section_id))
+            return get_content(project, "var", filename, xsl_file, params)
 
-            if variation["original_filename"] is None and variation["legacy_id"] is not None:
-                filename = "{}.xml".format(variation["legacy_id"])
-            else:
-                filename = "{}_{}_var_{}.xml".format(collection_id, publication_id, variation["id"])
+        renders = {
+            index: lambda variation=variation: render_variant(variation)
+            for index, variation in enumerate(variation_info)
+        }
 
-            variation_info[index]["content"] = get_content(project, "var", filename, xsl_file, params)
+        def create_variants_response():
+            contents, pending = render_with_budget(renders)
+            for index, content in contents.items():
+                variation_info[index]["content"] = content
+            for index in pending:
+                variation_info[index]["content_url"] = get_content_url(variation_info[index])
 
-        data = {
-            "id": "{}_{}_var".format(collection_id, publication_id),
-            "variations": variation_info
-        }
-        return jsonify(data), 200
+            data = {
+                "id": "{}_{}_var".format(collection_id, publication_id),
+                "variations": variation_info
+            }
+            response = jsonify(data)
+            if pending:
+                # the rest of the variants are fetched separately, so this response shouldn't be reused
+                response.headers["Cache-Control"] = "no-store"
+            return response, 200
+
+        def create_variants_stream():
+            def generate():
+                yield current_app.json.dumps({
+                    "id": "{}_{}_var".format(collection_id, publication_id),
+                    "count": len(variation_info)
+                }) + "\n"
+                for index, content in render_as_completed(renders):
+                    yield current_app.json.dumps(dict(variation_info[index], index=index, content=content)) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson"), 200
+
+        return get_conditional_text_response(
+            project, sources, {"variations": variation_info, "section_id": section_id, "mode": mode},
+            create_variants_stream if mode == "stream" else create_variants_response
+        )
     else:
         return jsonify({
             "id": "{}_{}".format(collection_id, publication_id),
@@ -424,6 +686,180 @@ def get_variant(project, collection_id, publication_id, section_id=None):
         }), 403
 
 
+@text.route("/<project>/text/<collection_id>/<publication_id>/bundle")
+def get_publication_bundle(project, collection_id, publication_id):
+    """
+    Get several reading views of a publication in one response, selected with the 'include' query parameter as a
+    comma-separated list of est, com, ms, var, facs and correspondence (default est,com,ms,var,facs).
+
+    The response has a key for each included part, with the same data the endpoint of the part returns
+    (est, com, ms/, var/, facsimiles/<publication_id> and correspondence/publication/metadata/<publication_id>).
+    A part that fails is returned as {"error": message} without affecting the other parts. Texts are rendered in
+    parallel, texts not rendered within the rendering budget are returned as {"url": URL} (or with the URLs of the
+    missing renderings for manuscripts and variants, see get_manuscript and get_variant).
+    """
+    config = get_project_config(project)
+    if config is None:
+        return jsonify({"msg": "No such project."}), 400
+    parts = get_list_query_parameter("include")
+    if parts is None:
+        parts = list(DEFAULT_BUNDLE_PARTS)
+    elif not parts or any(part not in BUNDLE_PARTS for part in parts):
+        return jsonify({"msg": "Invalid include, must be one or more of {}.".format(", ".join(BUNDLE_PARTS))}), 400
+
+    can_show, message = get_published_status(project, collection_id, publication_id)
+    if not can_show:
+        return jsonify({
+            "id": "{}_{}".format(collection_id, publication_id),
+            "error": message
+        }), 403
+
+    logger.info("Getting bundle {} for {}_{}...".format(",".join(parts), collection_id, publication_id))
+    # all metadata of the publication is fetched using one connection, before rendering anything
+    connection = db_engine.connect()
+    select = """SELECT publication.legacy_id, publication.original_filename, publication.language,
+    publication_collection.legacy_id AS collection_legacy_id,
+    publication_comment.legacy_id AS comment_legacy_id, publication_comment.original_filename AS comment_original_filename
+    FROM publication
+    JOIN publication_collection ON publication_collection.id = publication.publication_collection_id
+    LEFT JOIN publication_comment ON publication_comment.id = publication.publication_comment_id
+    WHERE publication.id = :p_id"""
+    publication = connection.execute(sqlalchemy.sql.text(select).bindparams(p_id=publication_id)).fetchone()
+    manuscript_info = []
+    if "ms" in parts:
+        select = "SELECT sort_order, name, legacy_id, id, original_filename, language FROM publication_manuscript WHERE publication_id = :p_id AND deleted != 1 ORDER BY sort_order ASC"
+        statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
+        manuscript_info = [row._asdict() for row in connection.execute(statement).fetchall() if row is not None]
+    variation_info = []
+    if "var" in parts:
+        select = "SELECT sort_order, name, type, legacy_id, id, original_filename FROM publication_version WHERE publication_id = :p_id AND deleted != 1 ORDER BY type, sort_order ASC"
+        statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
+        variation_info = [row._asdict() for row in connection.execute(statement).fetchall() if row is not None]
+    connection.close()
+    if publication is None:
+        return jsonify({
+            "id": "{}_{}".format(collection_id, publication_id),
+            "error": "Content does not exist"
+        }), 404
+
+    try:
+        book_id = '"{}"'.format(int(publication.collection_legacy_id))
+    except (TypeError, ValueError):
+        book_id = '"{}"'.format(collection_id)
+    params = {"bookId": book_id}
+
+    bundle = {
+        "id": "{}_{}".format(collection_id, publication_id)
+    }
+    # database parts are part of the ETag of the response, so they're fetched before checking it
+    for part, get_part in (("facs", lambda: get_publication_facsimiles(project, config, publication_id)),
+                           ("correspondence", lambda: get_publication_correspondence_metadata(project, publication_id))):
+        if part in parts:
+            try:
+                bundle[part] = get_part()
+            except Exception as e:
+                logger.exception("Error getting {} for bundle".format(part))
+                bundle[part] = {"error": "Error getting {}: {}".format(part, e)}
+
+    # texts to render, by part and (for manuscripts and variants) index and view
+    renders = {}
+    text_urls = {}
+    sources = []
+
+    def add_render(key, folder, filename, xsl_file, render_params, url, replace_ids=False):
+        def render():
+            content = get_content(project, folder, filename, xsl_file, render_params)
+            if replace_ids and not content.startswith(RENDER_ERROR_PREFIXES):
+                content = content.replace(" id=", " data-id=")
+            return content
+        renders[key] = render
+        text_urls[key] = url
+        sources.append((folder, filename, xsl_file, render_params))
+
+    url_arguments = {"project": project, "collection_id": collection_id, "publication_id": publication_id}
+    if "est" in parts:
+        legacy_id = publication.legacy_id if publication.original_filename is None else None
+        add_render(("est",), "est", get_reading_text_filename(collection_id, publication_id, legacy_id=legacy_id),
+                   "est.xsl", params, url_for("text.get_reading_text", **url_arguments), replace_ids=True)
+    if "com" in parts:
+        comment_legacy_id = None
+        if publication.comment_legacy_id is not None and publication.comment_original_filename is None:
+            comment_legacy_id = publication.comment_legacy_id
+        filename = get_comment_filename(collection_id, publication_id, comment_legacy_id=comment_legacy_id)
+        add_render(("com",), "com", filename, "com.xsl", get_comment_parameters(config, filename, book_id),
+                   url_for("text.get_comments", **url_arguments))
+    for index, manuscript in enumerate(manuscript_info):
+        for view, (key, xsl_file) in MANUSCRIPT_VIEWS.items():
+            add_render(("ms", index, key), "ms", get_manuscript_filename(collection_id, publication_id, manuscript),
+                       xsl_file, params, url_for("text.get_manuscript", manuscript_id=manuscript["id"], views=view, **url_arguments),
+                       replace_ids=True)
+    for index, variation in enumerate(variation_info):
+        add_render(("var", index), "var", get_variant_filename(collection_id, publication_id, variation),
+                   get_variant_xsl_filename(variation), params,
+                   url_for("text.get_variant", ids=variation["id"], **url_arguments))
+
+    def create_bundle_response():
+        contents, pending = render_with_budget(renders)
+        if "est" in parts:
+            bundle["est"] = {
+                "id": "{}_{}_est".format(collection_id, publication_id),
+                "language": publication.language or ""
+            }
+        if "com" in parts:
+            bundle["com"] = {
+                "id": "{}_{}_com".format(collection_id, publication_id)
+            }
+        if "ms" in parts:
+            bundle["ms"] = {
+                "id": "{}_{}".format(collection_id, publication_id),
+                "manuscripts": manuscript_info
+            }
+        if "var" in parts:
+            bundle["var"] = {
+                "id": "{}_{}_var".format(collection_id, publication_id),
+                "variations": variation_info
+            }
+
+        for key in renders:
+            part = key[0]
+            content = contents.get(key)
+            if part in ("est", "com"):
+                if key in pending:
+                    bundle[part] = {"url": text_urls[key]}
+                elif content.startswith(RENDER_ERROR_PREFIXES):
+                    bundle[part] = {"error": content}
+                else:
+                    bundle[part]["content"] = content
+            elif part == "ms":
+                _, index, view_key = key
+                if key in pending:
+                    manuscript_info[index][view_key + "_url"] = text_urls[key]
+                else:
+                    manuscript_info[index][view_key] = content
+            else:
+                _, index = key
+                if key in pending:
+                    variation_info[index]["content_url"] = text_urls[key]
+                else:
+                    variation_info[index]["content"] = content
+
+        response = jsonify(bundle)
+        if pending:
+            # the rest of the texts are fetched separately, so this response shouldn't be reused
+            response.headers["Cache-Control"] = "no-store"
+        return response, 200
+
+    extra = {
+        "parts": parts,
+        "publication": publication._asdict(),
+        "manuscripts": manuscript_info,
+        "variations": variation_info,
+        "facs": bundle.get("facs"),
+        "correspondence": bundle.get("correspondence")
+    }
+    return get_conditional_text_response(project, sources, extra, create_bundle_response)
+
+
 @text.route("/<project>/text/downloadable/<format>/<collection_id>/inl")
 @text.route("/<project>/text/downloadable/<format>/<collection_id>/inl/<lang>")
 def get_introduction_downloadable_format(project, format, collection_id, lang="sv"):
@@ -442,12 +878,16 @@ def get_introduction_downloadable_format(project, format, collection_id, lang="s
             filename = "{}_inl_{}_{}.xml".format(collection_id, lang, version)
             if format == "xml":
                 xsl_file = None
-                content = get_xml_content(project, "inl", filename, xsl_file, None)
                 data = {
-                    "id": "{}_inl".format(collection_id),
-                    "content": content
+                    "id": "{}_inl".format(collection_id)
                 }
-                return jsonify(data), 200
+                if wants_downloadable_file(DOWNLOADABLE_MIMETYPES[format]):
+                    return get_downloadable_file_response(project, "inl", filename, xsl_file, None, data,
+                                                          "{}.xml".format(data["id"]), DOWNLOADABLE_MIMETYPES[format])
+                return get_conditional_text_response(
+                    project, [("inl", filename, xsl_file, None)], data,
+                    lambda: (jsonify(dict(data, content=get_xml_content(project, "inl", filename, xsl_file, None))), 200)
+                )
             else:
                 return jsonify({
                     "id": "{}_inl".format(collection_id),
@@ -474,13 +914,9 @@ def get_reading_text_downloadable_format(project, format, collection_id, publica
         select = "SELECT legacy_id FROM publication WHERE id = :p_id AND original_filename IS NULL"
         statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
         result = connection.execute(statement).fetchone()
-        if result is None or language is not None:
-            filename = "{}_{}_est.xml".format(collection_id, publication_id)
-            if language is not None:
-                filename = "{}_{}_{}_est.xml".format(collection_id, publication_id, language)
-                logger.debug("Filename (est xml) for {} is {}".format(publication_id, filename))
-        else:
-            filename = "{}_est.xml".format(result.legacy_id)
+        filename = get_reading_text_filename(collection_id, publication_id,
+                                             legacy_id=result.legacy_id if result is not None else None,
+                                             language=language)
         logger.debug("Filename (est xml) for {} is {}".format(publication_id, filename))
 
         if format == "xml":
@@ -490,21 +926,17 @@ def get_reading_text_downloadable_format(project, format, collection_id, publica
         else:
             xsl_file = None
 
-        bookId = get_collection_legacy_id(collection_id)
-        if bookId is None:
-            bookId = collection_id
-        bookId = '"{}"'.format(bookId)
+        bookId = get_book_id_parameter(collection_id)
 
+        params = {"bookId": bookId}
         if section_id is not None:
             section_id = '"{}"'.format(section_id)
-            content = get_xml_content(project, "est", filename, xsl_file,
-                                      {"bookId": bookId, "sectionId": section_id})
-        else:
-            content = get_xml_content(project, "est", filename, xsl_file, {"bookId": bookId})
+            params["sectionId"] = section_id
 
         select = "SELECT language FROM publication WHERE id = :p_id"
         statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
         result = connection.execute(statement).fetchone()
+        connection.close()
 
         text_language = ""
         if result is not None and result.language is not None:
@@ -513,13 +945,17 @@ def get_reading_text_downloadable_format(project, format, collection_id, publica
         data = {
             # @TODO: investigate if id should have language in its value or not (similar to filename).
             "id": "{}_{}_est".format(collection_id, publication_id),
-            "content": content,
             "language": text_language
         }
 
-        connection.close()
-
-        return jsonify(data), 200
+        if wants_downloadable_file(DOWNLOADABLE_MIMETYPES.get(format, "application/xml")):
+            return get_downloadable_file_response(project, "est", filename, xsl_file, params, data,
+                                                  "{}.{}".format(data["id"], format if format in DOWNLOADABLE_MIMETYPES else "xml"),
+                                                  DOWNLOADABLE_MIMETYPES.get(format, "application/xml"))
+        return get_conditional_text_response(
+            project, [("est", filename, xsl_file, params)], data,
+            lambda: (jsonify(dict(data, content=get_xml_content(project, "est", filename, xsl_file, params))), 200)
+        )
     else:
         return jsonify({
             "id": "{}_{}".format(collection_id, publication_id),
@@ -540,29 +976,13 @@ def get_comments_downloadable_format(project, format, collection_id, publication
         can_show, message = get_published_status(project, collection_id, publication_id)
         if can_show:
             logger.info("Getting XML for {} and transforming...".format(request.full_path))
-            connection = db_engine.connect()
-            select = "SELECT legacy_id FROM publication_comment WHERE id IN (SELECT publication_comment_id FROM publication WHERE id = :p_id) \
-                        AND legacy_id IS NOT NULL AND original_filename IS NULL"
-            statement = sqlalchemy.sql.text(select).bindparams(p_id=publication_id)
-            result = connection.execute(statement).fetchone()
-
-            bookId = get_collection_legacy_id(collection_id)
-            if bookId is None:
-                bookId = collection_id
-            bookId = '"{}"'.format(bookId)
+            bookId = get_book_id_parameter(collection_id)
 
-            if result is not None:
-                filename = "{}_com.xml".format(result.legacy_id)
-                connection.close()
-            else:
-                filename = "{}_{}_com.xml".format(collection_id, publication_id)
-                connection.close()
+            filename = get_comment_filename(collection_id, publication_id,
+                                            comment_legacy_id=get_comment_legacy_id(publication_id))
             logger.debug("Filename (com) for {} is {}".format(publication_id, filename))
 
-            params = {
-                "estDocument": '"file://{}"'.format(safe_join(config["file_root"], "xml", "est", filename.replace("com", "est"))),
-                "bookId": bookId
-            }
+            params = get_comment_parameters(config, filename, bookId)
 
             if format == "xml":
                 xsl_file = "com_downloadable_xml.xsl"
@@ -573,20 +993,19 @@ def get_comments_downloadable_format(project, format, collection_id, publication
 
             if section_id is not None:
                 section_id = '"{}"'.format(section_id)
-                content = get_xml_content(project, "com", filename, xsl_file, {
-                    "sectionId": str(section_id),
-                    "estDocument": '"file://{}"'.format(safe_join(config["file_root"], "xml", "est", filename.replace("com", "est"))),
-                    "bookId": bookId
-                })
-            else:
-                content = get_xml_content(project, "com", filename, xsl_file, params)
+                params["sectionId"] = str(section_id)
 
             data = {
-                "id": "{}_{}_com".format(collection_id, publication_id),
-                "content": content
+                "id": "{}_{}_com".format(collection_id, publication_id)
             }
-            connection.close()
-            return jsonify(data), 200
+            if wants_downloadable_file(DOWNLOADABLE_MIMETYPES.get(format, "application/xml")):
+                return get_downloadable_file_response(project, "com", filename, xsl_file, params, data,
+                                                      "{}.{}".format(data["id"], format if format in DOWNLOADABLE_MIMETYPES else "xml"),
+                                                      DOWNLOADABLE_MIMETYPES.get(format, "application/xml"))
+            return get_conditional_text_response(
+                project, [("com", filename, xsl_file, params)], data,
+                lambda: (jsonify(dict(data, content=get_xml_content(project, "com", filename, xsl_file, params))), 200)
+            )
         else:
             return jsonify({
                 "id": "{}_{}".format(collection_id, publication_id),
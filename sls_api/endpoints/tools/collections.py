@@ -3,7 +3,7 @@ from flask import Blueprint, request
 from sqlalchemy import select, and_, or_, not_, asc, desc
 from datetime import datetime
 
-from sls_api.endpoints.generics import db_engine, get_project_id_from_name, get_table, \
+from sls_api.endpoints.generics import db_engine, facsimile_collection_cache, get_project_id_from_name, get_table, \
     int_or_none, project_permission_required, validate_int, create_error_response, \
     create_success_response
 
@@ -341,10 +341,12 @@ def edit_facsimile_collection(project, collection_id):
                     # No row was returned: invalid facsimile collection_id
                     return create_error_response("Update failed: no facsimile collection with the provided 'collection_id' found.")
 
-                return create_success_response(
-                    message="Facsimile collection updated.",
-                    data=updated_row._asdict()
-                )
+        # the change is committed, make facsimile image requests see it
+        facsimile_collection_cache.invalidate()
+        return create_success_response(
+            message="Facsimile collection updated.",
+            data=updated_row._asdict()
+        )
 
     except Exception:
         logger.exception("Exception updating facsimile collection.")
@@ -731,11 +733,13 @@ def link_facsimile_collection_to_publication(project, collection_id):
                 if inserted_row is None:
                     return create_error_response("Insertion failed: no row returned.", 500)
 
-                return create_success_response(
-                    message="Facsimile created.",
-                    data=inserted_row._asdict(),
-                    status_code=201
-                )
+        # the change is committed, make facsimile image requests see it
+        facsimile_collection_cache.invalidate()
+        return create_success_response(
+            message="Facsimile created.",
+            data=inserted_row._asdict(),
+            status_code=201
+        )
 
     except Exception:
         logger.exception("Exception creating new publication facsimile.")
@@ -908,10 +912,12 @@ def edit_facsimile(project):
                 if updated_row is None:
                     return create_error_response("Update failed: no facsimile with the provided 'id' found.")
 
-                return create_success_response(
-                    message="Publication facsimile updated.",
-                    data=updated_row._asdict()
-                )
+        # the change is committed, make facsimile image requests see it
+        facsimile_collection_cache.invalidate()
+        return create_success_response(
+            message="Publication facsimile updated.",
+            data=updated_row._asdict()
+        )
 
     except Exception:
         logger.exception("Exception updating publication facsimile.")
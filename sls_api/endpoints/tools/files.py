@@ -12,7 +12,9 @@ from werkzeug.security import safe_join
 
 from sls_api.endpoints.generics import get_project_config, \
     project_permission_required, create_error_response, \
-    create_success_response, is_any_valid_date_format
+    create_success_response, is_any_valid_date_format, memory_content_cache, render_counters, \
+    xslt_cache, saxon_xslt_cache, content_disk_cache, derivative_disk_cache, get_xslt_engine, xml_document_cache, xml_source_cache, \
+    facsimile_collection_cache
 
 
 file_tools = Blueprint("file_tools", __name__)
@@ -207,6 +209,154 @@ def get_git_repo_details(project):
     )
 
 
+@file_tools.route("/<project>/cache/stats/")
+@project_permission_required
+def get_rendering_cache_stats(project):
+    """
+    Retrieve rendering cache statistics for a project.
+
+    The API runs in several worker processes, each with its own in-memory
+    caches, so the counters returned describe only the worker process that
+    handled the request. The process ID of the worker is included in the
+    response. The `disk_cache` statistics are shared by all workers and
+    describe the cache directory as of its last sweep (`swept_at` is a
+    UNIX timestamp), with evictions counted since the cache directory was
+    created.
+
+    URL Path Parameters:
+
+    - `project` (str, required): The name of the project.
+
+    Returns:
+
+    - A tuple containing a Flask Response object with JSON data and an
+      HTTP status code. The JSON response has the following structure:
+
+        {
+            "success": bool,
+            "message": str,
+            "data": object or null
+        }
+
+    Example Success Response (HTTP 200):
+
+        {
+            "success": true,
+            "message": "Rendering cache statistics successfully retrieved.",
+            "data": {
+                "worker_pid": 12,
+                "xslt_engine": "lxml",
+                "xslt_cache": {
+                    "entries": 3,
+                    "max_entries": 32,
+                    "hits": 1520,
+                    "misses": 4,
+                    "invalidations": 1,
+                    "compile_seconds": 0.412,
+                    "stylesheets": ["/var/www/project/xslt/est.xsl", ...]
+                },
+                "saxon_xslt_cache": {
+                    "entries": 0,
+                    ...
+                },
+                "xml_document_cache": {
+                    "entries": 16,
+                    "max_entries": 16,
+                    "hits": 310,
+                    "misses": 52,
+                    "invalidations": 2,
+                    "load_seconds": 1.274
+                },
+                "xml_source_cache": {
+                    "entries": 9,
+                    ...
+                },
+                "facsimile_collection_cache": {
+                    "entries": 12,
+                    "ttl_seconds": 60,
+                    "hits": 48210,
+                    "misses": 95,
+                    "invalidations": 1
+                },
+                "memory_cache": {
+                    "entries": 120,
+                    "bytes": 31457280,
+                    "max_bytes": 67108864,
+                    "revalidate_seconds": 10,
+                    "projects": {
+                        "project": {
+                            "hits": 9800,
+                            "misses": 200,
+                            "invalidations": 3,
+                            "evictions": 0,
+                            "bytes": 31457280,
+                            "hit_ratio": 0.98
+                        }
+                    }
+                },
+                "rendering": {
+                    "project": {
+                        "renders": 200,
+                        "shared_cache_hits": 35,
+                        "duplicate_renders_avoided": 12,
+                        "stale_served": 0,
+                        "lock_wait_seconds": 3.52
+                    }
+                },
+                "disk_cache": {
+                    "swept_at": 1718000000.0,
+                    "sweep_seconds": 0.214,
+                    "entries": 5210,
+                    "bytes": 1073741824,
+                    "max_bytes": 2147483648,
+                    "projects": {
+                        "project": {
+                            "entries": 5210,
+                            "bytes": 1073741824,
+                            "evictions": 340,
+                            "types": {
+                                "est": {
+                                    "entries": 1200,
+                                    "bytes": 524288000,
+                                    "evictions": 20
+                                },
+                                ...
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+    Status Codes:
+
+    - 200 - OK: The request was successful.
+    - 404 - Not Found: The project configuration does not exist.
+    """
+    config = get_project_config(project)
+    if config is None:
+        return create_error_response("Error: project config not found on the server.", 404)
+
+    xslt_folder = os.path.abspath(safe_join(config["file_root"], "xslt"))
+
+    return create_success_response(
+        message="Rendering cache statistics successfully retrieved.",
+        data={
+            "worker_pid": os.getpid(),
+            "xslt_engine": get_xslt_engine(project),
+            "xslt_cache": xslt_cache.stats(path_prefix=xslt_folder),
+            "saxon_xslt_cache": saxon_xslt_cache.stats(path_prefix=xslt_folder),
+            "xml_document_cache": xml_document_cache.stats(),
+            "xml_source_cache": xml_source_cache.stats(),
+            "facsimile_collection_cache": facsimile_collection_cache.stats(),
+            "memory_cache": memory_content_cache.stats(project=project),
+            "rendering": render_counters.stats(project=project),
+            "disk_cache": content_disk_cache.stats(project=project),
+            "derivative_cache": derivative_disk_cache.stats(project=project)
+        }
+    )
+
+
 @file_tools.route("/<project>/sync_files/", methods=["POST"])
 @project_permission_required
 def pull_changes_from_git_remote(project):
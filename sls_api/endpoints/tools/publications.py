@@ -1,11 +1,11 @@
 import logging
 import os
-from flask import Blueprint, request, Response
+from flask import Blueprint, request
 from flask_jwt_extended import jwt_required
 from sqlalchemy import asc, desc, select, text
 from werkzeug.security import safe_join
 
-from sls_api.endpoints.generics import db_engine, get_project_id_from_name, \
+from sls_api.endpoints.generics import create_file_response, db_engine, get_project_id_from_name, \
     get_table, int_or_none, validate_int, project_permission_required, \
     create_error_response, create_success_response, get_project_config
 
@@ -1349,9 +1349,7 @@ def get_single_facsimile_file(project, collection_id, file_nr, zoom_level):
 
     # Retrieve image file
     try:
-        with open(file_path, "rb") as img_file:
-            content = img_file.read()
-        return Response(content, status=200, content_type="image/jpeg")
+        return create_file_response(file_path, "image/jpeg")
     except FileNotFoundError:
         logger.exception(f"Error reading facsimile: file not found at {file_path}.")
         return create_error_response("Facsimile file not found.", 404)
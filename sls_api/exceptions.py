@@ -8,3 +8,15 @@ class CascadeUpdateError(Exception):
     def __init__(self, message: str):
         super().__init__(message)
         self.message = message
+
+
+class BulkUploadLimitError(Exception):
+    """
+    Exception raised when a bulk upload of facsimiles exceeds the configured size or number of files.
+
+    Attributes:
+        message (str): Explanation of the error.
+    """
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
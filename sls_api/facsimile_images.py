@@ -0,0 +1,388 @@
+import io
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from PIL import Image, ImageCms
+
+logger = logging.getLogger("sls_api.facsimile_images")
+
+# JPEG quality of resized facsimiles and tiles, the same as the "-quality 77" previously given to imagemagick
+FACSIMILE_JPEG_QUALITY = 77
+
+# engines for resizing uploaded facsimiles, see resize_facsimile
+RESIZE_ENGINES = ["pillow", "imagemagick"]
+
+# uploaded facsimiles are often scans of several hundred megapixels, well above the decompression bomb limit of Pillow,
+# which is meant for untrusted images. Facsimiles are only uploaded by users with project permissions, so uploads are
+# opened with this limit instead (see open_image), while other images keep the default limit of Pillow.
+UPLOAD_MAX_IMAGE_PIXELS = 1024 * 1024 * 1024
+
+# the limit is a module global of Pillow, only one thread at a time may raise it
+image_pixel_limit_lock = threading.Lock()
+
+# facsimile image tiles are square, this many pixels wide and high (the last tiles of each row and column may be smaller)
+DEFAULT_TILE_SIZE = 512
+
+TILE_QUALITY = FACSIMILE_JPEG_QUALITY
+
+# file describing the tile pyramid of a page, in the tiles folder of the page
+PYRAMID_FILENAME = "pyramid.json"
+
+
+def parse_resolution(resolution):
+    """
+    Returns the maximum width and height of a resolution in FACSIMILE_IMAGE_SIZES, such as "600x600", as a tuple of ints
+    """
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
+def get_fit_size(width, height, max_width, max_height):
+    """
+    Returns the size a 'width' x 'height' image is resized to for fitting within 'max_width' x 'max_height' with
+    the aspect ratio retained, the same way as "convert -resize <max_width>x<max_height>", which also enlarges
+    smaller images
+    """
+    scale = min(max_width / width, max_height / height)
+    return max(1, int(width * scale + 0.5)), max(1, int(height * scale + 0.5))
+
+
+def convert_to_srgb(image):
+    """
+    Returns 'image' as an 8-bit RGB image in the sRGB colour space. Images with an embedded ICC profile (such as
+    Adobe RGB or CMYK scans) are converted from that profile, other images are assumed to be sRGB already.
+    """
+    if image.mode in ("I;16", "I;16B", "I;16L", "I"):
+        # 16-bit greyscale, which Pillow would otherwise clip when converting to 8 bits
+        image = image.convert("I").point(lambda value: value * (1 / 256)).convert("L")
+    icc_profile = image.info.get("icc_profile")
+    if icc_profile:
+        try:
+            return ImageCms.profileToProfile(image, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                                             ImageCms.createProfile("sRGB"), outputMode="RGB")
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            logger.warning("Could not convert facsimile from its embedded ICC profile, converting it as sRGB")
+    return image.convert("RGB")
+
+
+def open_image(source_path, max_pixels=None):
+    """
+    Opens the image 'source_path' using Image.open. If 'max_pixels' is given, images of up to that many pixels are
+    opened instead of raising Image.DecompressionBombError, the limit of Pillow being restored once the image is open.
+    """
+    if max_pixels is None:
+        return Image.open(source_path)
+    with image_pixel_limit_lock:
+        default_max_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = max_pixels
+        try:
+            return Image.open(source_path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = default_max_pixels
+
+
+def open_facsimile_source(source_path, draft_size=None, max_pixels=None):
+    """
+    Decodes the image 'source_path' (the first page of multi-page TIFF files) into an sRGB image (see
+    convert_to_srgb). JPEG images much larger than 'draft_size', if given, are decoded at a reduced scale
+    at least that size, which is a lot faster than decoding them in full. 'max_pixels' is as in open_image.
+    """
+    with open_image(source_path, max_pixels=max_pixels) as source_image:
+        if draft_size is not None:
+            source_image.draft("RGB", draft_size)
+        source_image.load()
+        return convert_to_srgb(source_image)
+
+
+def save_facsimile_jpeg(image, destination_path, quality=FACSIMILE_JPEG_QUALITY):
+    """
+    Saves 'image' as a JPEG file at 'destination_path', replacing any previous file only when the new one is complete
+    """
+    destination_folder = os.path.dirname(destination_path)
+    os.makedirs(destination_folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=destination_folder, prefix=".{}.".format(os.path.basename(destination_path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            image.save(temp_file, "JPEG", quality=quality, optimize=True)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, destination_path)
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def resize_facsimile_with_pillow(source_path, outputs, quality=FACSIMILE_JPEG_QUALITY, progress=None):
+    """
+    Resizes the image 'source_path' to each (zoom level, resolution, destination path) in 'outputs' (see
+    resize_facsimile), decoding it only once. Each level is scaled down from the previous, larger level rather
+    than from the full source image, so that a large scan is only processed in full for the largest zoom level.
+
+    Returns a dict of the time spent decoding the image and resizing and saving each zoom level, in seconds.
+    """
+    timings = {"decode": 0.0, "levels": {}}
+    with open_image(source_path, max_pixels=UPLOAD_MAX_IMAGE_PIXELS) as source_image:
+        source_width, source_height = source_image.size
+    outputs = sorted(outputs, key=lambda output: parse_resolution(output[1]), reverse=True)
+    sizes = [get_fit_size(source_width, source_height, *parse_resolution(resolution)) for _, resolution, _ in outputs]
+
+    start = time.perf_counter()
+    # sizes are computed from the full size of the source, a JPEG source may be decoded at a smaller scale
+    image = open_facsimile_source(source_path, draft_size=sizes[0], max_pixels=UPLOAD_MAX_IMAGE_PIXELS)
+    timings["decode"] = time.perf_counter() - start
+
+    base_image = image
+    for (zoom_level, _, destination_path), size in zip(outputs, sizes):
+        start = time.perf_counter()
+        if size == base_image.size:
+            level_image = base_image
+        else:
+            level_image = base_image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        save_facsimile_jpeg(level_image, destination_path, quality=quality)
+        # smaller levels are resized from this one, unless it was enlarged from a source smaller than it
+        if size[0] <= source_width and size[1] <= source_height:
+            base_image = level_image
+        timings["levels"][zoom_level] = time.perf_counter() - start
+        if progress is not None:
+            progress(zoom_level, timings["levels"][zoom_level])
+    return timings
+
+
+def create_image_derivative(source_path, destination_path, width, quality=FACSIMILE_JPEG_QUALITY):
+    """
+    Saves the image 'source_path' scaled to 'width' pixels wide, with the aspect ratio retained,
+    as a JPEG file at 'destination_path'. Returns the size of the saved image.
+    """
+    with Image.open(source_path) as source_image:
+        source_width, source_height = source_image.size
+    size = (width, max(1, int(source_height * width / source_width + 0.5)))
+    image = open_facsimile_source(source_path, draft_size=size)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    save_facsimile_jpeg(image, destination_path, quality=quality)
+    return size
+
+
+def resize_facsimile_with_imagemagick(source_path, outputs, quality=FACSIMILE_JPEG_QUALITY, progress=None):
+    """
+    Resizes the image 'source_path' to each (zoom level, resolution, destination path) in 'outputs' (see
+    resize_facsimile) by running imagemagick "convert" once per zoom level.
+
+    Returns a dict of the time spent on each zoom level, in seconds. Raises subprocess.CalledProcessError if
+    a conversion fails, or FileNotFoundError if imagemagick isn't installed.
+    """
+    timings = {"decode": None, "levels": {}}
+    for zoom_level, resolution, destination_path in outputs:
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        start = time.perf_counter()
+        convert_cmd = ["convert", "-resize", resolution, "-quality", str(quality), "-colorspace", "sRGB",
+                       source_path, destination_path]
+        subprocess.run(convert_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        timings["levels"][zoom_level] = time.perf_counter() - start
+        if progress is not None:
+            progress(zoom_level, timings["levels"][zoom_level])
+    return timings
+
+
+def resize_facsimile(source_path, outputs, engine="pillow", quality=FACSIMILE_JPEG_QUALITY, progress=None):
+    """
+    Resizes the uploaded facsimile 'source_path' into a JPEG file for each zoom level, where 'outputs' is a list of
+    (zoom level, resolution, destination path) tuples and resolutions are as in FACSIMILE_IMAGE_SIZES in generics.py.
+
+    'engine' is one of RESIZE_ENGINES, 'pillow' (see resize_facsimile_with_pillow) or 'imagemagick'. Images Pillow
+    can't read are resized with imagemagick.
+
+    Returns a tuple of the engine used and a dict of timings, {"decode": seconds, "levels": {zoom level: seconds}}
+    (decode is None for imagemagick, which decodes the image again for each level). Raises an exception if resizing fails.
+
+    If given, 'progress' is called with the zoom level and the time spent on it in seconds as each level is saved.
+    """
+    if engine not in RESIZE_ENGINES:
+        raise ValueError(f"Unknown facsimile resize engine {engine}, expected one of {RESIZE_ENGINES}")
+    if engine == "pillow":
+        try:
+            return "pillow", resize_facsimile_with_pillow(source_path, outputs, quality=quality, progress=progress)
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            # Pillow raises UnidentifiedImageError (an OSError) for formats it can't read
+            logger.warning(f"Could not resize {source_path} using Pillow ({e}), using imagemagick")
+    return "imagemagick", resize_facsimile_with_imagemagick(source_path, outputs, quality=quality, progress=progress)
+
+
+def get_tiles_folder(collection_folder_path, page_number):
+    """
+    Returns the folder the tiles of a facsimile page are stored in, <collection_folder_path>/tiles/<page_number>
+    """
+    return os.path.join(collection_folder_path, "tiles", str(int(page_number)))
+
+
+def get_tile_path(tiles_folder, scale_factor, column, row):
+    """
+    Returns the path of a tile, <tiles_folder>/<scale_factor>/<column>_<row>.jpg
+    """
+    return os.path.join(tiles_folder, str(scale_factor), "{}_{}.jpg".format(column, row))
+
+
+def get_scale_factors(width, height, tile_size):
+    """
+    Returns the power of two scale factors of the tile pyramid of a 'width' x 'height' image,
+    from 1 (full resolution) up to the first one at which the whole image fits in a single tile
+    """
+    scale_factors = [1]
+    while math.ceil(width / scale_factors[-1]) > tile_size or math.ceil(height / scale_factors[-1]) > tile_size:
+        scale_factors.append(scale_factors[-1] * 2)
+    return scale_factors
+
+
+def generate_tile_pyramid(source_path, tiles_folder, tile_size=DEFAULT_TILE_SIZE, quality=TILE_QUALITY, max_pixels=None):
+    """
+    Generates a pyramid of JPEG tiles of 'tile_size' pixels from the image 'source_path' into 'tiles_folder',
+    for deep zoom viewers to load only the visible parts of a facsimile page (see get_facsimile_tile).
+
+    Each level of the pyramid is the image scaled down by a power of two scale factor (see get_scale_factors),
+    cut into tiles stored as <scale_factor>/<column>_<row>.jpg. The size of the image, the tile size and the scale
+    factors are written to pyramid.json. The tiles are generated in a temporary folder which then replaces
+    'tiles_folder', so a page never has a partially generated pyramid. 'max_pixels' is as in open_image.
+
+    Returns the contents of pyramid.json as a dict.
+    """
+    parent_folder = os.path.dirname(os.path.normpath(tiles_folder))
+    os.makedirs(parent_folder, exist_ok=True)
+    temp_folder = tempfile.mkdtemp(dir=parent_folder, prefix=".{}.".format(os.path.basename(tiles_folder)))
+    try:
+        image = open_facsimile_source(source_path, max_pixels=max_pixels)
+        width, height = image.size
+        scale_factors = get_scale_factors(width, height, tile_size)
+
+        level_image = image
+        for scale_factor in scale_factors:
+            if scale_factor > 1:
+                # each level is scaled down from the previous one, which is faster than scaling the full image
+                level_image = level_image.resize((math.ceil(width / scale_factor), math.ceil(height / scale_factor)),
+                                                 Image.LANCZOS)
+            level_width, level_height = level_image.size
+            os.makedirs(os.path.join(temp_folder, str(scale_factor)))
+            for row in range(math.ceil(level_height / tile_size)):
+                for column in range(math.ceil(level_width / tile_size)):
+                    box = (column * tile_size, row * tile_size,
+                           min((column + 1) * tile_size, level_width), min((row + 1) * tile_size, level_height))
+                    level_image.crop(box).save(get_tile_path(temp_folder, scale_factor, column, row),
+                                               "JPEG", quality=quality)
+
+        pyramid = {
+            "width": width,
+            "height": height,
+            "tile_size": tile_size,
+            "scale_factors": scale_factors
+        }
+        with open(os.path.join(temp_folder, PYRAMID_FILENAME), "w", encoding="utf-8") as pyramid_file:
+            json.dump(pyramid, pyramid_file)
+
+        # replace any previous pyramid of the page
+        old_folder = None
+        if os.path.exists(tiles_folder):
+            old_folder = tempfile.mkdtemp(dir=parent_folder, prefix=".{}.old.".format(os.path.basename(tiles_folder)))
+            os.replace(tiles_folder, os.path.join(old_folder, "tiles"))
+        os.replace(temp_folder, tiles_folder)
+        if old_folder is not None:
+            shutil.rmtree(old_folder, ignore_errors=True)
+        return pyramid
+    except Exception:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise
+
+
+def read_tile_pyramid(tiles_folder):
+    """
+    Returns the contents of the pyramid.json file of 'tiles_folder' as a dict, or None if the page has no tiles
+    """
+    try:
+        with open(os.path.join(tiles_folder, PYRAMID_FILENAME), encoding="utf-8") as pyramid_file:
+            return json.load(pyramid_file)
+    except (OSError, ValueError):
+        return None
+
+
+def parse_iiif_size(size, region_width, region_height):
+    """
+    Returns the width and height requested by the IIIF Image API size parameter 'size' ('max', 'full', 'w,', ',h',
+    'w,h' or 'pct:n', as used by deep zoom viewers for tiles) for a region of 'region_width' x 'region_height' pixels,
+    or None if 'size' isn't valid
+    """
+    try:
+        if size in ("max", "full"):
+            return region_width, region_height
+        if size.startswith("pct:"):
+            percent = float(size[len("pct:"):])
+            return math.ceil(region_width * percent / 100), math.ceil(region_height * percent / 100)
+        width, height = size.lstrip("!^").split(",")
+        if width and height:
+            return int(width), int(height)
+        if width:
+            return int(width), math.ceil(region_height * int(width) / region_width)
+        if height:
+            return math.ceil(region_width * int(height) / region_height), int(height)
+    except (ValueError, ZeroDivisionError):
+        pass
+    return None
+
+
+def find_iiif_tile(pyramid, region, size):
+    """
+    Returns a tuple of the scale factor, column and row of the tile in 'pyramid' (see read_tile_pyramid) matching
+    the IIIF Image API 'region' ('full' or 'x,y,w,h') and 'size' parameters, or None if there's no such tile.
+    Only the regions and sizes of the tiles listed in info.json (see get_iiif_info) are available, as in IIIF level 0.
+    """
+    width, height, tile_size = pyramid["width"], pyramid["height"], pyramid["tile_size"]
+    if region == "full":
+        x, y, region_width, region_height = 0, 0, width, height
+    else:
+        try:
+            x, y, region_width, region_height = (int(value) for value in region.split(","))
+        except ValueError:
+            return None
+    requested_size = parse_iiif_size(size, region_width, region_height)
+    if requested_size is None:
+        return None
+
+    for scale_factor in pyramid["scale_factors"]:
+        tile_span = tile_size * scale_factor
+        if x % tile_span != 0 or y % tile_span != 0:
+            continue
+        column, row = x // tile_span, y // tile_span
+        tile_width = min(tile_span, width - x)
+        tile_height = min(tile_span, height - y)
+        if tile_width <= 0 or tile_height <= 0 or (region_width, region_height) != (tile_width, tile_height):
+            continue
+        if requested_size == (math.ceil(tile_width / scale_factor), math.ceil(tile_height / scale_factor)):
+            return scale_factor, column, row
+    return None
+
+
+def get_iiif_info(pyramid, image_id):
+    """
+    Returns an IIIF Image API 3.0 info.json document (level 0) for the tile pyramid 'pyramid', served at 'image_id'
+    """
+    return {
+        "@context": "http://iiif.io/api/image/3/context.json",
+        "id": image_id,
+        "type": "ImageService3",
+        "protocol": "http://iiif.io/api/image",
+        "profile": "level0",
+        "width": pyramid["width"],
+        "height": pyramid["height"],
+        "tiles": [{"width": pyramid["tile_size"], "height": pyramid["tile_size"], "scaleFactors": pyramid["scale_factors"]}],
+        # the whole image is available in a single tile at the largest scale factor
+        "sizes": [{
+            "width": math.ceil(pyramid["width"] / pyramid["scale_factors"][-1]),
+            "height": math.ceil(pyramid["height"] / pyramid["scale_factors"][-1])
+        }]
+    }
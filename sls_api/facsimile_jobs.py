@@ -0,0 +1,316 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+import json
+import logging
+import multiprocessing
+import os
+import re
+import subprocess
+import threading
+import time
+import uuid
+from werkzeug.security import safe_join
+
+from sls_api.endpoints.generics import acquire_file_lock, config, FACSIMILE_IMAGE_SIZES, FACSIMILE_UPLOAD_FOLDER, \
+    release_file_lock, write_file_atomically
+from sls_api.facsimile_images import generate_tile_pyramid, get_tiles_folder, resize_facsimile, UPLOAD_MAX_IMAGE_PIXELS
+
+logger = logging.getLogger("sls_api.facsimile_jobs")
+
+# status files of facsimile conversion jobs, <job_id>.json
+FACSIMILE_JOBS_FOLDER = os.path.join(FACSIMILE_UPLOAD_FOLDER, "jobs")
+
+# status files of finished jobs are removed after a week
+FACSIMILE_JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# fields of the status file returned by the job status endpoint, the rest are only used for running the job
+PUBLIC_JOB_FIELDS = ["id", "project", "collection_id", "page_number", "status", "levels", "tiles", "engine",
+                     "timings", "error", "created", "started", "finished"]
+
+conversion_executor = None
+conversion_executor_pid = None
+conversion_executor_lock = threading.Lock()
+
+
+def get_bulk_conversion_workers():
+    """
+    Returns the number of processes converting the pages of a bulk upload, 'facsimile_bulk_conversion_workers',
+    by default the number of CPUs of the host
+    """
+    return max(1, int(config.get("facsimile_bulk_conversion_workers") or os.cpu_count() or 1))
+
+
+def get_bulk_upload_limits():
+    """
+    Returns a tuple of the maximum size in bytes of a bulk upload archive and of the files extracted from it,
+    'facsimile_bulk_upload_max_bytes', and the maximum number of files in a bulk upload, 'facsimile_bulk_upload_max_files'
+    """
+    return int(config.get("facsimile_bulk_upload_max_bytes", 20 * 1024 * 1024 * 1024)), \
+        int(config.get("facsimile_bulk_upload_max_files", 5000))
+
+
+def get_conversion_workers():
+    """
+    Returns the maximum number of facsimile conversions running at the same time on this host,
+    'facsimile_conversion_workers', or 0 if uploaded facsimiles are converted during the upload request
+    """
+    return max(0, int(config.get("facsimile_conversion_workers", 2)))
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def get_job_file_path(job_id):
+    return os.path.join(FACSIMILE_JOBS_FOLDER, f"{job_id}.json")
+
+
+def write_job(job):
+    write_file_atomically(get_job_file_path(job["id"]), json.dumps(job))
+
+
+def process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_job(job_id):
+    """
+    Returns the status of the facsimile conversion job 'job_id' as a dict, or None if there's no such job.
+    Jobs whose process has exited without finishing them (e.g. an API worker restarted while they were queued)
+    are marked as failed.
+    """
+    if not JOB_ID_PATTERN.match(str(job_id)):
+        return None
+    try:
+        with open(get_job_file_path(job_id), encoding="utf-8") as job_file:
+            job = json.load(job_file)
+    except (OSError, ValueError):
+        return None
+    if (job["status"] == "queued" and not process_is_alive(job["owner_pid"])) or \
+            (job["status"] == "running" and not process_is_alive(job["pid"])):
+        job.update(status="failed", error="Conversion was interrupted, upload the facsimile again.", finished=now())
+        write_job(job)
+    return job
+
+
+def get_public_job(job):
+    return {field: job.get(field) for field in PUBLIC_JOB_FIELDS}
+
+
+def remove_expired_jobs():
+    """
+    Removes the status files of jobs finished more than FACSIMILE_JOB_RETENTION_SECONDS ago
+    """
+    expiry = time.time() - FACSIMILE_JOB_RETENTION_SECONDS
+    for entry in os.scandir(FACSIMILE_JOBS_FOLDER):
+        try:
+            if entry.name.endswith(".json") and entry.stat().st_mtime < expiry:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def create_facsimile_job(project, collection_id, page_number, source_path, collection_folder_path, remove_source=True):
+    """
+    Creates a job for converting the uploaded facsimile 'source_path' into page 'page_number' of the facsimile
+    collection 'collection_id' stored in 'collection_folder_path', using the settings of 'project' (see
+    run_facsimile_job). 'source_path' is removed once converted, unless 'remove_source' is False.
+    Returns the status of the job as a dict.
+    """
+    os.makedirs(FACSIMILE_JOBS_FOLDER, exist_ok=True)
+    remove_expired_jobs()
+    project_config = config[project]
+    job = {
+        "id": uuid.uuid4().hex,
+        "project": project,
+        "collection_id": collection_id,
+        "page_number": page_number,
+        "status": "queued",
+        "levels": {str(zoom_level): "pending" for zoom_level in FACSIMILE_IMAGE_SIZES},
+        "tiles": "pending" if project_config.get("facsimile_tiles", False) else None,
+        "engine": None,
+        "timings": {},
+        "error": None,
+        "created": now(),
+        "started": None,
+        "finished": None,
+        "owner_pid": os.getpid(),
+        "pid": None,
+        "source_path": source_path,
+        "remove_source": remove_source,
+        "collection_folder_path": collection_folder_path,
+        "resize_engine": project_config.get("facsimile_resize_engine", "pillow"),
+        "tile_size": project_config.get("facsimile_tile_size", 512)
+    }
+    write_job(job)
+    return job
+
+
+def get_conversion_executor():
+    """
+    Returns the process pool of this worker process used for running facsimile conversion jobs,
+    with 'facsimile_conversion_workers' processes
+    """
+    global conversion_executor, conversion_executor_pid
+    with conversion_executor_lock:
+        # processes of a pool belong to the process that created it, a forked worker process needs a pool of its own
+        if conversion_executor is None or conversion_executor_pid != os.getpid():
+            conversion_executor = ProcessPoolExecutor(max_workers=get_conversion_workers(),
+                                                      mp_context=multiprocessing.get_context("fork"))
+            conversion_executor_pid = os.getpid()
+        return conversion_executor
+
+
+def submit_facsimile_job(job_id):
+    """
+    Queues the job 'job_id' to be run by the conversion process pool of this worker process
+    """
+    global conversion_executor
+    try:
+        get_conversion_executor().submit(run_facsimile_job, job_id)
+    except BrokenProcessPool:
+        # a pool process has died (e.g. killed for using too much memory), start a new pool
+        logger.warning("Facsimile conversion process pool is broken, starting a new one")
+        with conversion_executor_lock:
+            conversion_executor = None
+        get_conversion_executor().submit(run_facsimile_job, job_id)
+
+
+def acquire_conversion_slot(bulk=False):
+    """
+    Waits until fewer than 'facsimile_conversion_workers' conversions are running on this host, the API workers
+    each having a pool of their own. Returns an open file descriptor holding the slot.
+    Pages of bulk uploads have slots of their own, 'facsimile_bulk_conversion_workers' of them.
+    """
+    slots = get_bulk_conversion_workers() if bulk else max(1, get_conversion_workers())
+    prefix = "bulk" if bulk else "slot"
+    while True:
+        for slot in range(slots):
+            lock_fd = acquire_file_lock(os.path.join(FACSIMILE_JOBS_FOLDER, f".{prefix}.{slot}.lock"))
+            if lock_fd is not None:
+                return lock_fd
+        time.sleep(0.5)
+
+
+def convert_resize_uploaded_facsimile(uploaded_file_path, collection_folder_path, page_number, engine="pillow", progress=None):
+    """
+    Given an uploaded file, a destination folder for the facsimile collection, and a page number - create a .jpg file for each zoom level for the page
+    Files are stored as <collection_folder_path>/<zoom_level>/<page_number>.jpg
+    Where zoom_level is determined by FACSIMILE_IMAGE_SIZES in generics.py (1-4)
+
+    The image is resized using 'engine', 'pillow' or 'imagemagick', see resize_facsimile in facsimile_images.py
+
+    Returns a tuple of the engine used and the timings of resize_facsimile if all conversions succeeded, otherwise None.
+    """
+    outputs = [(zoom_level, resolution, safe_join(collection_folder_path, str(zoom_level), f"{page_number}.jpg"))
+               for zoom_level, resolution in FACSIMILE_IMAGE_SIZES.items()]
+    try:
+        used_engine, timings = resize_facsimile(uploaded_file_path, outputs, engine=engine, progress=progress)
+    except subprocess.CalledProcessError as ex:
+        logger.exception("Failed to convert uploaded facsimile!")
+        logger.error(ex.stdout)
+        logger.error(ex.stderr)
+        return None
+    except Exception:
+        logger.exception("Failed to convert uploaded facsimile!")
+        return None
+    level_timings = ", ".join(f"{zoom_level}: {seconds:.3f}s" for zoom_level, seconds in timings["levels"].items())
+    decode_timing = f"decode: {timings['decode']:.3f}s, " if timings["decode"] is not None else ""
+    logger.info(f"Resized {uploaded_file_path} using {used_engine} ({decode_timing}{level_timings})")
+    return used_engine, timings
+
+
+def run_facsimile_job(job_id, bulk=False):
+    """
+    Runs the facsimile conversion job 'job_id', once a conversion slot is available (see acquire_conversion_slot):
+    generates tiles for deep zoom if 'facsimile_tiles' is set for the project, then resizes the uploaded image into
+    each zoom level, updating the status file of the job as each step finishes. The uploaded image is removed afterwards.
+
+    Returns the final status of the job as a dict.
+    """
+    job = read_job(job_id)
+    if job is None or job["status"] != "queued":
+        logger.error(f"Facsimile conversion job {job_id} not found or not queued!")
+        return job
+    slot_fd = acquire_conversion_slot(bulk)
+    try:
+        job.update(status="running", started=now(), pid=os.getpid())
+        write_job(job)
+
+        # generate tiles from the full resolution upload, before it's removed
+        if job["tiles"] is not None:
+            try:
+                start = time.perf_counter()
+                generate_tile_pyramid(job["source_path"], get_tiles_folder(job["collection_folder_path"], job["page_number"]),
+                                      tile_size=job["tile_size"], max_pixels=UPLOAD_MAX_IMAGE_PIXELS)
+                job["timings"]["tiles"] = round(time.perf_counter() - start, 3)
+                job["tiles"] = "done"
+            except Exception:
+                logger.exception("Failed to generate tiles for uploaded facsimile!")
+                job["tiles"] = "failed"
+            write_job(job)
+
+        def progress(zoom_level, seconds):
+            job["levels"][str(zoom_level)] = "done"
+            job["timings"][str(zoom_level)] = round(seconds, 3)
+            write_job(job)
+
+        result = convert_resize_uploaded_facsimile(job["source_path"], job["collection_folder_path"], job["page_number"],
+                                                   engine=job["resize_engine"], progress=progress)
+        if result is None:
+            job["levels"] = {zoom_level: "failed" if status == "pending" else status for zoom_level, status in job["levels"].items()}
+            job.update(status="failed", error="Failed to resize uploaded facsimile!")
+        else:
+            job["engine"] = result[0]
+            if result[1]["decode"] is not None:
+                job["timings"]["decode"] = round(result[1]["decode"], 3)
+            if job["tiles"] == "failed":
+                job.update(status="failed", error="Failed to generate tiles for uploaded facsimile!")
+            else:
+                job["status"] = "done"
+    except Exception:
+        logger.exception(f"Facsimile conversion job {job_id} failed!")
+        job.update(status="failed", error="Failed to convert uploaded facsimile!")
+    finally:
+        job["finished"] = now()
+        write_job(job)
+        release_file_lock(slot_fd)
+        # remove uploaded source file once conversions are complete
+        if job.get("remove_source", True):
+            try:
+                os.remove(job["source_path"])
+            except OSError:
+                pass
+    return job
+
+
+def run_facsimile_jobs(job_ids):
+    """
+    Runs the facsimile conversion jobs 'job_ids' of a bulk upload on a process pool of 'facsimile_bulk_conversion_workers'
+    processes, and returns the final status of each job as a dict by job id
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=get_bulk_conversion_workers(), mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {executor.submit(run_facsimile_job, job_id, True): job_id for job_id in job_ids}
+        for future in as_completed(futures):
+            job_id = futures[future]
+            try:
+                results[job_id] = future.result()
+            except Exception:
+                # the process converting the page died, e.g. killed for using too much memory
+                logger.exception(f"Facsimile conversion job {job_id} failed!")
+                job = read_job(job_id)
+                if job["status"] in ("queued", "running"):
+                    job.update(status="failed", error="Failed to convert uploaded facsimile!", finished=now())
+                    write_job(job)
+                results[job_id] = job
+    return results
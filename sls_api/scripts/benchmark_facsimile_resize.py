@@ -0,0 +1,128 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+
+from PIL import Image, ImageChops, ImageStat
+
+from sls_api.endpoints.generics import FACSIMILE_IMAGE_SIZES
+from sls_api.facsimile_images import RESIZE_ENGINES, resize_facsimile
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger("benchmark_facsimile_resize")
+logger.setLevel(logging.DEBUG)
+
+
+def get_outputs(output_folder):
+    """
+    Returns the (zoom level, resolution, destination path) tuples for resizing an image into 'output_folder',
+    as convert_resize_uploaded_facsimile does for a facsimile collection folder
+    """
+    return [(zoom_level, resolution, os.path.join(output_folder, str(zoom_level), "1.jpg"))
+            for zoom_level, resolution in FACSIMILE_IMAGE_SIZES.items()]
+
+
+def compare_outputs(first_folder, second_folder):
+    """
+    Compares the zoom levels resized into 'first_folder' and 'second_folder', returning a dict of whether the
+    sizes of each level match and the mean absolute difference of their pixel values (0-255)
+    """
+    comparison = {}
+    for zoom_level, _, first_path in get_outputs(first_folder):
+        second_path = os.path.join(second_folder, str(zoom_level), "1.jpg")
+        with Image.open(first_path) as first_image, Image.open(second_path) as second_image:
+            first_image = first_image.convert("RGB")
+            second_image = second_image.convert("RGB")
+            same_size = first_image.size == second_image.size
+            if not same_size:
+                second_image = second_image.resize(first_image.size)
+            difference = ImageStat.Stat(ImageChops.difference(first_image, second_image)).mean
+        comparison[zoom_level] = {
+            "same_size": same_size,
+            "mean_difference": round(statistics.mean(difference), 2)
+        }
+    return comparison
+
+
+def benchmark_resize(image_paths, engines, repeat=3):
+    """
+    Resizes each image in 'image_paths' into all zoom levels in FACSIMILE_IMAGE_SIZES 'repeat' times using each of
+    'engines', and returns a report dict of the decode and per level times of each engine, and how much the output
+    of the engines differs (see compare_outputs)
+    """
+    work_folder = tempfile.mkdtemp(prefix="benchmark_facsimile_resize.")
+    report = {"repeat": repeat, "images": {}, "engines": {}}
+    totals = {engine: [] for engine in engines}
+    try:
+        for image_path in image_paths:
+            with Image.open(image_path) as image:
+                image_report = {
+                    "size": image.size,
+                    "mode": image.mode,
+                    "megabytes": round(os.path.getsize(image_path) / 1024 / 1024, 1),
+                    "engines": {}
+                }
+            logger.info(f"Benchmarking {image_path} ({image_report['size'][0]}x{image_report['size'][1]} {image_report['mode']})...")
+            for engine in engines:
+                output_folder = os.path.join(work_folder, engine)
+                decode_timings = []
+                level_timings = {zoom_level: [] for zoom_level in FACSIMILE_IMAGE_SIZES}
+                used_engine = None
+                try:
+                    for _ in range(repeat):
+                        used_engine, timings = resize_facsimile(image_path, get_outputs(output_folder), engine=engine)
+                        if timings["decode"] is not None:
+                            decode_timings.append(timings["decode"])
+                        for zoom_level, seconds in timings["levels"].items():
+                            level_timings[zoom_level].append(seconds)
+                except Exception as e:
+                    logger.error(f"Failed to resize {image_path} using {engine}: {e}")
+                    image_report["engines"][engine] = {"failed": str(e)}
+                    continue
+                total = (sum(decode_timings) + sum(sum(seconds) for seconds in level_timings.values())) / repeat
+                totals[engine].append(total)
+                image_report["engines"][engine] = {
+                    "used_engine": used_engine,
+                    "decode_seconds": round(statistics.median(decode_timings), 3) if decode_timings else None,
+                    "level_seconds": {zoom_level: round(statistics.median(seconds), 3) for zoom_level, seconds in level_timings.items()},
+                    "total_seconds": round(total, 3)
+                }
+            succeeded = [engine for engine in engines if "failed" not in image_report["engines"][engine]]
+            if len(succeeded) > 1:
+                image_report["difference"] = compare_outputs(os.path.join(work_folder, succeeded[0]),
+                                                             os.path.join(work_folder, succeeded[1]))
+            report["images"][image_path] = image_report
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    for engine in engines:
+        report["engines"][engine] = {
+            "images": len(totals[engine]),
+            "mean_seconds": round(statistics.mean(totals[engine]), 3) if totals[engine] else None,
+            "total_seconds": round(sum(totals[engine]), 3)
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares resizing facsimile images into the zoom levels of FACSIMILE_IMAGE_SIZES using Pillow and imagemagick, "
+                                                 "as done for uploaded facsimiles")
+    parser.add_argument("images", nargs="+", help="Image files to resize, preferably original scans such as TIFF files")
+    parser.add_argument("-e", "--engines", nargs="*", choices=RESIZE_ENGINES, default=RESIZE_ENGINES,
+                        help="Which engines to benchmark (Default all: pillow imagemagick)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of timed resizes per image and engine (Default 3)")
+
+    args = parser.parse_args()
+
+    missing = [image_path for image_path in args.images if not os.path.isfile(image_path)]
+    if missing:
+        logger.error(f"No such files: {', '.join(missing)}, aborting...")
+        sys.exit(1)
+
+    result = benchmark_resize(args.images, args.engines, repeat=args.repeat)
+    logger.info(f"Facsimile resize benchmark:\n{json.dumps(result, indent=4)}")
@@ -0,0 +1,147 @@
+import argparse
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import time
+
+from sls_api.endpoints.generics import XSLT_ENGINES, config, get_xslt_engine, transform_xml
+from sls_api.scripts.prewarm_cache import get_render_tasks
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger("benchmark_xslt_engines")
+logger.setLevel(logging.DEBUG)
+
+valid_projects = [project for project in config if isinstance(config[project], dict) and config[project].get("file_root", False)]
+
+TEXT_TYPES = ["est", "com", "ms"]
+
+XML_DECLARATION_PATTERN = re.compile(r"^\s*<\?xml[^>]*\?>")
+
+
+def normalize_output(result):
+    """
+    Normalizes a rendering for comparing the output of the engines, the same way get_content does (removing
+    line breaks), and removing any XML declaration, which the engines serialize differently
+    """
+    return XML_DECLARATION_PATTERN.sub("", result.replace("\n", "").replace("\r", ""))
+
+
+def time_transform(xsl_file_path, xml_file_path, params, engine, repeat):
+    """
+    Transforms 'xml_file_path' with 'xsl_file_path' 'repeat' times using 'engine'.
+    Returns a tuple of the time of each transformation in seconds and the result of the last one.
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = transform_xml(xsl_file_path, xml_file_path, params=params, engine=engine)
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def benchmark_engines(project, text_types, engines, collection_ids=None, limit=None, repeat=3):
+    """
+    Renders published texts of the given types in 'project' with each of 'engines', using the same files and
+    parameters as the text endpoints, and returns a report dict of compile and transform times per text type
+    and engine, including how many renderings were identical between the engines (see normalize_output).
+
+    At most 'limit' texts of each type are rendered, each 'repeat' times per engine after a warm-up transformation,
+    so stylesheet compilation is timed separately from transformation.
+    """
+    file_root = config[project]["file_root"]
+    tasks_by_type = {text_type: [] for text_type in text_types}
+    for task in get_render_tasks(project, text_types, collection_ids):
+        xml_file_path = os.path.join(file_root, "xml", task["folder"], task["filename"])
+        xsl_file_path = os.path.join(file_root, "xslt", task["xsl_file"])
+        if not os.path.exists(xml_file_path) or not os.path.exists(xsl_file_path):
+            continue
+        if limit is None or len(tasks_by_type[task["folder"]]) < limit:
+            tasks_by_type[task["folder"]].append((task["id"], xsl_file_path, xml_file_path, task["params"]))
+
+    report = {
+        "project": project,
+        "configured_engine": get_xslt_engine(project),
+        "repeat": repeat,
+        "types": {}
+    }
+    for text_type, tasks in tasks_by_type.items():
+        logger.info(f"Benchmarking {len(tasks)} {text_type} texts...")
+        timings = {engine: [] for engine in engines}
+        compile_seconds = {engine: 0.0 for engine in engines}
+        failures = {engine: 0 for engine in engines}
+        identical = 0
+        for task_id, xsl_file_path, xml_file_path, params in tasks:
+            results = {}
+            for engine in engines:
+                xslt_engine_cache = XSLT_ENGINES[engine]
+                try:
+                    if xsl_file_path not in xslt_engine_cache.stats()["stylesheets"]:
+                        start = time.perf_counter()
+                        xslt_engine_cache.get(xsl_file_path)
+                        compile_seconds[engine] += time.perf_counter() - start
+                    # warm-up, so the first timed transformation doesn't include loading anything lazily
+                    transform_xml(xsl_file_path, xml_file_path, params=params, engine=engine)
+                    engine_timings, results[engine] = time_transform(xsl_file_path, xml_file_path, params, engine, repeat)
+                except Exception as e:
+                    logger.error(f"Failed to render {task_id} using {engine}: {e}")
+                    failures[engine] += 1
+                    continue
+                timings[engine].extend(engine_timings)
+            if len(results) == len(engines) and len(set(normalize_output(result) for result in results.values())) == 1:
+                identical += 1
+
+        report["types"][text_type] = {
+            "texts": len(tasks),
+            "identical_output": identical,
+            "engines": {
+                engine: {
+                    "compile_seconds": round(compile_seconds[engine], 3),
+                    "failures": failures[engine],
+                    "mean_seconds": round(statistics.mean(timings[engine]), 4) if timings[engine] else None,
+                    "median_seconds": round(statistics.median(timings[engine]), 4) if timings[engine] else None,
+                    "max_seconds": round(max(timings[engine]), 4) if timings[engine] else None,
+                    "total_seconds": round(sum(timings[engine]), 3)
+                }
+                for engine in engines
+            }
+        }
+        engine_totals = {engine: sum(timings[engine]) for engine in engines if timings[engine] and not failures[engine]}
+        if engine_totals:
+            report["types"][text_type]["fastest_engine"] = min(engine_totals, key=engine_totals.get)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the lxml and Saxon XSLT engines on the EST/COM/MS texts and stylesheets of a project")
+    parser.add_argument("project", nargs="?", help="Which project to benchmark, a project name from --list_projects")
+    parser.add_argument("-c", "--collection_ids", type=int, nargs="*",
+                        help="Only use publications in these publication_collections")
+    parser.add_argument("-t", "--text_types", nargs="*", choices=TEXT_TYPES, default=TEXT_TYPES,
+                        help="Which text types to benchmark (Default all: est com ms)")
+    parser.add_argument("-e", "--engines", nargs="*", choices=list(XSLT_ENGINES), default=list(XSLT_ENGINES),
+                        help="Which XSLT engines to benchmark (Default all: lxml saxon)")
+    parser.add_argument("-n", "--limit", type=int, default=50,
+                        help="Maximum number of texts of each type to render (Default 50)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of timed transformations per text and engine (Default 3)")
+    parser.add_argument("-l", "--list_projects", action="store_true",
+                        help="Print a listing of available projects with seemingly valid configuration and exit")
+
+    args = parser.parse_args()
+
+    if args.list_projects:
+        logger.info(f"Projects with seemingly valid configuration: {', '.join(valid_projects)}")
+        sys.exit(0)
+    if args.project is None:
+        parser.error("project is required unless --list_projects is given")
+    if args.project not in valid_projects:
+        logger.error(f"{args.project} is not in the API configuration or lacks 'file_root' setting, aborting...")
+        sys.exit(1)
+
+    result = benchmark_engines(args.project, args.text_types, args.engines, collection_ids=args.collection_ids,
+                               limit=args.limit, repeat=args.repeat)
+    logger.info(f"XSLT engine benchmark for {args.project}:\n{json.dumps(result, indent=4)}")
@@ -0,0 +1,153 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy.sql import bindparam, text
+
+from sls_api.endpoints.generics import config, db_engine, get_project_id_from_name
+from sls_api.facsimile_images import PYRAMID_FILENAME, generate_tile_pyramid, get_tiles_folder
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger("generate_facsimile_tiles")
+logger.setLevel(logging.DEBUG)
+
+valid_projects = [project for project in config if isinstance(config[project], dict) and config[project].get("file_root", False)]
+
+# tiles are generated from the largest zoom level of the facsimiles, see FACSIMILE_IMAGE_SIZES in generics.py
+SOURCE_ZOOM_LEVEL = "4"
+
+
+def get_facsimile_collection_folders(project, collection_ids=None):
+    """
+    Returns a list of (facsimile collection id, folder) tuples for the non-deleted facsimile collections linked to
+    publications in 'project', optionally limited to 'collection_ids', using the same folders as get_facsimile_file
+    """
+    connection = db_engine.connect()
+    stmt = """SELECT DISTINCT fc.id, fc.folder_path FROM publication_facsimile_collection fc
+    JOIN publication_facsimile f ON f.publication_facsimile_collection_id = fc.id
+    JOIN publication p ON p.id = f.publication_id
+    JOIN publication_collection pc ON pc.id = p.publication_collection_id
+    WHERE pc.project_id = :p_id AND fc.deleted != 1 AND f.deleted != 1
+    """
+    if collection_ids:
+        stmt += " AND fc.id IN :c_ids"
+    stmt += " ORDER BY fc.id"
+    statement = text(stmt).bindparams(p_id=get_project_id_from_name(project))
+    if collection_ids:
+        statement = statement.bindparams(bindparam("c_ids", value=list(collection_ids), expanding=True))
+    folders = []
+    for row in connection.execute(statement).fetchall():
+        if row.folder_path:
+            folders.append((row.id, os.path.join(row.folder_path, str(row.id))))
+        else:
+            folders.append((row.id, os.path.join(config[project]["file_root"], "facsimiles", str(row.id))))
+    connection.close()
+    return folders
+
+
+def get_tile_tasks(project, collection_ids=None, force=False):
+    """
+    Returns a list of (source image, tiles folder) tuples for the facsimile pages of 'project' that have no tiles,
+    or tiles older than the image, or all pages if 'force' is True
+    """
+    tasks = []
+    for collection_id, collection_folder in get_facsimile_collection_folders(project, collection_ids):
+        for source_path in sorted(glob.glob(os.path.join(collection_folder, SOURCE_ZOOM_LEVEL, "*.jpg"))):
+            page_number = os.path.splitext(os.path.basename(source_path))[0]
+            if not page_number.isdigit():
+                continue
+            tiles_folder = get_tiles_folder(collection_folder, page_number)
+            if not force:
+                try:
+                    if os.path.getmtime(os.path.join(tiles_folder, PYRAMID_FILENAME)) >= os.path.getmtime(source_path):
+                        continue
+                except OSError:
+                    pass
+            tasks.append((source_path, tiles_folder))
+    return tasks
+
+
+def tile_task(source_path, tiles_folder, tile_size):
+    """
+    Generates the tiles of a single page. Returns a tuple of the source image, the number of tiles, the time spent
+    in seconds and an error message, if any
+    """
+    start = time.perf_counter()
+    try:
+        pyramid = generate_tile_pyramid(source_path, tiles_folder, tile_size=tile_size)
+    except Exception as e:
+        return source_path, 0, time.perf_counter() - start, str(e)
+    tiles = sum(len(files) for _, _, files in os.walk(tiles_folder)) - 1
+    logger.debug(f"Generated {tiles} tiles at scale factors {pyramid['scale_factors']} for {source_path}")
+    return source_path, tiles, time.perf_counter() - start, None
+
+
+def generate_facsimile_tiles(project, collection_ids=None, workers=None, force=False):
+    """
+    Generates tile pyramids (see generate_tile_pyramid) for the facsimile pages of 'project' using a pool of
+    'workers' processes, and returns a summary dict of the run
+    """
+    tile_size = config[project].get("facsimile_tile_size", 512)
+    tasks = get_tile_tasks(project, collection_ids, force)
+    logger.info(f"Generating tiles for {len(tasks)} facsimile pages in {project} using {workers or os.cpu_count()} processes...")
+    pages = 0
+    tiles = 0
+    failures = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(tile_task, source_path, tiles_folder, tile_size) for source_path, tiles_folder in tasks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            source_path, page_tiles, seconds, error = future.result()
+            if error is not None:
+                logger.error(f"Failed to generate tiles for {source_path}: {error}")
+                failures += 1
+            else:
+                pages += 1
+                tiles += page_tiles
+            if done % 100 == 0 or done == len(tasks):
+                logger.info(f"{done}/{len(tasks)} pages done")
+    elapsed = time.perf_counter() - start
+    return {
+        "project": project,
+        "pages": pages,
+        "tiles": tiles,
+        "failures": failures,
+        "elapsed_seconds": round(elapsed, 3),
+        "pages_per_second": round(pages / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates deep zoom tiles for already uploaded facsimiles of a project, from the largest zoom level (4) of each page")
+    parser.add_argument("project", nargs="?", help="Which project to generate tiles for, either a project name from --list_projects or 'all' for all valid projects")
+    parser.add_argument("-c", "--collection_ids", type=int, nargs="*",
+                        help="Only generate tiles for these publication_facsimile_collections")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes (Default number of CPUs)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Generate tiles for all pages, not only for pages without tiles or with tiles older than the page image")
+    parser.add_argument("-l", "--list_projects", action="store_true",
+                        help="Print a listing of available projects with seemingly valid configuration and exit")
+
+    args = parser.parse_args()
+
+    if args.list_projects:
+        logger.info(f"Projects with seemingly valid configuration: {', '.join(valid_projects)}")
+        sys.exit(0)
+    if args.project is None:
+        parser.error("project is required unless --list_projects is given")
+    if str(args.project).lower() == "all":
+        projects = valid_projects
+    elif args.project in valid_projects:
+        projects = [args.project]
+    else:
+        logger.error(f"{args.project} is not in the API configuration or lacks 'file_root' setting, aborting...")
+        sys.exit(1)
+
+    for p in projects:
+        result = generate_facsimile_tiles(p, collection_ids=args.collection_ids, workers=args.workers, force=args.force)
+        logger.info(f"Tile generation report for {p}:\n{json.dumps(result, indent=4)}")
@@ -0,0 +1,289 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy.sql import bindparam, text
+
+from sls_api.endpoints.generics import config, db_engine, get_content, render_counters, write_file_atomically, \
+    RENDER_ERROR_PREFIXES
+from sls_api.endpoints.text import get_book_id_parameter, get_comment_filename, get_comment_parameters, \
+    get_manuscript_filename, get_reading_text_filename, get_variant_filename, get_variant_xsl_filename
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger("prewarm_cache")
+logger.setLevel(logging.DEBUG)
+
+valid_projects = [project for project in config if isinstance(config[project], dict) and config[project].get("file_root", False)]
+
+TEXT_TYPES = ["est", "com", "ms", "var"]
+
+
+def get_published_publications(project, collection_ids=None):
+    """
+    Returns a list of dicts for all publications in 'project' that the API would show, optionally limited to the
+    publication_collections in 'collection_ids', using the same published status rules as get_published_status
+    """
+    min_status = 1 if config[project]["show_internally_published"] else 2
+    connection = db_engine.connect()
+    stmt = """SELECT publication.id AS publication_id, publication.publication_collection_id AS collection_id,
+    publication.legacy_id, publication.original_filename
+    FROM project
+    JOIN publication_collection ON publication_collection.project_id = project.id
+    JOIN publication ON publication.publication_collection_id = publication_collection.id
+    WHERE project.name = :project
+    AND project.published >= :min_status AND publication_collection.published >= :min_status AND publication.published >= :min_status
+    AND publication_collection.deleted != 1 AND publication.deleted != 1
+    """
+    params = {"project": project, "min_status": min_status}
+    if collection_ids:
+        stmt += " AND publication_collection.id IN :c_ids"
+    stmt += " ORDER BY publication.publication_collection_id, publication.id"
+    statement = text(stmt).bindparams(**params)
+    if collection_ids:
+        statement = statement.bindparams(bindparam("c_ids", value=list(collection_ids), expanding=True))
+    publications = [row._asdict() for row in connection.execute(statement).fetchall() if row is not None]
+    connection.close()
+    return publications
+
+
+def get_rows_by_publication(select, publication_ids):
+    """
+    Runs 'select', which should have a 'publication_id' column and an ':p_ids' IN parameter,
+    and returns the resulting rows as lists of dicts keyed by publication_id
+    """
+    rows = {}
+    if not publication_ids:
+        return rows
+    connection = db_engine.connect()
+    statement = text(select).bindparams(bindparam("p_ids", value=list(publication_ids), expanding=True))
+    for row in connection.execute(statement).fetchall():
+        if row is not None:
+            row = row._asdict()
+            rows.setdefault(row["publication_id"], []).append(row)
+    connection.close()
+    return rows
+
+
+def get_render_tasks(project, text_types, collection_ids=None):
+    """
+    Returns a list of render tasks for all published publications in 'project'.
+
+    Each task is a dict with the same folder, XML filename, XSL filename and XSLT parameters that the
+    corresponding endpoint in sls_api/endpoints/text.py passes to get_content, so the content rendered by this
+    script is served from the cache when requested through the API.
+    """
+    publications = get_published_publications(project, collection_ids)
+    publication_ids = [publication["publication_id"] for publication in publications]
+    logger.info(f"Found {len(publications)} published publications in {project}")
+
+    comment_legacy_ids = {}
+    if "com" in text_types:
+        comment_rows = get_rows_by_publication(
+            """SELECT publication.id AS publication_id, publication_comment.legacy_id FROM publication
+            JOIN publication_comment ON publication_comment.id = publication.publication_comment_id
+            WHERE publication.id IN :p_ids AND publication_comment.legacy_id IS NOT NULL AND publication_comment.original_filename IS NULL""",
+            publication_ids
+        )
+        comment_legacy_ids = {p_id: rows[0]["legacy_id"] for p_id, rows in comment_rows.items()}
+
+    manuscripts = {}
+    if "ms" in text_types:
+        manuscripts = get_rows_by_publication(
+            """SELECT publication_id, sort_order, legacy_id, id, original_filename FROM publication_manuscript
+            WHERE publication_id IN :p_ids AND deleted != 1 ORDER BY sort_order ASC""",
+            publication_ids
+        )
+
+    variants = {}
+    if "var" in text_types:
+        variants = get_rows_by_publication(
+            """SELECT publication_id, sort_order, type, legacy_id, id, original_filename FROM publication_version
+            WHERE publication_id IN :p_ids AND deleted != 1 ORDER BY type, sort_order ASC""",
+            publication_ids
+        )
+
+    book_ids = {}
+    tasks = []
+    for publication in publications:
+        collection_id = publication["collection_id"]
+        publication_id = publication["publication_id"]
+        if collection_id not in book_ids:
+            book_ids[collection_id] = get_book_id_parameter(collection_id)
+        book_id = book_ids[collection_id]
+
+        def add_task(folder, filename, xsl_file, params):
+            tasks.append({
+                "id": f"{folder}/{filename}/{xsl_file}",
+                "project": project,
+                "folder": folder,
+                "filename": filename,
+                "xsl_file": xsl_file,
+                "params": params
+            })
+
+        if "est" in text_types:
+            legacy_id = publication["legacy_id"] if publication["original_filename"] is None else None
+            filename = get_reading_text_filename(collection_id, publication_id, legacy_id=legacy_id)
+            add_task("est", filename, "est.xsl", {"bookId": book_id})
+        if "com" in text_types:
+            filename = get_comment_filename(collection_id, publication_id,
+                                            comment_legacy_id=comment_legacy_ids.get(publication_id))
+            add_task("com", filename, "com.xsl", get_comment_parameters(config[project], filename, book_id))
+        for manuscript in manuscripts.get(publication_id, []):
+            filename = get_manuscript_filename(collection_id, publication_id, manuscript)
+            add_task("ms", filename, "ms_changes.xsl", {"bookId": book_id})
+            add_task("ms", filename, "ms_normalized.xsl", {"bookId": book_id})
+        for variant in variants.get(publication_id, []):
+            filename = get_variant_filename(collection_id, publication_id, variant)
+            add_task("var", filename, get_variant_xsl_filename(variant), {"bookId": book_id})
+    return tasks
+
+
+def init_render_process():
+    """
+    Initializer for render processes, makes sure forked processes don't share database connections with the parent
+    """
+    db_engine.dispose(close=False)
+    logging.getLogger("sls_api.generics").setLevel(logging.WARNING)
+
+
+def render_task(task):
+    """
+    Renders a single task into the cache using get_content. Returns a tuple of the task id, the outcome
+    ('rendered', 'cached', 'missing' or 'failed'), the time spent in seconds and an error message, if any
+    """
+    xml_file_path = os.path.join(config[task["project"]]["file_root"], "xml", task["folder"], task["filename"])
+    if not os.path.exists(xml_file_path):
+        return task["id"], "missing", 0.0, None
+
+    renders_before = render_counters.stats(task["project"]).get(task["project"], {}).get("renders", 0)
+    start = time.perf_counter()
+    content = get_content(task["project"], task["folder"], task["filename"], task["xsl_file"], task["params"])
+    elapsed = time.perf_counter() - start
+    if content.startswith(RENDER_ERROR_PREFIXES):
+        return task["id"], "failed", elapsed, content[:200]
+    renders_after = render_counters.stats(task["project"]).get(task["project"], {}).get("renders", 0)
+    return task["id"], "rendered" if renders_after > renders_before else "cached", elapsed, None
+
+
+def read_state_file(state_file_path):
+    if not os.path.exists(state_file_path):
+        return set()
+    with open(state_file_path, encoding="utf-8") as state_file:
+        return set(json.load(state_file).get("completed", []))
+
+
+def write_state_file(state_file_path, completed):
+    write_file_atomically(state_file_path, json.dumps({"completed": sorted(completed)}))
+
+
+def prewarm_cache(project, text_types, collection_ids=None, workers=None, state_file_path=None, resume=False,
+                  report_interval=100):
+    """
+    Renders all published texts of the given types in 'project' into the content cache using a pool of 'workers'
+    processes, logs progress every 'report_interval' tasks and returns a summary dict of the run.
+
+    Completed tasks are recorded in 'state_file_path', if given. With 'resume', tasks already recorded
+    as completed there are skipped.
+    """
+    tasks = get_render_tasks(project, text_types, collection_ids)
+    completed = set()
+    if state_file_path is not None and resume:
+        completed = read_state_file(state_file_path)
+        tasks = [task for task in tasks if task["id"] not in completed]
+        logger.info(f"Resuming from {state_file_path}, {len(completed)} tasks already completed")
+
+    total = len(tasks)
+    logger.info(f"Pre-warming cache for {total} texts in {project} using {workers or os.cpu_count()} processes...")
+    outcomes = {"rendered": 0, "cached": 0, "missing": 0, "failed": 0}
+    types = {text_type: {"tasks": 0, "seconds": 0.0} for text_type in text_types}
+    task_timings = []
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_render_process) as executor:
+        futures = [executor.submit(render_task, task) for task in tasks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            task_id, outcome, seconds, error = future.result()
+            outcomes[outcome] += 1
+            text_type = task_id.split("/", 1)[0]
+            types[text_type]["tasks"] += 1
+            types[text_type]["seconds"] += seconds
+            if outcome == "failed":
+                logger.error(f"Failed to render {task_id}: {error}")
+            else:
+                completed.add(task_id)
+                if outcome == "rendered":
+                    task_timings.append((seconds, task_id))
+
+            if done % report_interval == 0 or done == total:
+                elapsed = time.perf_counter() - start
+                rate = done / elapsed if elapsed > 0 else 0.0
+                eta = (total - done) / rate if rate > 0 else 0.0
+                logger.info(f"{done}/{total} texts done, {rate:.1f} texts/s, ETA {eta:.0f} s")
+                if state_file_path is not None:
+                    write_state_file(state_file_path, completed)
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "project": project,
+        "tasks": total,
+        "elapsed_seconds": round(elapsed, 3),
+        "texts_per_second": round(total / elapsed, 2) if elapsed > 0 else 0.0,
+        "outcomes": outcomes,
+        "types": {
+            text_type: {
+                "tasks": counts["tasks"],
+                "mean_seconds": round(counts["seconds"] / counts["tasks"], 3) if counts["tasks"] else 0.0
+            }
+            for text_type, counts in types.items()
+        },
+        "slowest_renders": [
+            {"id": task_id, "seconds": round(seconds, 3)} for seconds, task_id in sorted(task_timings, reverse=True)[:10]
+        ]
+    }
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-warms the content cache by rendering published EST/COM/MS/VAR texts of a project")
+    parser.add_argument("project", nargs="?", help="Which project to pre-warm, either a project name from --list_projects or 'all' for all valid projects")
+    parser.add_argument("-c", "--collection_ids", type=int, nargs="*",
+                        help="Only pre-warm publications in these publication_collections")
+    parser.add_argument("-t", "--text_types", nargs="*", choices=TEXT_TYPES, default=TEXT_TYPES,
+                        help="Which text types to pre-warm (Default all: est com ms var)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of render processes (Default number of CPUs)")
+    parser.add_argument("--state_file", type=str,
+                        help="File for recording completed texts (Default prewarm_<project>.json in the temp directory)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip texts recorded as completed in the state file by a previous, interrupted run")
+    parser.add_argument("--report_interval", type=int, default=100,
+                        help="Log progress every N texts (Default 100)")
+    parser.add_argument("-l", "--list_projects", action="store_true",
+                        help="Print a listing of available projects with seemingly valid configuration and exit")
+
+    args = parser.parse_args()
+
+    if args.list_projects:
+        logger.info(f"Projects with seemingly valid configuration: {', '.join(valid_projects)}")
+        sys.exit(0)
+    if args.project is None:
+        parser.error("project is required unless --list_projects is given")
+
+    if str(args.project).lower() == "all":
+        projects = valid_projects
+    elif args.project in valid_projects:
+        projects = [args.project]
+    else:
+        logger.error(f"{args.project} is not in the API configuration or lacks 'file_root' setting, aborting...")
+        sys.exit(1)
+
+    for p in projects:
+        state_file = args.state_file or os.path.join(tempfile.gettempdir(), f"prewarm_{p}.json")
+        result = prewarm_cache(p, args.text_types, collection_ids=args.collection_ids, workers=args.workers,
+                               state_file_path=state_file, resume=args.resume, report_interval=args.report_interval)
+        logger.info(f"Pre-warm report for {p}:\n{json.dumps(result, indent=4)}")
@@ -21,6 +21,9 @@ class SaxonXMLDocument:
 
     Methods:
     - load_xml_file(filepath): Loads an XML document from a file and parses it.
+    - load_xml_string(xml_str): Parses an XML document from a string.
+    - transform_to_string(xslt_exec, parameters): Transforms the document
+      using XSLT and returns the result as a string.
     - transform_and_save(xslt_exec, output_filepath, parameters): Generates a
       transformed document using XSLT.
     - add_namespace(ns_prefix, ns_uri): Adds a namespace to the `namespaces`
@@ -105,13 +108,50 @@ class SaxonXMLDocument:
         """
         try:
             with io.open(filepath, mode="r", encoding="utf-8-sig") as xml_file:
-                self.xml_doc_str = xml_file.read()
-                self.xml_doc_tree = self._parse_from_string(xml_str=self.xml_doc_str)
+                self.load_xml_string(xml_str=xml_file.read())
         except FileNotFoundError:
             raise FileNotFoundError(f"The file '{filepath}' was not found.")
         except (EnvironmentError, PySaxonApiError) as e:
             raise ValueError(f"Error reading or parsing the file '{filepath}': {e}")
 
+    def load_xml_string(self, xml_str: str):
+        """
+        Parses an XML document from a string and loads it.
+
+        Parameters:
+        - xml_str (str): The XML document as a string.
+
+        Raises:
+        - PySaxonApiError: If the string cannot be parsed.
+        """
+        self.xml_doc_str = xml_str
+        self.xml_doc_tree = self._parse_from_string(xml_str=xml_str)
+
+    def transform_to_string(
+            self,
+            xslt_exec: PyXsltExecutable,
+            parameters: Optional[Dict] = None
+    ) -> str:
+        """
+        Transforms the XML document using an XSLT executable and returns the
+        result as a string. The document itself is left unchanged.
+
+        Parameters:
+        - xslt_exec (PyXsltExecutable): The XSLT execution object.
+        - parameters (dict, optional): A dictionary with parameters for the XSLT
+          executable. Defaults to None.
+
+        Returns:
+        - str: The result of the transformation.
+        """
+        # Clear any parameters previously set on the XSLT executable
+        xslt_exec.clear_parameters()
+
+        if parameters:
+            self._set_xslt_parameters_from_dict(xslt_exec, parameters)
+
+        return xslt_exec.transform_to_string(xdm_node=self.xml_doc_tree)
+
     def transform_and_save(
             self,
             xslt_exec: PyXsltExecutable,
@@ -129,16 +169,7 @@ class SaxonXMLDocument:
         - parameters (dict, optional): A dictionary with parameters for the XSLT
           executable. Defaults to None.
         """
-        # Initialize parameters as an empty dictionary if None is passed
-        parameters = parameters or {}
-
-        # Clear any parameters previously set on the XSLT executable
-        xslt_exec.clear_parameters()
-
-        if parameters:
-            self._set_xslt_parameters_from_dict(xslt_exec, parameters)
-
-        self.xml_doc_str = xslt_exec.transform_to_string(xdm_node=self.xml_doc_tree)
+        self.xml_doc_str = self.transform_to_string(xslt_exec, parameters)
         self._save_to_file(output_filepath=output_filepath)
 
     def add_namespace(self, ns_prefix: str, ns_uri: str):
@@ -364,11 +395,15 @@ class SaxonXMLDocument:
         - Converts Python types to their XDM equivalents:
             - `int` -> XDM Integer
             - `str` -> XDM String (UTF-8 encoded by default)
-            - `bool` -> XDM Boolean
+            - `bool` -> XDM Integer 1 or 0, as `bool` is a subclass of `int`
             - `float` -> XDM Float
+        - XDM values (such as ones made with `make_boolean_value`) are
+          returned as they are.
         - For unsupported types, returns an empty XDM sequence.
         """
-        if isinstance(value, int):
+        if isinstance(value, PyXdmValue):
+            return value
+        elif isinstance(value, int):
             return self.saxon_proc.make_integer_value(value)
         elif isinstance(value, str):
             return self.saxon_proc.make_string_value(value, encoding="utf-8")
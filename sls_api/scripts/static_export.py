@@ -0,0 +1,371 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy.sql import bindparam, text
+
+from sls_api import app
+from sls_api.endpoints.generics import config, db_engine, get_project_id_from_name, write_file_atomically
+from sls_api.scripts.prewarm_cache import get_published_publications
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger("static_export")
+logger.setLevel(logging.DEBUG)
+
+valid_projects = [project for project in config if isinstance(config[project], dict) and config[project].get("file_root", False)]
+
+EXPORT_TYPES = ["text", "toc", "collections", "facsimiles", "tooltips"]
+
+# responses of these types only depend on the database, they are requested again only when it has changed
+DATABASE_EXPORT_TYPES = ["collections", "facsimiles", "tooltips"]
+
+# tables the responses of DATABASE_EXPORT_TYPES are built from, see get_database_signature
+SIGNATURE_TABLES = ["project", "publication_collection", "publication", "translation_text", "publication_facsimile",
+                    "publication_facsimile_collection", "subject", "tag", "location"]
+
+TOOLTIP_TABLES = ["subject", "tag", "location"]
+
+URL_PREFIX = "/digitaledition"
+
+EXPORT_FILENAME = "index.json"
+
+# exported files are read by nginx, which runs as a user of its own, whatever the umask of the export is
+EXPORT_FILE_MODE = 0o644
+
+test_client = None
+
+
+def get_published_collections(project, collection_ids=None):
+    """
+    Returns the ids of the publication_collections in 'project' that the API would show,
+    optionally limited to 'collection_ids'
+    """
+    min_status = 1 if config[project]["show_internally_published"] else 2
+    connection = db_engine.connect()
+    stmt = """SELECT publication_collection.id FROM project
+    JOIN publication_collection ON publication_collection.project_id = project.id
+    WHERE project.name = :project AND project.published >= :min_status
+    AND publication_collection.published >= :min_status AND publication_collection.deleted != 1
+    """
+    if collection_ids:
+        stmt += " AND publication_collection.id IN :c_ids"
+    stmt += " ORDER BY publication_collection.id"
+    statement = text(stmt).bindparams(project=project, min_status=min_status)
+    if collection_ids:
+        statement = statement.bindparams(bindparam("c_ids", value=list(collection_ids), expanding=True))
+    collections = [row.id for row in connection.execute(statement).fetchall() if row is not None]
+    connection.close()
+    return collections
+
+
+def get_tooltip_urls(project):
+    """
+    Returns the URLs of the tooltips of all subjects, tags and locations of 'project', by id and by legacy_id
+    """
+    urls = [f"{URL_PREFIX}/tooltips/{table}s" for table in TOOLTIP_TABLES]
+    project_id = get_project_id_from_name(project)
+    connection = db_engine.connect()
+    for table in TOOLTIP_TABLES:
+        statement = text(f"SELECT id, legacy_id FROM {table} WHERE project_id = :p_id ORDER BY id").bindparams(p_id=project_id)
+        for row in connection.execute(statement).fetchall():
+            urls.append(f"{URL_PREFIX}/{project}/tooltips/{table}/{row.id}/")
+            # numeric legacy ids are looked up as ids by the endpoint, so only other legacy ids have URLs of their own
+            if row.legacy_id and not str(row.legacy_id).isdigit() and "/" not in str(row.legacy_id):
+                urls.append(f"{URL_PREFIX}/{project}/tooltips/{table}/{row.legacy_id}/")
+    connection.close()
+    return urls
+
+
+def get_export_urls(project, export_types, collection_ids=None, languages=None):
+    """
+    Returns a list of (URL, export type, collection id, language) tuples of the public read-only responses of
+    'project' to export, for published collections and publications only (see get_published_publications).
+    The collection id and language are None for responses not specific to a collection or language.
+    """
+    languages = languages or []
+    file_root = config[project]["file_root"]
+    collections = get_published_collections(project, collection_ids)
+    publications = get_published_publications(project, collection_ids)
+    urls = []
+
+    def add(export_type, path, collection_id=None, language=None):
+        urls.append((f"{URL_PREFIX}/{project}/{path}", export_type, collection_id, language))
+
+    if "collections" in export_types:
+        add("collections", "collections")
+        for language in languages:
+            add("collections", f"collections/{language}", language=language)
+        for collection_id in collections:
+            add("collections", f"collection/{collection_id}", collection_id)
+            add("collections", f"collection/{collection_id}/publications", collection_id)
+            for language in languages:
+                add("collections", f"collection/{collection_id}/i18n/{language}", collection_id, language)
+        for publication in publications:
+            add("collections", f"publication/{publication['publication_id']}", publication["collection_id"])
+
+    if "toc" in export_types:
+        for collection_id in collections:
+            # table of contents files are named <collection_id>.json and <collection_id>_<language>.json
+            for toc_file_path in sorted(glob.glob(os.path.join(file_root, "toc", f"{collection_id}*.json"))):
+                toc_name = os.path.basename(toc_file_path)[:-len(".json")]
+                if toc_name == str(collection_id):
+                    add("toc", f"toc/{collection_id}", collection_id)
+                    add("toc", f"toc-first/{collection_id}", collection_id)
+                elif toc_name.startswith(f"{collection_id}_"):
+                    # table of contents languages are exported whether or not they're in 'languages'
+                    language = toc_name[len(f"{collection_id}_"):]
+                    add("toc", f"toc/{collection_id}/{language}", collection_id)
+                    add("toc", f"toc-first/{collection_id}/{language}", collection_id)
+
+    if "text" in export_types:
+        for collection_id in collections:
+            add("text", f"text/{collection_id}/fore", collection_id)
+            for language in languages:
+                add("text", f"text/{collection_id}/fore/{language}", collection_id, language)
+        for publication in publications:
+            text_path = f"text/{publication['collection_id']}/{publication['publication_id']}"
+            for text_type in ["est", "com", "list/ms", "ms/", "var/"]:
+                add("text", f"{text_path}/{text_type}", publication["collection_id"])
+
+    if "facsimiles" in export_types:
+        for publication in publications:
+            add("facsimiles", f"facsimiles/{publication['publication_id']}", publication["collection_id"])
+
+    if "tooltips" in export_types:
+        urls.extend((url, "tooltips", None, None) for url in get_tooltip_urls(project))
+    return urls
+
+
+def in_export_scope(entry, export_types, collection_ids=None, languages=None):
+    """
+    Returns True if the manifest entry 'entry' of a previously exported response is within the scope of an export of
+    'export_types', 'collection_ids' and 'languages', i.e. if the export would have exported it were it still available.
+    Entries of manifests written before entries had a type are only in the scope of exports of everything.
+    """
+    if entry.get("type") is None:
+        return not collection_ids and set(export_types) >= set(EXPORT_TYPES)
+    if entry["type"] not in export_types:
+        return False
+    if collection_ids and entry.get("collection_id") is not None and entry["collection_id"] not in collection_ids:
+        return False
+    if entry.get("language") is not None and entry["language"] not in (languages or []):
+        return False
+    return True
+
+
+def get_database_signature():
+    """
+    Returns a signature of the state of the database tables in SIGNATURE_TABLES, from the number of rows and the
+    latest date_modified and date_created of each, which changes whenever rows are added, modified or deleted.
+    Returns None if any of the tables can't be checked, in which case the database is always considered changed.
+    """
+    signature = hashlib.sha256()
+    connection = db_engine.connect()
+    for table in SIGNATURE_TABLES:
+        try:
+            row = connection.execute(text(f"SELECT COUNT(*), MAX(date_created), MAX(date_modified) FROM {table}")).fetchone()
+        except Exception:
+            logger.exception(f"Could not check table {table} for changes")
+            connection.close()
+            return None
+        signature.update(f"{table}={row[0]}|{row[1]}|{row[2]}\n".encode("utf-8"))
+    connection.close()
+    return signature.hexdigest()
+
+
+def get_export_file_path(output_dir, url):
+    """
+    Returns the path of the file the response to 'url' is exported to, '<url>/index.json' below 'output_dir',
+    the path nginx looks for it with 'try_files $uri/index.json' (see nginx.conf)
+    """
+    return os.path.join(output_dir, url.strip("/"), EXPORT_FILENAME)
+
+
+def init_export_process():
+    """
+    Initializer for export processes, makes sure forked processes don't share database connections with the parent
+    """
+    global test_client
+    db_engine.dispose(close=False)
+    logging.getLogger("sls_api").setLevel(logging.WARNING)
+    # exported responses need to be complete, so wait for all texts of e.g. manuscript responses to be rendered
+    config["render_budget_seconds"] = 0
+    test_client = app.test_client()
+
+
+def export_url(url, etag=None):
+    """
+    Requests 'url' from the API, with 'etag' in If-None-Match if given. Returns a tuple of the URL, the status code,
+    the ETag of the response and the response body, or None if the response can't be exported
+    """
+    headers = {"If-None-Match": f'"{etag}"'} if etag else {}
+    try:
+        response = test_client.get(url, headers=headers)
+    except Exception as e:
+        logger.error(f"Failed to export {url}: {e}")
+        return url, 500, None, None
+    response_etag, _ = response.get_etag()
+    if response.status_code != 200 or response.cache_control.no_store:
+        return url, response.status_code, response_etag, None
+    return url, response.status_code, response_etag, response.get_data()
+
+
+def read_manifest(manifest_file_path):
+    if not os.path.exists(manifest_file_path):
+        return {"urls": {}}
+    with open(manifest_file_path, encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)
+
+
+def remove_export_file(output_dir, url):
+    file_path = get_export_file_path(output_dir, url)
+    for path in (file_path, file_path + ".gz"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def static_export(project, output_dir, export_types, collection_ids=None, languages=None, workers=None, full=False):
+    """
+    Exports the public read-only responses of 'project' (see get_export_urls) to files below 'output_dir', mirroring
+    the URLs, so nginx can serve them without the API. Responses are requested through the Flask app using a pool of
+    'workers' processes, and each is written along with a gzip compressed copy for nginx 'gzip_static'.
+
+    Exports are incremental, unless 'full' is given: the ETag and a hash of every exported response are kept in a
+    manifest file, '<project>.manifest.json' in 'output_dir'. Text responses are requested with their previous
+    ETag, so unchanged texts (XML and XSL files, see get_text_validators) aren't rendered again, and responses only
+    built from the database aren't requested at all unless the database has changed since they were exported
+    (see get_database_signature). Files are only rewritten if their content has changed. Files of responses within
+    the scope of the export (see in_export_scope) that are no longer available, e.g. of publications that have been
+    unpublished, are removed. Files and manifest entries outside the scope of the export are left as they are.
+
+    Returns a summary dict of the run.
+    """
+    manifest_file_path = os.path.join(output_dir, f"{project}.manifest.json")
+    manifest = read_manifest(manifest_file_path)
+    # a full export doesn't use the previous entries, but still needs them for the files outside its scope
+    previous_entries = {} if full else manifest["urls"]
+    database_signature = get_database_signature()
+
+    urls = get_export_urls(project, export_types, collection_ids, languages)
+    export_url_set = {url for url, _, _, _ in urls}
+    scopes = {url: {"type": export_type, "collection_id": collection_id, "language": language}
+              for url, export_type, collection_id, language in urls}
+    outcomes = {"written": 0, "unchanged": 0, "skipped": 0, "removed": 0, "failed": 0}
+    exported = {}
+    requests = []
+    for url, export_type, _, _ in urls:
+        entry = previous_entries.get(url)
+        if entry is not None and not os.path.exists(get_export_file_path(output_dir, url)):
+            entry = None
+        # each entry has the signature of the database when it was exported, as exports may be limited to some
+        # collections or types, and responses outside them aren't exported again when the database changes
+        if entry is not None and export_type in DATABASE_EXPORT_TYPES and database_signature is not None \
+                and entry.get("database_signature") == database_signature:
+            exported[url] = dict(entry, **scopes[url])
+            outcomes["skipped"] += 1
+        else:
+            requests.append((url, entry["etag"] if entry is not None else None))
+
+    logger.info(f"Exporting {len(requests)} of {len(urls)} responses of {project} to {output_dir} using {workers or os.cpu_count()} processes...")
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_export_process) as executor:
+        futures = [executor.submit(export_url, url, etag) for url, etag in requests]
+        for done, future in enumerate(as_completed(futures), start=1):
+            url, status, etag, body = future.result()
+            entry = previous_entries.get(url)
+            if status == 304 and entry is not None:
+                exported[url] = dict(entry, database_signature=database_signature, **scopes[url])
+                outcomes["unchanged"] += 1
+            elif body is not None:
+                body_hash = hashlib.sha256(body).hexdigest()
+                exported[url] = dict(etag=etag, sha256=body_hash, database_signature=database_signature, **scopes[url])
+                if entry is not None and entry["sha256"] == body_hash:
+                    outcomes["unchanged"] += 1
+                else:
+                    file_path = get_export_file_path(output_dir, url)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    write_file_atomically(file_path, body, mode="wb", file_mode=EXPORT_FILE_MODE)
+                    write_file_atomically(file_path + ".gz", gzip.compress(body, compresslevel=9, mtime=0), mode="wb",
+                                          file_mode=EXPORT_FILE_MODE)
+                    outcomes["written"] += 1
+            else:
+                # responses that can't be exported are left to the API
+                logger.warning(f"Not exporting {url}, response status {status}")
+                remove_export_file(output_dir, url)
+                outcomes["failed"] += 1
+            if done % 500 == 0:
+                logger.info(f"{done}/{len(requests)} responses exported")
+
+    for url, entry in manifest["urls"].items():
+        if url in export_url_set:
+            continue
+        if in_export_scope(entry, export_types, collection_ids, languages):
+            # responses exported previously that are no longer public
+            remove_export_file(output_dir, url)
+            outcomes["removed"] += 1
+        else:
+            # responses outside the scope of this export are kept as they are
+            exported[url] = entry
+
+    os.makedirs(output_dir, exist_ok=True)
+    write_file_atomically(manifest_file_path, json.dumps({"urls": exported}))
+    elapsed = time.perf_counter() - start
+    return {
+        "project": project,
+        "urls": len(urls),
+        "requested": len(requests),
+        "elapsed_seconds": round(elapsed, 3),
+        "outcomes": outcomes
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the public read-only responses of a project (texts, tables of contents, collections, "
+                                                 "facsimile metadata and tooltips) as static files for nginx to serve, see nginx.conf. "
+                                                 "Should be run again after publishing, as nginx serves the exported files as long as they exist. "
+                                                 "Run it as the user the API runs as (uwsgi in the backend container, as static-export.sh does), "
+                                                 "which owns the output directory. Exported files are readable by all users, for nginx to read them.")
+    parser.add_argument("project", nargs="?", help="Which project to export, either a project name from --list_projects or 'all' for all valid projects")
+    parser.add_argument("-o", "--output_dir", type=str, default="/var/www/static_export",
+                        help="Directory to export the files to, the root directory of the static files in nginx (Default /var/www/static_export)")
+    parser.add_argument("-t", "--types", nargs="*", choices=EXPORT_TYPES, default=EXPORT_TYPES,
+                        help="Which types of responses to export (Default all: text toc collections facsimiles tooltips)")
+    parser.add_argument("-c", "--collection_ids", type=int, nargs="*",
+                        help="Only export publications in these publication_collections")
+    parser.add_argument("--languages", nargs="*",
+                        help="Also export the responses of these languages, for endpoints with language versions (e.g. sv fi)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of export processes (Default number of CPUs)")
+    parser.add_argument("--full", action="store_true",
+                        help="Request and compare every response, instead of only those whose sources have changed since the previous export")
+    parser.add_argument("-l", "--list_projects", action="store_true",
+                        help="Print a listing of available projects with seemingly valid configuration and exit")
+
+    args = parser.parse_args()
+
+    if args.list_projects:
+        logger.info(f"Projects with seemingly valid configuration: {', '.join(valid_projects)}")
+        sys.exit(0)
+    if args.project is None:
+        parser.error("project is required unless --list_projects is given")
+
+    if str(args.project).lower() == "all":
+        projects = valid_projects
+    elif args.project in valid_projects:
+        projects = [args.project]
+    else:
+        logger.error(f"{args.project} is not in the API configuration or lacks 'file_root' setting, aborting...")
+        sys.exit(1)
+
+    for p in projects:
+        result = static_export(p, args.output_dir, args.types, collection_ids=args.collection_ids, languages=args.languages,
+                               workers=args.workers, full=args.full)
+        logger.info(f"Static export report for {p}:\n{json.dumps(result, indent=4)}")
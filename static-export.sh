@@ -0,0 +1,4 @@
+#!/bin/bash
+
+# exports as the uwsgi user, which owns the exported files (see static_export.py --help)
+docker-compose exec --user uwsgi backend python /app/sls_api/scripts/static_export.py ${@:1}